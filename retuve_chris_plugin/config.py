@@ -1,6 +1,9 @@
+import hashlib
 import inspect
-from argparse import ArgumentParser, Namespace
-from typing import Any
+import json
+from argparse import SUPPRESS, ArgumentParser, Namespace
+from dataclasses import dataclass
+from typing import Any, List, Tuple
 
 from dotenv import load_dotenv
 from retuve.defaults.hip_configs import default_US
@@ -10,12 +13,41 @@ load_dotenv()
 
 DISPLAY_TITLE = "Retuve ChRIS Plugin"
 
-parser = ArgumentParser(description=DISPLAY_TITLE)
+
+class PluginArgumentParser(ArgumentParser):
+    """
+    ArgumentParser that also records which options were given explicitly,
+    as the sorted list `passed_options` of the parsed namespace. It travels
+    with the options, e.g. to the daemon, and lets auto-tuning leave them
+    alone even when they were set to their default.
+    """
+
+    def parse_known_args(self, args=None, namespace=None):
+        options, extras = super().parse_known_args(args, namespace)
+
+        # Parse again into a namespace that already has every option, so
+        # argparse fills in no defaults and only given options change
+        unset = object()
+        given = Namespace(
+            **{
+                action.dest: unset
+                for action in self._actions
+                if action.dest != SUPPRESS
+            }
+        )
+        super().parse_known_args(args, given)
+        options.passed_options = sorted(
+            name for name, value in vars(given).items() if value is not unset
+        )
+        return options, extras
+
+
+parser = PluginArgumentParser(description=DISPLAY_TITLE)
 
 
 def add_config_args_to_parser(
     parser: ArgumentParser, config: Any, prefix: str = ""
-) -> None:
+) -> List[str]:
     """
     Add command line arguments from a config object's constructor parameters.
 
@@ -23,7 +55,12 @@ def add_config_args_to_parser(
         parser: The ArgumentParser to add arguments to
         config: The config object to extract arguments from
         prefix: Prefix for argument names (for nested configs)
+
+    Returns:
+        The names of the options added
     """
+    added = []
+
     # Get the constructor signature to understand the parameters
     init_signature = inspect.signature(config.__class__.__init__)
 
@@ -52,29 +89,32 @@ def add_config_args_to_parser(
         if isinstance(current_value, bool) or isinstance(
             current_value, type(None)
         ):
-            parser.add_argument(
+            action = parser.add_argument(
                 arg_name,
                 type=bool,
                 default=bool(current_value),
                 metavar="",
                 help=f"Boolean flag for {param_name}",
             )
+            added.append(action.dest)
         elif isinstance(current_value, int):
-            parser.add_argument(
+            action = parser.add_argument(
                 arg_name,
                 type=int,
                 default=current_value,
                 metavar="",
                 help=f"Integer value for {param_name}",
             )
+            added.append(action.dest)
         elif isinstance(current_value, float):
-            parser.add_argument(
+            action = parser.add_argument(
                 arg_name,
                 type=float,
                 default=current_value,
                 metavar="",
                 help=f"Float value for {param_name}",
             )
+            added.append(action.dest)
         elif (
             isinstance(current_value, str)
             or isinstance(current_value, type(None))
@@ -94,18 +134,21 @@ def add_config_args_to_parser(
                 )
             else:
                 current_value = str(current_value)
-            parser.add_argument(
+            action = parser.add_argument(
                 arg_name,
                 type=str,
                 default=current_value,
                 metavar="",
                 help=f"String value for {param_name}",
             )
+            added.append(action.dest)
         else:
             print(
                 f"Unsupported type for argument {param_name}: {type(current_value)}"
             )
 
+    return added
+
 
 def apply_args_to_config(
     config: Any, args: Namespace, prefix: str = ""
@@ -152,41 +195,112 @@ def apply_args_to_config(
                 )
 
 
-def apply_config(options, inputdir, outputdir):
-    from retuve_yolo_plugin.ultrasound import yolo_predict_dcm_us
+# Options that make up the retuve config, the only ones in the snapshot.
+# Filled in as the config arguments are added to the parser
+CONFIG_OPTIONS = {"incremental_landmarks"}
+
+
+@dataclass(frozen=True)
+class JobConfig:
+    """
+    Immutable snapshot of the options a job's retuve config is built from.
+
+    Only holds plain values, so it is cheap to pickle to worker processes.
+    The retuve config itself is built from it on demand, as an independent
+    copy of default_US.
+    """
+
+    overrides: Tuple[Tuple[str, Any], ...]
+    inputdir: str
+    outputdir: str
+
+    @property
+    def hash(self) -> str:
+        """
+        Stable hash of the config options, for use as a cache key. It is
+        the same for every job run with the same config, whatever its
+        directories.
+        """
+        data = json.dumps(self.overrides, default=str)
+        return hashlib.sha256(data.encode()).hexdigest()
+
+    def to_retuve_config(self):
+        """
+        Build the retuve config for this job, without touching default_US.
+        """
+        from retuve_yolo_plugin.ultrasound import yolo_predict_dcm_us
 
-    # Apply command line arguments to the config
-    apply_args_to_config(default_US, options)
-    apply_args_to_config(default_US.hip, options, "hip.")
-    apply_args_to_config(default_US.trak, options, "trak.")
-    apply_args_to_config(default_US.visuals, options, "visuals.")
-    apply_args_to_config(default_US.api, options, "api.")
-    apply_args_to_config(default_US.batch, options, "batch.")
+        from retuve_chris_plugin.funcs import add_metric_functions
 
-    # Override with input/output directories
-    default_US.batch.datasets = [inputdir]
-    default_US.api.savedir = outputdir
+        config = default_US.get_copy()
+        args = Namespace(**dict(self.overrides))
 
-    # TODO: Add support for mode_func and hip_mode string mapping
-    # For now, keep the hardcoded values
-    default_US.batch.mode_func = yolo_predict_dcm_us
-    default_US.batch.hip_mode = HipMode.US3D
-    default_US.visuals.display_segs = False
-    default_US.visuals.display_full_metric_names = True
-    default_US.worker_device = "cpu"
+        # Apply command line arguments to the config
+        apply_args_to_config(config, args)
+        apply_args_to_config(config.hip, args, "hip.")
+        apply_args_to_config(config.trak, args, "trak.")
+        apply_args_to_config(config.visuals, args, "visuals.")
+        apply_args_to_config(config.api, args, "api.")
+        apply_args_to_config(config.batch, args, "batch.")
 
-    return default_US
+        # Override with input/output directories
+        config.batch.datasets = [self.inputdir]
+        config.api.savedir = self.outputdir
+
+        # TODO: Add support for mode_func and hip_mode string mapping
+        # For now, keep the hardcoded values
+        config.batch.mode_func = yolo_predict_dcm_us
+        config.batch.hip_mode = HipMode.US3D
+        config.visuals.display_segs = False
+        config.visuals.display_full_metric_names = True
+        config.worker_device = "cpu"
+
+        add_metric_functions(
+            config,
+            incremental_landmarks=getattr(
+                args, "incremental_landmarks", False
+            ),
+        )
+
+        return config
+
+
+def build_job_config(options: Namespace, inputdir, outputdir) -> JobConfig:
+    """
+    Snapshot the options of a job.
+
+    Args:
+        options: The parsed plugin options
+        inputdir: Directory containing the input DICOM files
+        outputdir: Directory to write the reports to
+
+    Returns:
+        The frozen job config
+    """
+    overrides = tuple(
+        sorted(
+            (name, value)
+            for name, value in vars(options).items()
+            if name in CONFIG_OPTIONS
+        )
+    )
+    return JobConfig(overrides, str(inputdir), str(outputdir))
+
+
+def apply_config(options, inputdir, outputdir):
+    return build_job_config(options, inputdir, outputdir).to_retuve_config()
 
 
 # Add arguments for the main config
-add_config_args_to_parser(parser, default_US)
+CONFIG_OPTIONS.update(add_config_args_to_parser(parser, default_US))
 
 # Add arguments for subconfigs explicitly
-add_config_args_to_parser(parser, default_US.hip, "hip.")
-add_config_args_to_parser(parser, default_US.trak, "trak.")
-add_config_args_to_parser(parser, default_US.visuals, "visuals.")
-add_config_args_to_parser(parser, default_US.api, "api.")
-add_config_args_to_parser(parser, default_US.batch, "batch.")
+for subconfig in ["hip", "trak", "visuals", "api", "batch"]:
+    CONFIG_OPTIONS.update(
+        add_config_args_to_parser(
+            parser, getattr(default_US, subconfig), f"{subconfig}."
+        )
+    )
 
 parser.add_argument(
     "--github-secret",
@@ -202,6 +316,13 @@ parser.add_argument(
     metavar="",
     help="URL for a custom Retuve model",
 )
+parser.add_argument(
+    "--model-sha256",
+    type=str,
+    default=None,
+    metavar="",
+    help="Expected SHA-256 of the --model-url weights",
+)
 parser.add_argument(
     "--chris-api-url",
     type=str,
@@ -216,3 +337,102 @@ parser.add_argument(
     metavar="",
     help="Login Token for a custom Cube",
 )
+parser.add_argument(
+    "--study-mode",
+    action="store_true",
+    help="Produce one combined report per study and side",
+)
+parser.add_argument(
+    "--study-workers",
+    type=int,
+    default=2,
+    metavar="",
+    help="Sweeps of a study analysed in parallel in study mode",
+)
+parser.add_argument(
+    "--inference-batch-size",
+    type=int,
+    default=8,
+    metavar="",
+    help="Frames per model call, batched across DICOMs analysed together",
+)
+parser.add_argument(
+    "--inference-max-latency",
+    type=float,
+    default=0.05,
+    metavar="",
+    help="Seconds a partial inference batch may wait for more frames",
+)
+parser.add_argument(
+    "--inference-files",
+    type=int,
+    default=2,
+    metavar="",
+    help="DICOMs analysed concurrently so their frames share batches",
+)
+parser.add_argument(
+    "--frame-workers",
+    type=int,
+    default=1,
+    metavar="",
+    help="Processes splitting the frames of one long sweep (1 = off)",
+)
+parser.add_argument(
+    "--decode-workers",
+    type=int,
+    default=0,
+    metavar="",
+    help="Threads decoding compressed frames, 0 for one per available CPU",
+)
+parser.add_argument(
+    "--lazy-decode",
+    action="store_true",
+    help="Decode compressed frames in chunks as they are preprocessed",
+)
+parser.add_argument(
+    "--dedup-threshold",
+    type=float,
+    default=0.0,
+    metavar="",
+    help="Reuse results for frames differing from the last inferred frame "
+    "by less than this many grey levels on average (0 = off)",
+)
+parser.add_argument(
+    "--incremental-landmarks",
+    action="store_true",
+    help="Seed each frame's alpha landmark search with the previous frame's",
+)
+parser.add_argument(
+    "--priority",
+    type=int,
+    default=0,
+    metavar="",
+    help="Lock queue priority, each level doubles the job's precedence",
+)
+parser.add_argument(
+    "--output-mode",
+    type=str,
+    default="pdf",
+    choices=["pdf", "structured", "both"],
+    metavar="",
+    help="Write PDF reports, JSON and DICOM SR measurements, or both",
+)
+parser.add_argument(
+    "--shard-index",
+    type=int,
+    default=0,
+    metavar="",
+    help="Shard of the input this instance processes, from 0",
+)
+parser.add_argument(
+    "--shard-count",
+    type=int,
+    default=1,
+    metavar="",
+    help="Number of instances the input is split between by study",
+)
+parser.add_argument(
+    "--auto-tune",
+    action="store_true",
+    help="Calibrate threads, workers and batch size for this machine",
+)
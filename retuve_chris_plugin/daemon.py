@@ -0,0 +1,185 @@
+"""
+Resident worker that keeps retuve, the model and the report renderer
+loaded between ChRIS jobs.
+
+Jobs are handed over through a spool directory shared with the plugin:
+
+    <spool>/<job_id>.job.json      submitted by the plugin
+    <spool>/<job_id>.running.json  claimed by the daemon
+    <spool>/<job_id>.done.json     result written by the daemon
+    <spool>/daemon.heartbeat       touched by the daemon while alive
+"""
+
+import json
+import os
+import threading
+import time
+import traceback
+import uuid
+from argparse import Namespace
+from pathlib import Path
+from typing import Optional
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+DAEMON_SPOOL = os.environ.get("RETUVE_DAEMON_SPOOL")
+POLL_SECONDS = float(os.environ.get("RETUVE_DAEMON_POLL", "0.5"))
+HEARTBEAT_TIMEOUT = float(
+    os.environ.get("RETUVE_DAEMON_HEARTBEAT_TIMEOUT", "30")
+)
+HEARTBEAT_FNAME = "daemon.heartbeat"
+
+
+def _write_json(path: Path, data: dict) -> None:
+    tmp_path = path.with_name(f".{path.name}.tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+
+def daemon_alive(spool: Optional[str] = DAEMON_SPOOL) -> bool:
+    """
+    Check whether a daemon is currently serving the spool directory.
+    """
+    if not spool:
+        return False
+    heartbeat = Path(spool) / HEARTBEAT_FNAME
+    try:
+        age = time.time() - heartbeat.stat().st_mtime
+    except FileNotFoundError:
+        return False
+    return age < HEARTBEAT_TIMEOUT
+
+
+def submit_job(
+    options: Namespace, inputdir, outputdir, spool: str = DAEMON_SPOOL
+) -> bool:
+    """
+    Hand a job to the daemon and wait for it to finish.
+
+    Args:
+        options: The parsed plugin options
+        inputdir: Directory containing the input DICOM files
+        outputdir: Directory to write the reports to
+        spool: The spool directory the daemon is watching
+
+    Returns:
+        bool: True if the daemon ran the job successfully, False otherwise
+    """
+    spool = Path(spool)
+    job_id = uuid.uuid4().hex
+    done_path = spool / f"{job_id}.done.json"
+
+    _write_json(
+        spool / f"{job_id}.job.json",
+        {
+            "inputdir": str(inputdir),
+            "outputdir": str(outputdir),
+            "options": vars(options),
+        },
+    )
+    print(f"[daemon] Submitted job: {job_id}")
+
+    while not done_path.exists():
+        if not daemon_alive(str(spool)):
+            # Withdraw the job if unclaimed, so a restarted daemon does not
+            # run it as well as the caller
+            try:
+                (spool / f"{job_id}.job.json").unlink()
+            except FileNotFoundError:
+                pass
+            print(f"[daemon] Daemon stopped during job: {job_id}")
+            return False
+        time.sleep(POLL_SECONDS)
+
+    with open(done_path) as f:
+        result = json.load(f)
+    done_path.unlink()
+
+    if result["ok"]:
+        print(f"[daemon] Finished job: {job_id}")
+    else:
+        print(f"[daemon] Job failed: {job_id}\n{result['error']}")
+    return result["ok"]
+
+
+def _claim_next_job(spool: Path) -> Optional[Path]:
+    for job_path in sorted(
+        spool.glob("*.job.json"), key=lambda p: p.stat().st_mtime
+    ):
+        running_path = job_path.with_name(
+            job_path.name.replace(".job.json", ".running.json")
+        )
+        try:
+            os.replace(job_path, running_path)
+        except FileNotFoundError:
+            # Claimed by another daemon on the same spool
+            continue
+        return running_path
+    return None
+
+
+def _keep_heartbeat(heartbeat: Path) -> None:
+    # Runs in a thread so long jobs do not look like a dead daemon
+    while True:
+        heartbeat.touch()
+        time.sleep(HEARTBEAT_TIMEOUT / 3)
+
+
+def serve(spool: str = DAEMON_SPOOL) -> None:
+    """
+    Run the resident worker, processing spooled jobs until interrupted.
+    """
+    from retuve_chris_plugin.config import apply_config, parser
+    from retuve_chris_plugin.job import load_model, run_job
+
+    if not spool:
+        raise ValueError("RETUVE_DAEMON_SPOOL must be set.")
+
+    spool = Path(spool)
+    spool.mkdir(parents=True, exist_ok=True)
+    threading.Thread(
+        target=_keep_heartbeat, args=(spool / HEARTBEAT_FNAME,), daemon=True
+    ).start()
+
+    # Warm up with the default model so the first job does not pay for it
+    warm_options = parser.parse_args([])
+    load_model(
+        apply_config(warm_options, spool, spool),
+        warm_options,
+    )
+    print(f"[daemon] Serving spool: {spool}")
+
+    while True:
+        running_path = _claim_next_job(spool)
+        if running_path is None:
+            time.sleep(POLL_SECONDS)
+            continue
+
+        job_id = running_path.name.split(".")[0]
+        print(f"[daemon] Running job: {job_id}")
+        with open(running_path) as f:
+            job = json.load(f)
+
+        result = {"ok": True, "error": None}
+        try:
+            if not run_job(
+                Namespace(**job["options"]),
+                Path(job["inputdir"]),
+                Path(job["outputdir"]),
+            ):
+                result = {
+                    "ok": False,
+                    "error": "The job stopped on an error, see the daemon log",
+                }
+        except Exception:
+            result = {"ok": False, "error": traceback.format_exc()}
+
+        _write_json(spool / f"{job_id}.done.json", result)
+        running_path.unlink()
+
+
+if __name__ == "__main__":
+    serve()
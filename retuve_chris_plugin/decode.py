@@ -0,0 +1,153 @@
+"""
+Pixel decoding for DICOMs whose frames are encapsulated (JPEG, JPEG 2000,
+RLE...), with the frames decoded in parallel instead of one after another
+by pixel_array.
+"""
+
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+
+def is_encapsulated(dcm) -> bool:
+    file_meta = getattr(dcm, "file_meta", None)
+    syntax = getattr(file_meta, "TransferSyntaxUID", None)
+    return syntax is not None and syntax.is_encapsulated
+
+
+def number_of_frames(dcm) -> int:
+    return int(dcm.get("NumberOfFrames", 1) or 1)
+
+
+class LazyFrames:
+    """
+    The frames of an encapsulated DICOM, decoded only when sliced.
+
+    Slicing decodes just the frames asked for, in parallel, so a sweep
+    processed chunk by chunk never holds all of its decoded frames at once.
+    """
+
+    def __init__(self, decoder: "FrameDecoder", dcm):
+        self.decoder = decoder
+        self.dcm = dcm
+        first = decoder.decode_frames(dcm, [0])
+        self.shape = (number_of_frames(dcm),) + first.shape[1:]
+        self.dtype = first.dtype
+        self.ndim = len(self.shape)
+
+    def __len__(self) -> int:
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return self.decoder.decode_frames(
+                self.dcm, range(*key.indices(len(self)))
+            )
+        return self.decoder.decode_frames(self.dcm, [key])[0]
+
+
+class FrameDecoder:
+    """
+    Decodes the pixel data of DICOMs, with the frames of encapsulated ones
+    decoded by a thread pool shared across sweeps. The pixel data plugins
+    (Pillow, pylibjpeg, ...) release the GIL while decoding a frame.
+
+    Time spent decoding is recorded separately from analysis and logged per
+    sweep and per job.
+    """
+
+    def __init__(self, workers: int, lazy: bool = False):
+        self.workers = max(1, workers)
+        self.lazy = lazy
+        self.pool = (
+            ThreadPoolExecutor(
+                max_workers=self.workers, thread_name_prefix="decode"
+            )
+            if self.workers > 1
+            else None
+        )
+
+        self.lock = threading.Lock()
+        self.seconds = 0.0
+        self.frames = 0
+
+    def close(self) -> None:
+        if self.pool is not None:
+            self.pool.shutdown()
+
+        if self.frames:
+            print(
+                f"[decode] {self.frames} frames decoded in "
+                f"{self.seconds:.2f}s ({self.workers} threads)"
+            )
+
+    def _record(self, frames: int, seconds: float) -> None:
+        with self.lock:
+            self.frames += frames
+            self.seconds += seconds
+
+    def decode_frames(self, dcm, indices) -> np.ndarray:
+        """
+        Decode some frames of an encapsulated DICOM, in parallel.
+
+        Args:
+            dcm: The DICOM dataset
+            indices: Indices of the frames to decode
+
+        Returns:
+            The (frames, rows, columns[, samples]) array of decoded frames
+        """
+        from pydicom.pixels import get_decoder
+
+        indices = list(indices)
+        start = time.perf_counter()
+        decoder = get_decoder(dcm.file_meta.TransferSyntaxUID)
+
+        def decode(index):
+            return decoder.as_array(dcm, index=index)[0]
+
+        # The first frame gives the shape and type of the rest
+        first = decode(indices[0] if indices else 0)
+        frames = np.empty((len(indices),) + first.shape, dtype=first.dtype)
+        if indices:
+            frames[0] = first
+
+        def decode_into(i):
+            frames[i] = decode(indices[i])
+
+        if self.pool is None:
+            for i in range(1, len(indices)):
+                decode_into(i)
+        else:
+            list(self.pool.map(decode_into, range(1, len(indices))))
+
+        self._record(len(indices), time.perf_counter() - start)
+        return frames
+
+    def decode(self, dcm):
+        """
+        The decoded frames of a DICOM.
+
+        Returns:
+            The pixel array for native (uncompressed) pixel data or single
+            frames, else the frames decoded in parallel, or a LazyFrames if
+            decoding lazily
+        """
+        frames = number_of_frames(dcm)
+        if not is_encapsulated(dcm) or frames == 1:
+            start = time.perf_counter()
+            pixels = dcm.pixel_array
+            self._record(frames, time.perf_counter() - start)
+            return pixels
+
+        if self.lazy:
+            return LazyFrames(self, dcm)
+
+        start = time.perf_counter()
+        pixels = self.decode_frames(dcm, range(frames))
+        print(
+            f"[decode] {frames} frames in {time.perf_counter() - start:.2f}s"
+        )
+        return pixels
@@ -2,8 +2,13 @@ import math
 import os
 import statistics
 import tempfile
+import threading
+import time
 from argparse import ArgumentParser
-from typing import Tuple
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from types import SimpleNamespace
+from typing import NamedTuple, Tuple
 
 import numpy as np
 from dotenv import load_dotenv
@@ -11,7 +16,6 @@ from radstract.math import smart_find_intersection
 from radstract.visuals import ReportGenerator
 from retuve.batch import run_batch
 from retuve.classes.draw import DrawTypes, Overlay
-from retuve.defaults.hip_configs import default_US
 from retuve.draw import resize_points_for_display
 from retuve.funcs import analyse_hip_2DUS_sweep
 from retuve.hip_us.classes.general import LandmarksUS
@@ -24,128 +28,101 @@ from retuve_yolo_plugin.ultrasound import (
     yolo_predict_us,
 )
 
+from retuve_chris_plugin.report import CachedReportGenerator
+from retuve_chris_plugin.structured import StructuredReport
 
-def find_alpha_landmarks(
-    ilium,
-    landmarks,
-    config=None,
-    max_samples_per_side: int = 50,
-    min_ratio: float = 0.40,
-) -> Tuple:
-    if ilium is None or getattr(ilium, "midline_moved", None) is None:
-        raise ValueError("Ilium or ilium.midline_moved is invalid.")
-    if not getattr(landmarks, "apex", None):
-        raise ValueError("Landmarks.apex is required.")
+# Sample indices either side of the previous frame's best pairs searched
+# when the search is seeded
+SEED_WINDOW = 3
+# Largest movement of the left, apex and right landmarks between frames,
+# as a fraction of the ilium width, for a seed to be used
+SEED_MAX_SHIFT = 0.05
+# How far below the full search's angle, in degrees, a seeded result may be
+SEED_TOLERANCE = 0.05
 
-    midline = np.asarray(ilium.midline_moved, dtype=float)
-    if midline.ndim != 2 or midline.shape[1] != 2 or len(midline) < 4:
-        raise ValueError("Ilium midline must be an (N, 2) array with N >= 4.")
 
-    apex0_x, apex0_y = float(landmarks.apex[0]), float(landmarks.apex[1])
-    landmarks.apexr = None
-    landmarks.mid_cov_point_new = None
+class AlphaSeed(NamedTuple):
+    """
+    Where a frame's alpha landmark search found its best pairs, used to
+    seed the search on the next frame.
+    """
 
-    if not (
-        landmarks
-        and landmarks.left
-        and landmarks.right
-        and landmarks.apex
-        and landmarks.point_d
-        and landmarks.point_D
-    ):
-        return landmarks, 0
+    left_pair: Tuple[int, int]
+    right_pair: Tuple[int, int]
+    left_samples: int
+    right_samples: int
+    # The left, apex and right landmarks the search started from
+    anchors: tuple
 
-    def distance(point1, point2):
-        if len(point1) != len(point2):
-            raise ValueError("Points must have the same dimensions")
-        return math.sqrt(sum((p2 - p1) ** 2 for p1, p2 in zip(point1, point2)))
 
-    def equal_sample(arr: np.ndarray, k: int) -> np.ndarray:
-        n = len(arr)
-        if n <= k:
-            return arr
-        idx = np.linspace(0, n - 1, k).round().astype(int)
-        idx = np.unique(idx)
-        return arr[idx]
+def _distance(point1, point2) -> float:
+    if len(point1) != len(point2):
+        raise ValueError("Points must have the same dimensions")
+    return math.sqrt(sum((p2 - p1) ** 2 for p1, p2 in zip(point1, point2)))
 
-    xs = midline[:, 1]
-    left_side = midline[xs <= apex0_x]
-    right_side = midline[xs >= apex0_x]
 
-    if len(left_side) < 2 or len(right_side) < 2:
-        raise ValueError("Not enough points on one side of apex.")
+def _equal_sample(arr: np.ndarray, k: int) -> np.ndarray:
+    n = len(arr)
+    if n <= k:
+        return arr
+    idx = np.linspace(0, n - 1, k).round().astype(int)
+    idx = np.unique(idx)
+    return arr[idx]
 
-    left_smpl = equal_sample(left_side, max_samples_per_side)
-    right_smpl = equal_sample(right_side, max_samples_per_side)
 
-    if len(left_smpl) < 2 or len(right_smpl) < 2:
-        raise ValueError("Insufficient sampled points after downsampling.")
+def _build_valid_pairs(
+    smpl: np.ndarray, min_dist: float
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    All ordered pairs of sample points at least min_dist apart.
 
-    def build_valid_pairs(
-        smpl: np.ndarray, min_dist: float
-    ) -> Tuple[np.ndarray, np.ndarray]:
-        n = len(smpl)
-        smpl_xy = smpl[:, [1, 0]].astype(float)
+    Returns:
+        The first and second point of each pair, and their sample indices
+    """
+    n = len(smpl)
+    smpl_xy = smpl[:, [1, 0]].astype(float)
 
-        diff = smpl_xy[np.newaxis, :, :] - smpl_xy[:, np.newaxis, :]
-        dists = np.linalg.norm(diff, axis=2)
+    diff = smpl_xy[np.newaxis, :, :] - smpl_xy[:, np.newaxis, :]
+    dists = np.linalg.norm(diff, axis=2)
 
-        mask = (dists >= min_dist) & (~np.eye(n, dtype=bool))
-        i_idx, j_idx = np.where(mask)
+    mask = (dists >= min_dist) & (~np.eye(n, dtype=bool))
+    i_idx, j_idx = np.where(mask)
 
-        if len(i_idx) == 0:
-            return (
-                np.array([], dtype=float).reshape(0, 2),
-                np.array([], dtype=float).reshape(0, 2),
-            )
+    return smpl_xy[i_idx], smpl_xy[j_idx], i_idx, j_idx
 
-        first_points = smpl_xy[i_idx]
-        second_points = smpl_xy[j_idx]
-        return first_points, second_points
 
-    min_left_dist = distance(landmarks.left, landmarks.apex) * min_ratio
-    min_right_dist = distance(landmarks.right, landmarks.apex) * min_ratio
+def _compute_all_angles(
+    left_first: np.ndarray,
+    left_second: np.ndarray,
+    right_first: np.ndarray,
+    right_second: np.ndarray,
+) -> np.ndarray:
+    A_xy = left_first[:, np.newaxis, :]
+    B_xy = left_second[:, np.newaxis, :]
+    R1_xy = right_first[np.newaxis, :, :]
+    R2_xy = right_second[np.newaxis, :, :]
 
-    left_first, left_second = build_valid_pairs(left_smpl, min_left_dist)
-    right_first, right_second = build_valid_pairs(right_smpl, min_right_dist)
+    BA = A_xy - B_xy
+    dvec = R2_xy - R1_xy
 
-    if len(left_first) == 0 or len(right_first) == 0:
-        raise ValueError("No valid side pairs found.")
+    nBA = np.linalg.norm(BA, axis=2, keepdims=True)
+    nd = np.linalg.norm(dvec, axis=2, keepdims=True)
 
-    def compute_all_angles(
-        left_first: np.ndarray,
-        left_second: np.ndarray,
-        right_first: np.ndarray,
-        right_second: np.ndarray,
-    ) -> np.ndarray:
-        A_xy = left_first[:, np.newaxis, :]
-        B_xy = left_second[:, np.newaxis, :]
-        R1_xy = right_first[np.newaxis, :, :]
-        R2_xy = right_second[np.newaxis, :, :]
+    nBA = np.where(nBA == 0, 1.0, nBA)
+    nd = np.where(nd == 0, 1.0, nd)
 
-        BA = A_xy - B_xy
-        dvec = R2_xy - R1_xy
+    u = dvec / nd
+    BC = u
 
-        nBA = np.linalg.norm(BA, axis=2, keepdims=True)
-        nd = np.linalg.norm(dvec, axis=2, keepdims=True)
+    cos_t = np.sum(BA * BC, axis=2) / (nBA[:, :, 0] * 1.0)
+    cos_t = np.clip(cos_t, -1.0, 1.0)
 
-        nBA = np.where(nBA == 0, 1.0, nBA)
-        nd = np.where(nd == 0, 1.0, nd)
+    theta = np.degrees(np.arccos(cos_t))
+    theta = np.where(theta > 90.0, 180.0 - theta, theta)
+    return theta
 
-        u = dvec / nd
-        BC = u
-
-        cos_t = np.sum(BA * BC, axis=2) / (nBA[:, :, 0] * 1.0)
-        cos_t = np.clip(cos_t, -1.0, 1.0)
-
-        theta = np.degrees(np.arccos(cos_t))
-        theta = np.where(theta > 90.0, 180.0 - theta, theta)
-        return theta
-
-    angles = compute_all_angles(
-        left_first, left_second, right_first, right_second
-    )
 
+def _angle_bounds(angles: np.ndarray) -> Tuple[float, float]:
     valid_mask = np.isfinite(angles)
     valid_angles = angles[valid_mask]
 
@@ -154,8 +131,152 @@ def find_alpha_landmarks(
 
     mean_angle = np.mean(valid_angles)
     std_angle = np.std(valid_angles)
-    lower_bound = mean_angle - std_angle * 2
-    upper_bound = mean_angle + std_angle * 2
+    return mean_angle - std_angle * 2, mean_angle + std_angle * 2
+
+
+def _line_directions(first: np.ndarray, second: np.ndarray) -> np.ndarray:
+    """
+    Direction of each line in degrees, in [0, 180], or NaN for lines of
+    zero length.
+    """
+    vec = second - first
+    directions = np.degrees(np.arctan2(vec[:, 1], vec[:, 0])) % 180.0
+    directions[~vec.any(axis=1)] = np.nan
+    return directions
+
+
+def _pair_angle_bounds(
+    left_dirs: np.ndarray, right_dirs: np.ndarray
+) -> Tuple[float, float]:
+    """
+    The 2 sigma bounds of the angles between every left and every right
+    line, given their _line_directions. Matches _angle_bounds of
+    _compute_all_angles up to rounding, without building the full matrix.
+
+    The acute angle between two lines is piecewise linear in the right
+    line's direction, so with the right directions sorted, the sums of the
+    angles and of their squares against each left line come from prefix
+    sums, in O((L + R) log R).
+    """
+    count = len(left_dirs) * len(right_dirs)
+
+    # A zero-length line makes an angle of 90 degrees with every other line
+    left_dirs = left_dirs[~np.isnan(left_dirs)]
+    right_dirs = np.sort(right_dirs[~np.isnan(right_dirs)])
+    zero_count = count - len(left_dirs) * len(right_dirs)
+    total = 90.0 * zero_count
+    total_sq = 90.0**2 * zero_count
+
+    prefix = np.concatenate([[0.0], np.cumsum(right_dirs)])
+    prefix_sq = np.concatenate([[0.0], np.cumsum(right_dirs**2)])
+    cuts = [
+        np.zeros(len(left_dirs), dtype=int),
+        np.searchsorted(right_dirs, left_dirs - 90.0),
+        np.searchsorted(right_dirs, left_dirs),
+        np.searchsorted(right_dirs, left_dirs + 90.0),
+        np.full(len(left_dirs), len(right_dirs)),
+    ]
+    # The angle is offset + sign * right direction between each pair of cuts
+    pieces = [
+        (180.0 - left_dirs, 1.0),
+        (left_dirs, -1.0),
+        (-left_dirs, 1.0),
+        (180.0 + left_dirs, -1.0),
+    ]
+    for (offset, sign), start, stop in zip(pieces, cuts, cuts[1:]):
+        n = stop - start
+        sum_dirs = prefix[stop] - prefix[start]
+        sum_sq = prefix_sq[stop] - prefix_sq[start]
+        total += np.sum(n * offset + sign * sum_dirs)
+        total_sq += np.sum(
+            n * offset**2 + 2.0 * sign * offset * sum_dirs + sum_sq
+        )
+
+    mean_angle = total / count
+    std_angle = math.sqrt(max(0.0, total_sq / count - mean_angle**2))
+    return mean_angle - std_angle * 2, mean_angle + std_angle * 2
+
+
+def _largest_pair_angle(
+    left_dirs: np.ndarray, right_dirs: np.ndarray, upper_bound: float
+) -> float:
+    """
+    The largest angle at most upper_bound between any left and any right
+    line, given their _line_directions, in O((L + R) log R). This is the
+    angle the full search finds, up to rounding.
+    """
+    limit = min(upper_bound, 90.0)
+    if limit >= 90.0 and (
+        np.isnan(left_dirs).any() or np.isnan(right_dirs).any()
+    ):
+        return 90.0
+
+    left_dirs = left_dirs[~np.isnan(left_dirs)]
+    right_dirs = np.sort(right_dirs[~np.isnan(right_dirs)])
+    if len(left_dirs) == 0 or len(right_dirs) == 0:
+        return -np.inf
+
+    # Directions are on a circle of 180 degrees, and the angle between two
+    # lines is their distance on it. The right line furthest from each
+    # left line, but within limit of it, is the first one past its
+    # direction - limit, or the last one before its direction + limit
+    circle = np.concatenate(
+        [right_dirs - 180.0, right_dirs, right_dirs + 180.0]
+    )
+    first = circle[np.searchsorted(circle, left_dirs - limit)]
+    last = circle[np.searchsorted(circle, left_dirs + limit, "right") - 1]
+    angles = np.maximum(
+        np.where(first <= left_dirs, left_dirs - first, -np.inf),
+        np.where(last >= left_dirs, last - left_dirs, -np.inf),
+    )
+    return float(angles.max())
+
+
+def _near_pairs(
+    pairs: tuple,
+    pair: Tuple[int, int],
+    seed_samples: int,
+    samples: int,
+) -> tuple:
+    # Map the seed's sample indices onto this frame's samples
+    scale = (samples - 1) / max(1, seed_samples - 1)
+    i_centre, j_centre = (round(index * scale) for index in pair)
+    _, _, i_idx, j_idx = pairs
+    near = (np.abs(i_idx - i_centre) <= SEED_WINDOW) & (
+        np.abs(j_idx - j_centre) <= SEED_WINDOW
+    )
+    return tuple(values[near] for values in pairs)
+
+
+def _search_alpha_pairs(
+    left_pairs: tuple,
+    right_pairs: tuple,
+    bounds: Tuple[float, float] = None,
+):
+    """
+    Find the left and right line pairs with the largest angle inside the 2
+    sigma bounds of all pairs' angles.
+
+    Args:
+        left_pairs: The left pairs, from _build_valid_pairs
+        right_pairs: The right pairs, from _build_valid_pairs
+        bounds: The angle bounds to use, by default those of the angles
+            of these pairs
+
+    Raises:
+        ValueError: If no pair qualifies
+    """
+    left_first, left_second, left_i, left_j = left_pairs
+    right_first, right_second, right_i, right_j = right_pairs
+
+    if len(left_first) == 0 or len(right_first) == 0:
+        raise ValueError("No valid side pairs found.")
+
+    angles = _compute_all_angles(
+        left_first, left_second, right_first, right_second
+    )
+
+    lower_bound, upper_bound = bounds or _angle_bounds(angles)
 
     filtered_mask = (angles >= lower_bound) & (angles <= upper_bound)
     filtered_angles = np.where(filtered_mask, angles, np.nan)
@@ -174,10 +295,162 @@ def find_alpha_landmarks(
         raise ValueError("Best angle computation failed.")
 
     i_left, i_right = best_idx
-    A_xy = left_first[i_left]
-    B_xy = left_second[i_left]
-    R1_xy = right_first[i_right]
-    R2_xy = right_second[i_right]
+    points = (
+        left_first[i_left],
+        left_second[i_left],
+        right_first[i_right],
+        right_second[i_right],
+    )
+    pairs = (
+        (int(left_i[i_left]), int(left_j[i_left])),
+        (int(right_i[i_right]), int(right_j[i_right])),
+    )
+    return best_angle, points, pairs
+
+
+def _search_near_seed(
+    left_pairs: tuple,
+    right_pairs: tuple,
+    seed: AlphaSeed,
+    left_samples: int,
+    right_samples: int,
+):
+    """
+    Search only the pairs near the seed's best pairs, against the bounds of
+    every pair's angle.
+
+    The result is checked against the largest angle any pair makes within
+    the bounds, which is what the full search finds. So a seeded result is
+    never more than SEED_TOLERANCE below the full search's.
+
+    Raises:
+        ValueError: If nothing near the seed is within SEED_TOLERANCE of
+            the full search's angle
+    """
+    left_dirs = _line_directions(left_pairs[0], left_pairs[1])
+    right_dirs = _line_directions(right_pairs[0], right_pairs[1])
+    bounds = _pair_angle_bounds(left_dirs, right_dirs)
+
+    best = _search_alpha_pairs(
+        _near_pairs(
+            left_pairs, seed.left_pair, seed.left_samples, left_samples
+        ),
+        _near_pairs(
+            right_pairs, seed.right_pair, seed.right_samples, right_samples
+        ),
+        bounds,
+    )
+    if _largest_pair_angle(left_dirs, right_dirs, bounds[1]) - best[0] > (
+        SEED_TOLERANCE
+    ):
+        # The best pairs overall are elsewhere
+        raise ValueError("Seeded search fell short of the full search.")
+    return best
+
+
+def _seed_usable(seed: AlphaSeed, anchors: tuple) -> bool:
+    if seed is None:
+        return False
+    # The midline moved too much for the previous best pairs to be close
+    max_shift = SEED_MAX_SHIFT * _distance(anchors[0], anchors[2])
+    return all(
+        _distance(old, new) <= max_shift
+        for old, new in zip(seed.anchors, anchors)
+    )
+
+
+def find_alpha_landmarks(
+    ilium,
+    landmarks,
+    config=None,
+    max_samples_per_side: int = 50,
+    min_ratio: float = 0.40,
+    seed: AlphaSeed = None,
+) -> Tuple:
+    """
+    Find the left and right ilium lines giving the alpha angle.
+
+    Args:
+        ilium: The ilium segmentation, with its midline
+        landmarks: The frame's landmarks, updated in place
+        config: The retuve config
+        max_samples_per_side: Midline points sampled either side of apex
+        min_ratio: Shortest line, as a fraction of the apex distance
+        seed: The previous frame's landmarks.alpha_seed, to only search
+            near its best pairs. The full search is run instead if the
+            landmarks moved too far, or nothing near them comes within
+            SEED_TOLERANCE of the full search's angle.
+
+    Returns:
+        The landmarks and the best angle
+    """
+    if ilium is None or getattr(ilium, "midline_moved", None) is None:
+        raise ValueError("Ilium or ilium.midline_moved is invalid.")
+    if not getattr(landmarks, "apex", None):
+        raise ValueError("Landmarks.apex is required.")
+
+    midline = np.asarray(ilium.midline_moved, dtype=float)
+    if midline.ndim != 2 or midline.shape[1] != 2 or len(midline) < 4:
+        raise ValueError("Ilium midline must be an (N, 2) array with N >= 4.")
+
+    apex0_x, apex0_y = float(landmarks.apex[0]), float(landmarks.apex[1])
+    landmarks.apexr = None
+    landmarks.mid_cov_point_new = None
+    landmarks.alpha_seed = None
+
+    if not (
+        landmarks
+        and landmarks.left
+        and landmarks.right
+        and landmarks.apex
+        and landmarks.point_d
+        and landmarks.point_D
+    ):
+        return landmarks, 0
+
+    xs = midline[:, 1]
+    left_side = midline[xs <= apex0_x]
+    right_side = midline[xs >= apex0_x]
+
+    if len(left_side) < 2 or len(right_side) < 2:
+        raise ValueError("Not enough points on one side of apex.")
+
+    left_smpl = _equal_sample(left_side, max_samples_per_side)
+    right_smpl = _equal_sample(right_side, max_samples_per_side)
+
+    if len(left_smpl) < 2 or len(right_smpl) < 2:
+        raise ValueError("Insufficient sampled points after downsampling.")
+
+    min_left_dist = _distance(landmarks.left, landmarks.apex) * min_ratio
+    min_right_dist = _distance(landmarks.right, landmarks.apex) * min_ratio
+
+    anchors = (
+        tuple(map(float, landmarks.left)),
+        tuple(map(float, landmarks.apex)),
+        tuple(map(float, landmarks.right)),
+    )
+
+    left_pairs = _build_valid_pairs(left_smpl, min_left_dist)
+    right_pairs = _build_valid_pairs(right_smpl, min_right_dist)
+
+    best = None
+    if _seed_usable(seed, anchors):
+        try:
+            best = _search_near_seed(
+                left_pairs,
+                right_pairs,
+                seed,
+                len(left_smpl),
+                len(right_smpl),
+            )
+        except ValueError:
+            # Nothing near the previous pairs is good enough
+            best = None
+
+    if best is None:
+        best = _search_alpha_pairs(left_pairs, right_pairs)
+
+    best_angle, (A_xy, B_xy, R1_xy, R2_xy), pairs = best
 
     left_new = (float(A_xy[0]), float(A_xy[1]))
     apexl = (float(B_xy[0]), float(B_xy[1]))
@@ -202,6 +475,14 @@ def find_alpha_landmarks(
         landmarks.point_D,
     )
 
+    landmarks.alpha_seed = AlphaSeed(
+        left_pair=pairs[0],
+        right_pair=pairs[1],
+        left_samples=len(left_smpl),
+        right_samples=len(right_smpl),
+        anchors=anchors,
+    )
+
     return landmarks, round(best_angle, 2)
 
 
@@ -265,7 +546,39 @@ def find_coverage(landmarks: LandmarksUS) -> float:
     return round(coverage, 3)
 
 
-def replace_alpha(hip, seg_frame_objs, config):
+# Landmarks set by find_alpha_landmarks
+ALPHA_LANDMARKS = (
+    "left_new",
+    "apexl",
+    "apexr",
+    "right_new",
+    "mid_cov_point_new",
+    "alpha_seed",
+)
+
+# The previous frame's landmark search, per analysis thread, so frames
+# reusing a duplicate frame's segmentation also reuse its search
+_PREVIOUS_FRAME = threading.local()
+
+
+def _alpha_inputs_key(ilium, landmarks) -> tuple:
+    midline = np.asarray(ilium.midline_moved)
+    return (
+        midline.shape,
+        hash(midline.tobytes()),
+        str(
+            (
+                landmarks.left,
+                landmarks.right,
+                landmarks.apex,
+                landmarks.point_d,
+                landmarks.point_D,
+            )
+        ),
+    )
+
+
+def replace_alpha(hip, seg_frame_objs, config, incremental: bool = False):
     ilium = None
     for obj in seg_frame_objs:
         if obj.empty:
@@ -277,7 +590,38 @@ def replace_alpha(hip, seg_frame_objs, config):
     if not ilium:
         return None, None
 
-    hip.landmarks, _ = find_alpha_landmarks(ilium, hip.landmarks, config)
+    seed = None
+    frame_no = getattr(hip, "frame_no", None)
+    previous_seed = getattr(_PREVIOUS_FRAME, "seed", None)
+    if incremental and previous_seed is not None and frame_no is not None:
+        # Only seed from a frame just before, in the same sweep
+        previous_frame_no, seed = previous_seed
+        if not 0 < frame_no - previous_frame_no <= 2:
+            seed = None
+
+    key = _alpha_inputs_key(ilium, hip.landmarks)
+    previous = getattr(_PREVIOUS_FRAME, "alpha", None)
+    if previous is not None and previous[0] == key:
+        for name, value in previous[1].items():
+            setattr(hip.landmarks, name, value)
+    else:
+        hip.landmarks, _ = find_alpha_landmarks(
+            ilium, hip.landmarks, config, seed=seed
+        )
+        _PREVIOUS_FRAME.alpha = (
+            key,
+            {
+                name: getattr(hip.landmarks, name, None)
+                for name in ALPHA_LANDMARKS
+            },
+        )
+
+    if incremental:
+        _PREVIOUS_FRAME.seed = (
+            frame_no,
+            getattr(hip.landmarks, "alpha_seed", None),
+        )
+
     alpha_angle = find_alpha_angle(hip.landmarks)
     coverage = find_coverage(hip.landmarks)
 
@@ -340,25 +684,50 @@ def alpha_landmarks(hip, seg_frame_objs, overlay: Overlay, config):
     return overlay
 
 
-def scan_quality_graf(hip_datas, results, config):
-    graf_confs, graf_frame = find_graf_plane_manual_features(
+def graf_plane(hip_datas, results, config):
+    """
+    Graf-plane confidences and chosen frame for a sweep, computed at most
+    once per sweep and shared by every full-metric function.
+
+    Always searched here rather than taken from hip_datas, whose
+    confidences are one-hot when the frame was selected manually.
+    """
+    memo = getattr(hip_datas, "graf_plane_memo", None)
+    if memo is not None:
+        return memo
+
+    hip_datas.graf_plane_memo = find_graf_plane_manual_features(
         hip_datas, results, config, just_graf_confs=True
     )
+    return hip_datas.graf_plane_memo
+
+
+def scan_quality_graf(hip_datas, results, config):
+    graf_confs, graf_frame = graf_plane(hip_datas, results, config)
+    if graf_confs is None or graf_frame is None:
+        return 0
+
+    alpha = 0
     for metric in hip_datas[graf_frame].metrics:
         if metric.name == "alpha" and metric.value > 0:
             alpha = metric.value
-    if graf_confs is None:
-        return 0
 
     value = min(10, round((graf_confs[graf_frame] - alpha) / 60, 2))
     return value
 
 
-default_US.hip.per_frame_metric_functions = [("original_alpha", replace_alpha)]
-default_US.hip.post_draw_functions = [("alpha_landmarks", alpha_landmarks)]
-# default_US.hip.full_metric_functions = [
-#     ("Scan Quality (Out of 10)", scan_quality_graf),
-# ]
+def add_metric_functions(config, incremental_landmarks: bool = False):
+    config.hip.per_frame_metric_functions = [
+        (
+            "original_alpha",
+            partial(replace_alpha, incremental=incremental_landmarks),
+        )
+    ]
+    config.hip.post_draw_functions = [("alpha_landmarks", alpha_landmarks)]
+    config.hip.full_metric_functions = [
+        ("Scan Quality (Out of 10)", scan_quality_graf),
+    ]
+
 
 load_dotenv()
 
@@ -372,106 +741,352 @@ else:
 parser = ArgumentParser(description=DISPLAY_TITLE)
 
 
-def get_retuve_report(dicom, model):
-    try:
-        hip_data, hip_image, dev_metrics, video_clip = analyse_hip_2DUS_sweep(
-            image=dicom,
-            keyphrase=default_US,  # Adjust based on your config keyphrase
-            modes_func=yolo_predict_dcm_us,
-            modes_func_kwargs_dict={"model": model},
-        )
+def analyse_dicom(dicom, model, config, modes_func=yolo_predict_dcm_us):
+    """
+    Run the retuve sweep analysis on a single DICOM.
 
-        metric_names = list(
-            set([metric.name.capitalize() for metric in hip_data.metrics])
-        )
-        metric_names.sort()  # Sort for consistent ordering
-
-        headers = ["Metric Name", "Value"]
-        values = [
-            [
-                metric.name
-                for metric in hip_data.metrics
-                if metric.name != "original_alpha"
-            ],
-            [
-                str(metric.value)
-                for metric in hip_data.metrics
-                if metric.name != "original_alpha"
-            ],
-        ]
-
-        # values needs to be rotated 90 degrees
-        values = list(zip(*values))
-
-        r_gen = ReportGenerator(
-            title=f"Hip Analysis Report - {dicom.PatientID} - {dicom.InstanceNumber}",
-            footer_text="Test/Example report created by https://github.com/radoss-org/radstract",
-            footer_website="https://radoss.org",
-            footer_email="info@radoss.org",
-            logo_path=f"{IMAGE_DIR}/images/logo.png",
-        )
+    modes_func runs the segmentation, see inference.FrameParallelPredictor
+    for an alternative to the default.
+
+    Returns:
+        The graf hip data, the graf frame image and the metric table rows
+    """
+    hip_data, hip_image, dev_metrics, video_clip = analyse_hip_2DUS_sweep(
+        image=dicom,
+        keyphrase=config,
+        modes_func=modes_func,
+        modes_func_kwargs_dict={"model": model},
+    )
 
-        r_gen.add_subtitle("Ultrasound DDH Analysis", level=1)
+    if hip_data is None:
+        raise ValueError("Sweep analysis failed.")
 
-        r_gen.add_paragraph(
-            "This report contains the results of a graf analysis of a 2DUS image of a hip."
+    values = [
+        [
+            metric.name
+            for metric in hip_data.metrics
+            if metric.name != "original_alpha"
+        ],
+        [
+            str(metric.value)
+            for metric in hip_data.metrics
+            if metric.name != "original_alpha"
+        ],
+    ]
+
+    # values needs to be rotated 90 degrees
+    values = list(zip(*values))
+
+    return hip_data, hip_image, values
+
+
+def new_report_generator(title: str) -> ReportGenerator:
+    return CachedReportGenerator(
+        title=title,
+        footer_text="Test/Example report created by https://github.com/radoss-org/radstract",
+        footer_website="https://radoss.org",
+        footer_email="info@radoss.org",
+        logo_path=f"{IMAGE_DIR}/images/logo.png",
+    )
+
+
+def add_report_intro(r_gen: ReportGenerator) -> None:
+    r_gen.add_subtitle("Ultrasound DDH Analysis", level=1)
+
+    r_gen.add_paragraph(
+        "This report contains the results of a graf analysis of a 2DUS image of a hip."
+    )
+
+    r_gen.add_warning(
+        "Over 50% of hips can go from moderately dysplastic to normal and vice-versa purely with probe tilt (Jaremko et al., 2014 - Probe Orientation)"
+    )
+
+    r_gen.add_warning(
+        "Alpha angle is expected to increase with age. At 16 weeks, alpha angle is on average 5 degrees higher than at 1-8 weeks. (Hareendranathan et al., 2022 - Normal variation))"
+    )
+
+
+def add_hip_image(r_gen: ReportGenerator, hip_image, caption: str) -> None:
+    with tempfile.NamedTemporaryFile(delete=False, suffix=".png") as temp_file:
+        hip_image.save(temp_file.name)
+
+        r_gen.add_image(
+            image_path=temp_file.name,
+            caption=caption,
+            max_width="90%",
         )
 
-        r_gen.add_warning(
-            "Over 50% of hips can go from moderately dysplastic to normal and vice-versa purely with probe tilt (Jaremko et al., 2014 - Probe Orientation)"
+
+def get_error_report(output_mode: str = "pdf"):
+    structured = None
+    if output_mode != "pdf":
+        structured = StructuredReport(
+            "Hip Analysis Report - Error", success=False
         )
+    if output_mode == "structured":
+        return None, structured
+
+    # Generate a minimal error report
+    r_gen = CachedReportGenerator(
+        title="Hip Analysis Report - Error",
+        footer_text="For assistance, contact amcarth1@ualberta.ca",
+        footer_website="https://radoss.org",
+        footer_email="amcarth1@ualberta.ca",
+        logo_path=f"{IMAGE_DIR}/images/logo.png",
+    )
+
+    r_gen.add_subtitle("Ultrasound DDH Analysis - Error", level=1)
+    r_gen.add_paragraph(
+        "An error occurred while generating the report. "
+        "Please contact amcarth1@ualberta.ca for assistance."
+    )
+
+    r_gen.add_highlights(
+        report_success=False,
+        status_text="Research Only!",
+        highlight1=f"Nan",
+        highlight1_label="Alpha Angle",
+        highlight2=f"Nan",
+        highlight2_label="Coverage",
+    )
 
-        r_gen.add_warning(
-            "Alpha angle is expected to increase with age. At 16 weeks, alpha angle is on average 5 degrees higher than at 1-8 weeks. (Hareendranathan et al., 2022 - Normal variation))"
+    return r_gen, structured
+
+
+def get_retuve_report(
+    dicom,
+    model,
+    config,
+    modes_func=yolo_predict_dcm_us,
+    output_mode: str = "pdf",
+):
+    """
+    Analyse a single DICOM and build its report.
+
+    Args:
+        dicom: The DICOM dataset of the sweep
+        model: The YOLO model
+        config: The retuve config for the job
+        modes_func: The segmentation function
+        output_mode: "pdf", "structured" or "both"
+
+    Returns:
+        The report generator (None unless a PDF is wanted) and the
+        structured report (None unless one is wanted)
+    """
+    r_gen = structured = None
+    try:
+        hip_data, hip_image, values = analyse_dicom(
+            dicom, model, config, modes_func
         )
 
-        r_gen.add_highlights(
-            report_success=None,
-            status_text="Research Only!",
-            highlight1=f"{values[0][1]}",
-            highlight1_label="Alpha Angle",
-            highlight2=f"{values[1][1]}",
-            highlight2_label="Coverage",
+        title = (
+            f"Hip Analysis Report - {dicom.PatientID} - {dicom.InstanceNumber}"
         )
 
-        with tempfile.NamedTemporaryFile(
-            delete=False, suffix=".png"
-        ) as temp_file:
-            hip_image.save(temp_file.name)
+        if output_mode != "pdf":
+            structured = StructuredReport(title).add_sweep(dicom, values)
+
+        if output_mode != "structured":
+            headers = ["Metric Name", "Value"]
 
-            r_gen.add_image(
-                image_path=temp_file.name,
-                caption="Hip Image",
-                max_width="90%",
+            r_gen = new_report_generator(title)
+
+            add_report_intro(r_gen)
+
+            r_gen.add_highlights(
+                report_success=None,
+                status_text="Research Only!",
+                highlight1=f"{values[0][1]}",
+                highlight1_label="Alpha Angle",
+                highlight2=f"{values[1][1]}",
+                highlight2_label="Coverage",
             )
 
-        r_gen.add_page_break()
-        r_gen.add_subtitle("Metric Analysis", level=1)
-        r_gen.add_table(data=values, headers=headers)
-
-    except Exception as e:
-        # Generate a minimal error report
-        r_gen = ReportGenerator(
-            title="Hip Analysis Report - Error",
-            footer_text="For assistance, contact amcarth1@ualberta.ca",
-            footer_website="https://radoss.org",
-            footer_email="amcarth1@ualberta.ca",
-            logo_path=f"{IMAGE_DIR}/images/logo.png",
+            add_hip_image(r_gen, hip_image, "Hip Image")
+
+            r_gen.add_page_break()
+            r_gen.add_subtitle("Metric Analysis", level=1)
+            r_gen.add_table(data=values, headers=headers)
+
+    except Exception:
+        return get_error_report(output_mode)
+
+    return r_gen, structured
+
+
+def get_study_report(
+    dicoms,
+    model,
+    config,
+    max_workers: int = 1,
+    modes_func=yolo_predict_dcm_us,
+    output_mode: str = "pdf",
+):
+    """
+    Analyse every sweep of a study and build one consolidated report.
+
+    Args:
+        dicoms: The DICOM datasets of the sweeps
+        model: The YOLO model
+        config: The retuve config for the job
+        max_workers: Number of sweeps to analyse at once
+        modes_func: The segmentation function
+        output_mode: "pdf", "structured" or "both"
+
+    Returns:
+        The report generator (None unless a PDF is wanted) and the
+        structured report (None unless one is wanted) for the study
+    """
+
+    def analyse(dicom):
+        try:
+            return analyse_dicom(dicom, model, config, modes_func)
+        except Exception as e:
+            print(f"Sweep {dicom.get('InstanceNumber', '')} failed: {e}")
+            return None
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        results = list(pool.map(analyse, dicoms))
+
+    done = [
+        (dicom, result)
+        for dicom, result in zip(dicoms, results)
+        if result is not None
+    ]
+    if not done:
+        return get_error_report(output_mode)
+
+    first = dicoms[0]
+    laterality = study_laterality(first)
+    title = f"Hip Analysis Report - {first.PatientID}" + (
+        f" - {laterality}" if laterality else ""
+    )
+
+    structured = None
+    if output_mode != "pdf":
+        structured = StructuredReport(title)
+        for dicom, (_, _, values) in done:
+            structured.add_sweep(dicom, values)
+
+    if output_mode == "structured":
+        return None, structured
+
+    # Every sweep shares the metric names of the first successful one
+    metric_names = [name for name, _ in done[0][1][2]]
+    headers = ["Sweep"] + metric_names
+    table = []
+    for dicom, (_, _, values) in done:
+        by_name = dict(values)
+        table.append(
+            [str(dicom.get("InstanceNumber", ""))]
+            + [by_name.get(name, "") for name in metric_names]
         )
 
-        r_gen.add_subtitle("Ultrasound DDH Analysis - Error", level=1)
-        r_gen.add_paragraph(
-            "An error occurred while generating the report. "
-            "Please contact amcarth1@ualberta.ca for assistance."
+    r_gen = new_report_generator(title)
+
+    add_report_intro(r_gen)
+
+    r_gen.add_highlights(
+        report_success=None,
+        status_text="Research Only!",
+        highlight1=f"{len(done)} / {len(dicoms)}",
+        highlight1_label="Sweeps Analysed",
+        highlight2=laterality,
+        highlight2_label="Side",
+    )
+
+    r_gen.add_subtitle("Metric Analysis", level=1)
+    r_gen.add_table(data=table, headers=headers)
+
+    for dicom, (_, hip_image, _) in done:
+        if hip_image is not None:
+            add_hip_image(
+                r_gen,
+                hip_image,
+                f"Sweep {dicom.get('InstanceNumber', '')}",
+            )
+
+    return r_gen, structured
+
+
+def study_laterality(dicom) -> str:
+    return str(dicom.get("ImageLaterality", "") or dicom.get("Laterality", ""))
+
+
+def _synthetic_sweep(frames: int, drift: float = 0.5) -> list:
+    """
+    An ilium midline and its landmarks per frame, with the roof of the
+    ilium drifting by drift pixels per frame as the probe moves.
+    """
+    xs = np.arange(100, 500, dtype=float)
+    sweep = []
+    for frame in range(frames):
+        shift = frame * drift
+        ys = (
+            300
+            - 80 * np.exp(-(((xs - 300 - shift) / 60.0) ** 2))
+            + 10 * np.sin(xs / 25.0 + shift / 10)
         )
+        landmarks = LandmarksUS(
+            left=(xs[0], ys[0]),
+            right=(xs[-1], ys[-1]),
+            apex=(300.0 + shift, 220.0),
+            point_D=(300.0, 350.0),
+            point_d=(300.0, 250.0),
+        )
+        ilium = SimpleNamespace(midline_moved=np.column_stack([ys, xs]))
+        sweep.append((ilium, landmarks))
+    return sweep
+
+
+def benchmark(frame_counts, repeats: int):
+    """
+    Time the full alpha landmark search against the seeded one on synthetic
+    sweeps, and report how far the seeded angles are from the full ones.
+    """
+    print(f"[landmarks] Synthetic sweeps, best of {repeats}")
+    print(
+        f"{'frames':>8} {'full':>10} {'seeded':>10} {'speedup':>8} "
+        f"{'max diff':>9}"
+    )
 
-        r_gen.add_highlights(
-            report_success=False,
-            status_text="Research Only!",
-            highlight1=f"Nan",
-            highlight1_label="Alpha Angle",
-            highlight2=f"Nan",
-            highlight2_label="Coverage",
+    for frames in frame_counts:
+        full = seeded = float("inf")
+        for _ in range(repeats):
+            sweep = _synthetic_sweep(frames)
+            start = time.perf_counter()
+            full_angles = [
+                find_alpha_landmarks(ilium, landmarks)[1]
+                for ilium, landmarks in sweep
+            ]
+            full = min(full, time.perf_counter() - start)
+
+            sweep = _synthetic_sweep(frames)
+            seed = None
+            seeded_angles = []
+            start = time.perf_counter()
+            for ilium, landmarks in sweep:
+                landmarks, angle = find_alpha_landmarks(
+                    ilium, landmarks, seed=seed
+                )
+                seed = landmarks.alpha_seed
+                seeded_angles.append(angle)
+            seeded = min(seeded, time.perf_counter() - start)
+
+        max_diff = max(abs(a - b) for a, b in zip(full_angles, seeded_angles))
+        print(
+            f"{frames:>8} {full:>9.3f}s {seeded:>9.3f}s "
+            f"{full / seeded:>7.1f}x {max_diff:>8.2f}°"
         )
 
-    return r_gen
+
+if __name__ == "__main__":
+    arg_parser = ArgumentParser(
+        description="Benchmark the seeded alpha landmark search"
+    )
+    arg_parser.add_argument("--frames", type=int, nargs="+", default=[60])
+    arg_parser.add_argument("--repeats", type=int, default=3)
+    args = arg_parser.parse_args()
+
+    benchmark(args.frames, args.repeats)
@@ -0,0 +1,486 @@
+import copy
+import multiprocessing
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from multiprocessing import shared_memory
+from typing import List, Optional
+
+import numpy as np
+from PIL import Image
+
+from retuve_chris_plugin.preprocess import (
+    SharedFrameBuffers,
+    bgr_shape,
+    preprocess_sweep,
+    sweep_pixels,
+    to_bgr,
+    yolo_predict_frames,
+)
+
+
+class _PredictRequest:
+    def __init__(self, images: list, kwargs: dict):
+        self.images = images
+        self.kwargs = kwargs
+        self.submitted = time.monotonic()
+        self.done = threading.Event()
+        self.results = None
+        self.error = None
+
+
+class _SweepPrefetcher:
+    """
+    Stands in for a BatchingModel while one sweep is predicted. The YOLO
+    plugin predicts a sweep one frame per call, so on the first call for a
+    chunk of frames, the whole chunk is submitted at once.
+    """
+
+    def __init__(self, batching: "BatchingModel", frames: list):
+        self.batching = batching
+        self.frames = frames
+        self.next = 0
+        self.results = deque()
+        self.kwargs = None
+
+    def predict(self, images, **kwargs):
+        images = list(images)
+        # Anything but the sweep's own frames, in order, is passed through
+        if (
+            len(images) != 1
+            or self.next >= len(self.frames)
+            or images[0] is not self.frames[self.next]
+        ):
+            return self.batching.predict(images, **kwargs)
+
+        if not self.results or kwargs != self.kwargs:
+            end = self.next + self.batching.batch_size
+            chunk = self.frames[self.next : end]
+            self.results = deque(self.batching.predict(chunk, **kwargs))
+            self.kwargs = kwargs
+
+        self.next += 1
+        return [self.results.popleft()]
+
+
+class BatchingModel:
+    """
+    Wraps a YOLO model so frames predicted from several threads (e.g. one
+    per DICOM being analysed) are run through the model together in
+    batches.
+
+    A batch is run as soon as it holds batch_size frames, once every
+    sweep being predicted through prefetch() is waiting on it, or once its
+    oldest frame has waited max_latency seconds. Results are routed back to
+    each caller in order. Only one batch runs at a time, so the wrapped
+    model is never called concurrently.
+    """
+
+    def __init__(self, model, batch_size: int = 8, max_latency: float = 0.05):
+        self.model = model
+        self.batch_size = max(1, batch_size)
+        self.max_latency = max_latency
+        # Turned off if the model rejects multi-image batches, e.g. ONNX
+        # weights exported with a static batch dimension
+        self.batching_supported = True
+
+        self.cond = threading.Condition()
+        self.pending: List[_PredictRequest] = []
+        # Sweeps currently predicted through prefetch()
+        self.producers = 0
+        self.closed = False
+        self.batches = 0
+        self.frames = 0
+
+        self.thread = threading.Thread(target=self._dispatch, daemon=True)
+        self.thread.start()
+
+    def predict(self, images, **kwargs):
+        request = _PredictRequest(list(images), kwargs)
+
+        with self.cond:
+            if self.closed:
+                raise RuntimeError("BatchingModel is closed.")
+            self.pending.append(request)
+            self.cond.notify_all()
+
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.results
+
+    @contextmanager
+    def prefetch(self, frames: list):
+        """
+        Predict one sweep's frames a chunk of batch_size at a time, through
+        the model this yields, rather than one frame per call.
+
+        Args:
+            frames: The frames that will be predicted, in order
+        """
+        with self.cond:
+            self.producers += 1
+        try:
+            yield _SweepPrefetcher(self, frames)
+        finally:
+            with self.cond:
+                self.producers -= 1
+                # The batch may now only be waiting on sweeps still running
+                self.cond.notify_all()
+
+    def close(self) -> None:
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        self.thread.join()
+
+        if self.batches:
+            print(
+                f"[inference] {self.frames} frames in {self.batches} "
+                f"batches (avg {self.frames / self.batches:.1f} per batch)"
+            )
+
+    def _pending_frames(self) -> int:
+        return sum(len(request.images) for request in self.pending)
+
+    def _batch_ready(self) -> bool:
+        if self.closed or self._pending_frames() >= self.batch_size:
+            return True
+        # Each sweep waits on one request at a time, so no more frames can
+        # come until this batch is run
+        return 0 < self.producers <= len(self.pending)
+
+    def _next_batch(self) -> List[_PredictRequest]:
+        with self.cond:
+            while not self.pending and not self.closed:
+                self.cond.wait()
+            if not self.pending:
+                return []
+
+            deadline = self.pending[0].submitted + self.max_latency
+            while not self._batch_ready():
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.cond.wait(remaining)
+
+            # Requests with other predict() arguments wait for a later batch
+            kwargs = self.pending[0].kwargs
+            batch, frames = [], 0
+            for request in list(self.pending):
+                if request.kwargs != kwargs:
+                    continue
+                if batch and frames + len(request.images) > self.batch_size:
+                    break
+                batch.append(request)
+                frames += len(request.images)
+                self.pending.remove(request)
+            return batch
+
+    def _run(self, images: list, kwargs: dict) -> list:
+        if self.batching_supported and len(images) > 1:
+            try:
+                return list(self.model.predict(images, **kwargs))
+            except Exception as e:
+                print(f"[inference] Batched predict failed, disabling: {e}")
+                self.batching_supported = False
+
+        results = []
+        for image in images:
+            results.extend(self.model.predict([image], **kwargs))
+        return results
+
+    def _dispatch(self) -> None:
+        while True:
+            batch = self._next_batch()
+            if not batch:
+                return
+
+            images = [image for request in batch for image in request.images]
+            try:
+                results = self._run(images, batch[0].kwargs)
+            except Exception as e:
+                for request in batch:
+                    request.error = e
+                    request.done.set()
+                continue
+
+            self.batches += 1
+            self.frames += len(images)
+
+            start = 0
+            for request in batch:
+                end = start + len(request.images)
+                request.results = results[start:end]
+                start = end
+                request.done.set()
+
+
+# Per-process state of FrameParallelPredictor workers
+_WORKER = {}
+
+
+def _init_frame_worker(job_config, weights: Optional[str], threads: int):
+    import torch
+    from retuve_yolo_plugin.ultrasound import get_yolo_model_us
+
+    torch.set_num_threads(threads)
+    _WORKER["config"] = job_config.to_retuve_config()
+    _WORKER["model"] = get_yolo_model_us(_WORKER["config"], weights)
+
+
+def _pack_mask(mask: np.ndarray) -> np.ndarray:
+    # Masks are black or white and the same in every channel
+    return np.packbits(mask[:, :, 0] > 0)
+
+
+def _unpack_mask(packed: np.ndarray, shape) -> np.ndarray:
+    height, width = shape[:2]
+    grey = np.unpackbits(packed, count=height * width).reshape(height, width)
+    grey *= 255
+    return np.stack([grey] * 3, axis=2)
+
+
+def _predict_frames(shm_name: str, shape, start: int, end: int):
+    from retuve_yolo_plugin.ultrasound import yolo_predict_us
+
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        stack = np.ndarray(shape, dtype=np.uint8, buffer=shm.buf)
+        # Copy out so nothing refers to the shared buffer once closed
+        frames = np.array(stack[start:end])
+        del stack
+    finally:
+        shm.close()
+
+    # Already BGR, which YOLO takes as is
+    seg_results = yolo_predict_us(
+        list(frames), _WORKER["config"], _WORKER["model"]
+    )
+
+    # The parent still has the frames, don't send them back, and send the
+    # masks as bits rather than as frame-sized RGB images
+    packed_masks = []
+    for seg_result in seg_results:
+        seg_result.img = None
+        packed = []
+        for seg_obj in seg_result:
+            if seg_obj.empty or seg_obj.mask is None:
+                packed.append(None)
+                continue
+            packed.append(_pack_mask(seg_obj.mask))
+            seg_obj.mask = None
+        packed_masks.append(packed)
+    return seg_results, packed_masks
+
+
+class FrameParallelPredictor:
+    """
+    Segmentation function (a retuve modes_func) that splits the frames of
+    one long sweep across worker processes, each with its own model.
+
+    The decoded sweep is preprocessed straight into a block of shared
+    memory, reused across sweeps, so workers read the frames without any
+    pixel data being pickled. Masks come back packed to one bit per pixel.
+    Per-frame results are merged back in frame order. Sweeps shorter than
+    min_frames are predicted in-process instead, where the start-up cost
+    is not worth it.
+    """
+
+    def __init__(
+        self,
+        job_config,
+        weights: Optional[str],
+        workers: int,
+        threads_per_worker: int = 1,
+        min_frames: int = 64,
+        decoder=None,
+    ):
+        self.workers = workers
+        self.min_frames = min_frames
+        # decode.FrameDecoder for the pixel data, pixel_array if None
+        self.decoder = decoder
+        self.buffers = SharedFrameBuffers()
+        self.initargs = (job_config, weights, threads_per_worker)
+        # Started on the first long sweep, jobs without one never load
+        # the workers' models
+        self.pool = None
+        self.pool_lock = threading.Lock()
+
+    def close(self) -> None:
+        with self.pool_lock:
+            if self.pool is not None:
+                self.pool.shutdown()
+                self.pool = None
+        self.buffers.close()
+
+    def _get_pool(self) -> ProcessPoolExecutor:
+        with self.pool_lock:
+            if self.pool is None:
+                self.pool = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    # Forking a process with running threads is unsafe
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=_init_frame_worker,
+                    initargs=self.initargs,
+                )
+            return self.pool
+
+    def __call__(self, dcm, keyphrase, model=None, **kwargs):
+        from retuve.keyphrases.config import Config
+
+        config = Config.get_config(keyphrase)
+        pixels = sweep_pixels(dcm, config.dicom_type, self.decoder)
+        if len(pixels) < self.min_frames:
+            return yolo_predict_frames(to_bgr(pixels), config, model, **kwargs)
+
+        shape = bgr_shape(pixels)
+        shm = self.buffers.acquire(int(np.prod(shape)))
+        try:
+            stack = np.ndarray(shape, dtype=np.uint8, buffer=shm.buf)
+            to_bgr(pixels, out=stack)
+            del pixels, stack
+            return self._predict_shared(shm, shape)
+        finally:
+            self.buffers.release(shm)
+
+    def predict_images(self, frames, config, model=None, **kwargs):
+        """
+        Predict already preprocessed BGR frames, e.g. a subset of a sweep.
+        """
+        if len(frames) < self.min_frames:
+            return yolo_predict_frames(frames, config, model, **kwargs)
+
+        shape = (len(frames),) + frames[0].shape
+        shm = self.buffers.acquire(int(np.prod(shape)))
+        try:
+            stack = np.ndarray(shape, dtype=np.uint8, buffer=shm.buf)
+            for i, frame in enumerate(frames):
+                stack[i] = frame
+            del stack
+            return self._predict_shared(shm, shape)
+        finally:
+            self.buffers.release(shm)
+
+    def _predict_shared(self, shm, shape) -> list:
+        stack = np.ndarray(shape, dtype=np.uint8, buffer=shm.buf)
+
+        pool = self._get_pool()
+        n_frames = shape[0]
+        n_chunks = min(n_frames, self.workers * 2)
+        bounds = np.linspace(0, n_frames, n_chunks + 1).astype(int)
+        futures = [
+            pool.submit(_predict_frames, shm.name, shape, int(start), int(end))
+            for start, end in zip(bounds[:-1], bounds[1:])
+        ]
+
+        seg_results = []
+        for future, start in zip(futures, bounds[:-1]):
+            chunk_results, packed_masks = future.result()
+            for i, (seg_result, packed) in enumerate(
+                zip(chunk_results, packed_masks), start
+            ):
+                # The buffer is reused, so each result gets its own copy
+                seg_result.img = np.array(stack[i])
+                for seg_obj, mask in zip(seg_result, packed):
+                    if mask is not None:
+                        seg_obj.mask = _unpack_mask(mask, shape[1:])
+                seg_results.append(seg_result)
+
+        del stack
+        return seg_results
+
+
+# Greyscale weights of a BGR frame, as PIL's convert("L") weighs RGB
+_BGR_TO_L = (0.114, 0.587, 0.299, 0)
+
+
+def _thumbnail(frame: np.ndarray) -> np.ndarray:
+    grey = Image.fromarray(frame).convert("L", matrix=_BGR_TO_L)
+    return np.asarray(grey.resize((64, 64), Image.BILINEAR), dtype=np.float32)
+
+
+class FrameDeduplicator:
+    """
+    Segmentation function (a retuve modes_func) that skips inference on
+    frames nearly identical to the last frame inferred, e.g. while the
+    probe is held still, and reuses that frame's results instead.
+
+    Frames are compared as 64x64 greyscale thumbnails. A frame is a
+    duplicate when its mean absolute difference from the last inferred
+    frame, in grey levels, is under threshold.
+    """
+
+    def __init__(self, threshold: float, predict_images=None, decoder=None):
+        self.threshold = threshold
+        # Runs inference on a list of frames, e.g.
+        # FrameParallelPredictor.predict_images. Defaults to in-process.
+        self.predict_images = predict_images
+        # decode.FrameDecoder for the pixel data, pixel_array if None
+        self.decoder = decoder
+        self.lock = threading.Lock()
+        self.frames = 0
+        self.reused = 0
+
+    def close(self) -> None:
+        if self.frames:
+            print(
+                f"[dedup] Reused results for {self.reused} of {self.frames} "
+                "frames"
+            )
+
+    def __call__(self, dcm, keyphrase, model=None, **kwargs):
+        from retuve.classes.seg import SegFrameObjects
+        from retuve.keyphrases.config import Config
+
+        config = Config.get_config(keyphrase)
+        frames = preprocess_sweep(dcm, config.dicom_type, self.decoder)
+
+        # For each frame, the index of the inferred frame it takes results
+        # from
+        sources, inferred = [], []
+        last = None
+        for frame in frames:
+            thumbnail = _thumbnail(frame)
+            if (
+                last is None
+                or np.mean(np.abs(thumbnail - last)) >= self.threshold
+            ):
+                last = thumbnail
+                inferred.append(frame)
+            sources.append(len(inferred) - 1)
+
+        if self.predict_images is not None:
+            inferred_results = self.predict_images(
+                inferred, config, model, **kwargs
+            )
+        else:
+            inferred_results = yolo_predict_frames(
+                inferred, config, model, **kwargs
+            )
+
+        seg_results = []
+        for i, source in enumerate(sources):
+            if i == 0 or sources[i - 1] != source:
+                seg_results.append(inferred_results[source])
+                continue
+            # Each frame keeps its own image and its own copy of the
+            # segmentation, as retuve edits both in place
+            seg_results.append(
+                SegFrameObjects(
+                    img=frames[i],
+                    seg_objects=copy.deepcopy(
+                        inferred_results[source].seg_objects
+                    ),
+                )
+            )
+
+        reused = len(frames) - len(inferred)
+        with self.lock:
+            self.frames += len(frames)
+            self.reused += reused
+        print(f"[dedup] Reused results for {reused} of {len(frames)} frames")
+
+        return seg_results
@@ -0,0 +1,539 @@
+import hashlib
+import json
+import os
+import shutil
+from argparse import Namespace
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+import pydicom
+from chris_plugin import PathMapper
+
+from retuve_chris_plugin.manifest import (
+    ANALYSED,
+    JSON_WRITTEN,
+    ORIGINAL_UPLOADED,
+    PDF_WRITTEN,
+    REPORT_UPLOADED,
+    REPORT_WRITTEN,
+    SR_UPLOADED,
+    SR_WRITTEN,
+    Manifest,
+)
+
+ENABLE_UPLOAD = True
+
+# Models already loaded in this process, keyed by model URL
+_MODELS = {}
+
+
+def load_model(config, options: Namespace):
+    """
+    Load the YOLO model for a job, reusing one already loaded in this
+    process for the same model URL. Weights from a URL come from the
+    local weight cache, see weights.resolve_weights.
+
+    Args:
+        config: The retuve config for the job
+        options: The parsed plugin options
+
+    Returns:
+        The loaded YOLO model
+    """
+    from retuve_yolo_plugin.ultrasound import get_yolo_model_us
+
+    from retuve_chris_plugin.weights import resolve_weights
+
+    if options.github_secret is not None:
+        os.environ["GITHUB_PAT"] = options.github_secret
+
+    if options.model_url not in _MODELS:
+        _MODELS[options.model_url] = get_yolo_model_us(
+            config, resolve_weights(options.model_url, options.model_sha256)
+        )
+
+    return _MODELS[options.model_url]
+
+
+def find_already_stored(input_files) -> set:
+    """
+    Find the input files whose instances Orthanc already stores, using one
+    C-FIND per study. An instance only counts as stored if its Content
+    Date and Time match too, so a re-exported file that kept its
+    SOPInstanceUID is uploaded again.
+
+    Args:
+        input_files: Paths of the DICOM files to check
+
+    Returns:
+        The subset of input_files that do not need uploading
+    """
+    from retuve_chris_plugin.orthanc import (
+        content_marker,
+        find_stored_instances,
+    )
+
+    by_study = {}
+    for input_file in input_files:
+        header = pydicom.dcmread(input_file, stop_before_pixels=True)
+        study_uid = str(header.get("StudyInstanceUID", ""))
+        sop_uid = str(header.get("SOPInstanceUID", ""))
+        if study_uid and sop_uid:
+            by_study.setdefault(study_uid, []).append(
+                (input_file, sop_uid, content_marker(header))
+            )
+
+    already_stored = set()
+    for study_uid, files in by_study.items():
+        stored = find_stored_instances(study_uid)
+        if stored is None:
+            # Query failed, upload everything for this study
+            continue
+        already_stored.update(
+            input_file
+            for input_file, sop_uid, marker in files
+            if stored.get(sop_uid) == marker
+        )
+
+    return already_stored
+
+
+def analyse_ahead(fn, items, workers: int):
+    """
+    Run fn over items in a thread pool, staying at most `workers` items
+    ahead of the consumer, and yield the results in order.
+    """
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        futures = deque()
+        for item in items:
+            futures.append(pool.submit(fn, item))
+            if len(futures) > workers:
+                yield futures.popleft().result()
+        while futures:
+            yield futures.popleft().result()
+
+
+def group_by_study(store_mapper, outputdir) -> list:
+    """
+    Group input files by StudyInstanceUID and laterality from a header scan.
+
+    Args:
+        store_mapper: (input_file, output_file) pairs
+        outputdir: Directory to write the reports to
+
+    Returns:
+        List of (manifest key, input files, pdf path, report path), one per
+        study and side
+    """
+    from retuve_chris_plugin.funcs import study_laterality
+
+    groups = {}
+    for input_file, output_file in store_mapper:
+        header = pydicom.dcmread(input_file, stop_before_pixels=True)
+        key = (
+            str(header.get("StudyInstanceUID", "unknown")),
+            study_laterality(header),
+        )
+        groups.setdefault(key, []).append((header, input_file))
+
+    units = []
+    for (study_uid, laterality), members in groups.items():
+        members.sort(key=lambda m: int(m[0].get("InstanceNumber", 0) or 0))
+        name = f"study-{study_uid}" + (f"-{laterality}" if laterality else "")
+        units.append(
+            (
+                f"study:{name}",
+                [input_file for _, input_file in members],
+                os.path.join(outputdir, f"{name}.pdf"),
+                os.path.join(outputdir, f"{name}-report.dcm"),
+            )
+        )
+    return units
+
+
+def shard_files(store_mapper, inputdir, shard_index: int, shard_count: int):
+    """
+    The (input_file, output_file) pairs belonging to one shard of a job.
+
+    Files are assigned by a hash of their StudyInstanceUID, so every sweep
+    of a study lands in the same shard, and every instance given the same
+    input computes the same split.
+
+    Args:
+        store_mapper: (input_file, output_file) pairs of the whole job
+        inputdir: Directory containing the input DICOM files
+        shard_index: This instance's shard, from 0
+        shard_count: Total number of shards
+
+    Returns:
+        The pairs in this shard, in their original order
+    """
+    if not 0 <= shard_index < shard_count:
+        raise ValueError(
+            f"Shard index {shard_index} out of range for {shard_count} shards"
+        )
+    if shard_count == 1:
+        return list(store_mapper)
+
+    shard = []
+    for input_file, output_file in store_mapper:
+        header = pydicom.dcmread(input_file, stop_before_pixels=True)
+        # Files without a study are spread by their path instead
+        key = str(header.get("StudyInstanceUID", "")) or str(
+            input_file.relative_to(inputdir)
+        )
+        digest = hashlib.sha256(key.encode()).hexdigest()
+        if int(digest[:16], 16) % shard_count == shard_index:
+            shard.append((input_file, output_file))
+    return shard
+
+
+def write_shard_summary(outputdir, summary: dict) -> str:
+    """
+    Write a shard's summary to the output directory, atomically so a
+    reader checking completion never sees a partial file.
+    """
+    summary_path = os.path.join(
+        outputdir,
+        f"shard-{summary['shard_index']}-of-{summary['shard_count']}.json",
+    )
+    tmp_path = f"{summary_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(summary, f, indent=2)
+    os.replace(tmp_path, summary_path)
+    return summary_path
+
+
+def unit_reports(report_file, output_mode: str) -> list:
+    """
+    The DICOM reports a unit produces for an output mode.
+
+    Args:
+        report_file: Path of the unit's PDF report DICOM
+        output_mode: "pdf", "structured" or "both"
+
+    Returns:
+        List of (path, written stage, uploaded stage), one per report
+    """
+    reports = []
+    if output_mode != "structured":
+        reports.append((str(report_file), REPORT_WRITTEN, REPORT_UPLOADED))
+    if output_mode != "pdf":
+        reports.append(
+            (
+                str(report_file).replace("-report.dcm", "-sr.dcm"),
+                SR_WRITTEN,
+                SR_UPLOADED,
+            )
+        )
+    return reports
+
+
+def run_job(options: Namespace, inputdir, outputdir, model=None) -> bool:
+    """
+    Upload, analyse and report on every DICOM in the input directory.
+
+    Args:
+        options: The parsed plugin options
+        inputdir: Directory containing the input DICOM files
+        outputdir: Directory to write the reports to
+        model: An already loaded YOLO model (optional)
+
+    Returns:
+        bool: False if the job stopped on an error, True otherwise
+    """
+    from retuve_chris_plugin.config import build_job_config
+    from retuve_chris_plugin.decode import FrameDecoder
+    from retuve_chris_plugin.funcs import get_retuve_report, get_study_report
+    from retuve_chris_plugin.inference import (
+        BatchingModel,
+        FrameDeduplicator,
+        FrameParallelPredictor,
+    )
+    from retuve_chris_plugin.preprocess import yolo_predict_dcm_vectorized
+    from retuve_chris_plugin.tuning import available_cpus
+    from retuve_chris_plugin.weights import resolve_weights
+    from retuve_chris_plugin.orthanc import (
+        compress_for_upload,
+        replay_spool,
+        upload_dicom_to_orthanc,
+    )
+
+    job_config = build_job_config(options, inputdir, outputdir)
+    print(f"[config] Job config: {job_config.hash[:12]}")
+    config = job_config.to_retuve_config()
+
+    if model is None:
+        model = load_model(config, options)
+
+    if options.auto_tune:
+        from retuve_chris_plugin.tuning import apply_tuning
+
+        options = apply_tuning(model, options)
+
+    manifest = Manifest(outputdir)
+
+    if ENABLE_UPLOAD:
+        # Uploads deferred by an earlier job while Orthanc was down
+        replay_spool()
+
+    mapper = PathMapper.file_mapper(inputdir, outputdir, glob="**/*.dcm")
+    store_mapper = shard_files(
+        mapper, inputdir, options.shard_index, options.shard_count
+    )
+    if options.shard_count > 1:
+        print(
+            f"[shard] Shard {options.shard_index + 1} of "
+            f"{options.shard_count}: {len(store_mapper)} files"
+        )
+
+    summary = {
+        "files": len(store_mapper),
+        "skipped_instances": 0,
+        "skipped_bytes": 0,
+    }
+
+    to_upload = [
+        input_file
+        for input_file, _ in store_mapper
+        if not manifest.has(
+            input_file.relative_to(inputdir), ORIGINAL_UPLOADED
+        )
+    ]
+    already_stored = find_already_stored(to_upload) if ENABLE_UPLOAD else set()
+    compressed = (
+        compress_for_upload(
+            [str(f) for f in to_upload if f not in already_stored]
+        )
+        if ENABLE_UPLOAD
+        else {}
+    )
+
+    for input_file, output_file in store_mapper:
+        file_key = input_file.relative_to(inputdir)
+
+        if not ENABLE_UPLOAD or manifest.has(file_key, ORIGINAL_UPLOADED):
+            continue
+
+        if input_file in already_stored:
+            manifest.mark(file_key, ORIGINAL_UPLOADED)
+            summary["skipped_instances"] += 1
+            summary["skipped_bytes"] += os.path.getsize(input_file)
+            print(f"Already in Orthanc, skipping upload: {input_file}")
+            continue
+
+        # Upload the original output file (processed DICOM)
+        compressed_file = compressed.get(str(input_file))
+        if compressed_file is not None:
+            upload_success = upload_dicom_to_orthanc(
+                compressed_file, uncompressed_path=input_file
+            )
+        else:
+            upload_success = upload_dicom_to_orthanc(input_file)
+        if upload_success:
+            manifest.mark(file_key, ORIGINAL_UPLOADED)
+            print(f"Successfully uploaded output file: {output_file}")
+        else:
+            print(f"Failed to upload output file: {output_file}")
+
+    if compressed:
+        shutil.rmtree(
+            os.path.dirname(next(iter(compressed.values()))),
+            ignore_errors=True,
+        )
+
+    if options.study_mode:
+        units = group_by_study(store_mapper, outputdir)
+        print(f"[study] {len(store_mapper)} sweeps in {len(units)} studies")
+    else:
+        units = [
+            (
+                str(input_file.relative_to(inputdir)),
+                [input_file],
+                str(output_file).replace(".dcm", ".pdf"),
+                str(output_file).replace(".dcm", "-report.dcm"),
+            )
+            for input_file, output_file in store_mapper
+        ]
+
+    batched_model = BatchingModel(
+        model,
+        batch_size=options.inference_batch_size,
+        max_latency=options.inference_max_latency,
+    )
+
+    decoder = FrameDecoder(
+        options.decode_workers or available_cpus(),
+        lazy=options.lazy_decode,
+    )
+
+    modes_func = partial(yolo_predict_dcm_vectorized, decoder=decoder)
+    frame_parallel = dedup = None
+    if options.frame_workers > 1:
+        # Leave a CPU to each sweep the job analyses at once
+        concurrent_sweeps = options.inference_files * (
+            options.study_workers if options.study_mode else 1
+        )
+        modes_func = frame_parallel = FrameParallelPredictor(
+            job_config,
+            # Workers load the cached weights rather than downloading
+            resolve_weights(options.model_url, options.model_sha256),
+            workers=options.frame_workers,
+            threads_per_worker=max(
+                1,
+                (available_cpus() - concurrent_sweeps)
+                // options.frame_workers,
+            ),
+            decoder=decoder,
+        )
+    if options.dedup_threshold > 0:
+        modes_func = dedup = FrameDeduplicator(
+            options.dedup_threshold,
+            predict_images=(
+                frame_parallel.predict_images if frame_parallel else None
+            ),
+            decoder=decoder,
+        )
+
+    def analyse_unit(unit):
+        unit_key, input_files, _, report_file = unit
+        reports = unit_reports(report_file, options.output_mode)
+
+        if all(manifest.has(unit_key, uploaded) for _, _, uploaded in reports):
+            return None, None, None
+
+        # The report DICOM only needs the header of the first input
+        dicom = pydicom.dcmread(input_files[0], stop_before_pixels=True)
+
+        if all(
+            manifest.has(unit_key, written) and os.path.exists(path)
+            for path, written, _ in reports
+        ):
+            # Only the upload is left
+            return dicom, None, None
+
+        dicoms = [pydicom.dcmread(f) for f in input_files]
+
+        if options.study_mode:
+            r_gen, structured = get_study_report(
+                dicoms,
+                batched_model,
+                config,
+                max_workers=options.study_workers,
+                modes_func=modes_func,
+                output_mode=options.output_mode,
+            )
+        else:
+            r_gen, structured = get_retuve_report(
+                dicoms[0],
+                batched_model,
+                config,
+                modes_func=modes_func,
+                output_mode=options.output_mode,
+            )
+        return dicom, r_gen, structured
+
+    ok = True
+    try:
+        for unit, (dicom, r_gen, structured) in zip(
+            units,
+            analyse_ahead(analyse_unit, units, options.inference_files),
+        ):
+            unit_key, _, pdf_file, report_file = unit
+
+            if dicom is None:
+                print(f"Skipping completed file: {unit_key}")
+                continue
+
+            if r_gen is not None or structured is not None:
+                manifest.mark(unit_key, ANALYSED)
+
+            if r_gen is not None:
+                if r_gen.save_pdf(pdf_file):
+                    manifest.mark(unit_key, PDF_WRITTEN)
+
+                if r_gen.save_to_dicom_study(
+                    output_path=report_file,
+                    dicom_tags=dicom,
+                    series_number=999,
+                    series_description="Hip Analysis Report",
+                    hide_videos=True,
+                ):
+                    manifest.mark(unit_key, REPORT_WRITTEN)
+
+            reports = unit_reports(report_file, options.output_mode)
+
+            if structured is not None:
+                json_file = os.path.splitext(str(pdf_file))[0] + ".json"
+                if structured.save_json(json_file, dicom_tags=dicom):
+                    manifest.mark(unit_key, JSON_WRITTEN)
+
+                sr_file = reports[-1][0]
+                if structured.save_to_dicom_sr(
+                    sr_file,
+                    dicom_tags=dicom,
+                    series_number=998,
+                    series_description="Hip Analysis Measurements",
+                ):
+                    manifest.mark(unit_key, SR_WRITTEN)
+
+            # Upload files to Orthanc if enabled
+            if ENABLE_UPLOAD:
+                for path, _, uploaded in reports:
+                    if manifest.has(unit_key, uploaded):
+                        continue
+
+                    # Upload the report file
+                    report_upload_success = upload_dicom_to_orthanc(
+                        path, original_dicom=dicom
+                    )
+                    if report_upload_success:
+                        manifest.mark(unit_key, uploaded)
+                        print(f"Successfully uploaded report file: {path}")
+                    else:
+                        print(f"Failed to upload report file: {path}")
+            else:
+                print("Upload disabled - files saved locally only")
+    except Exception as e:
+        print(e)
+        ok = False
+    finally:
+        batched_model.close()
+        decoder.close()
+        if frame_parallel is not None:
+            frame_parallel.close()
+        if dedup is not None:
+            dedup.close()
+
+    print(
+        f"[summary] {summary['files']} files, "
+        f"{summary['skipped_instances']} originals already in Orthanc "
+        f"({summary['skipped_bytes']:,} bytes not re-sent)"
+    )
+
+    if options.shard_count > 1:
+        # A unit is complete once its last stage is recorded
+        incomplete = [
+            unit_key
+            for unit_key, _, _, report_file in units
+            if not all(
+                manifest.has(unit_key, uploaded if ENABLE_UPLOAD else written)
+                for _, written, uploaded in unit_reports(
+                    report_file, options.output_mode
+                )
+            )
+        ]
+        summary.update(
+            {
+                "shard_index": options.shard_index,
+                "shard_count": options.shard_count,
+                "units": len(units),
+                "incomplete": incomplete,
+                "complete": not incomplete,
+            }
+        )
+        summary_path = write_shard_summary(outputdir, summary)
+        print(f"[shard] Summary written to {summary_path}")
+
+    return ok
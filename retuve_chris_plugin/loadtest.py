@@ -0,0 +1,464 @@
+"""
+Load test for several plugin instances sharing one CUBE lock directory and
+one Orthanc, using local stand-ins for both.
+
+    python -m retuve_chris_plugin.loadtest --instances 10
+
+Starts a stub of the CUBE userfiles API and a DICOM storage SCP, then runs
+main() for each instance in its own process, with a stub model in place of
+YOLO. Reports the lock wait distribution, end-to-end throughput, C-STORE
+latency and errors.
+"""
+
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from argparse import SUPPRESS, ArgumentParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Dict, List
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+
+LOCK_DIR_PATH = "home/chris/locks"
+SCP_AE_TITLE = "LOADTEST"
+
+
+class StubCube:
+    """
+    In-memory stand-in for the parts of the CUBE userfiles API used by
+    schedule.py.
+    """
+
+    def __init__(self):
+        self.files: Dict[int, str] = {}
+        self.next_id = 1
+        self.lock = threading.Lock()
+
+        cube = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def _reply(self, code: int, body=None):
+                data = json.dumps(body).encode() if body is not None else b""
+                self.send_response(code)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                body = self.rfile.read(length)
+                path = urlparse(self.path).path
+
+                if path.endswith("/auth-token/"):
+                    return self._reply(200, {"token": "loadtest"})
+
+                if path.endswith("/userfiles/"):
+                    match = re.search(
+                        rb'name="upload_path"\r\n\r\n(.*?)\r\n', body
+                    )
+                    if not match:
+                        return self._reply(400)
+                    return self._reply(201, cube.add(match.group(1).decode()))
+
+                self._reply(404)
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                if not url.path.endswith("/userfiles/search/"):
+                    return self._reply(404)
+
+                needle = parse_qs(url.query).get("fname_icontains", [""])[0]
+                base = f"http://{self.headers['Host']}/api/v1/userfiles"
+                with cube.lock:
+                    items = [
+                        {
+                            "href": f"{base}/{file_id}/",
+                            "data": [
+                                {"name": "id", "value": file_id},
+                                {"name": "fname", "value": fname},
+                            ],
+                        }
+                        for file_id, fname in cube.files.items()
+                        if needle in fname
+                    ]
+                self._reply(200, {"collection": {"items": items}})
+
+            def do_DELETE(self):
+                file_id = urlparse(self.path).path.rstrip("/").split("/")[-1]
+                with cube.lock:
+                    found = cube.files.pop(int(file_id), None)
+                self._reply(204 if found else 404)
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.thread = threading.Thread(
+            target=self.server.serve_forever, daemon=True
+        )
+
+    def add(self, upload_path: str) -> dict:
+        with self.lock:
+            file_id = self.next_id
+            self.next_id += 1
+            self.files[file_id] = upload_path
+        return {"id": file_id, "fname": upload_path}
+
+    @property
+    def api_url(self) -> str:
+        return f"http://127.0.0.1:{self.server.server_address[1]}/api/v1"
+
+    def start(self) -> None:
+        self.thread.start()
+
+    def stop(self) -> None:
+        self.server.shutdown()
+
+
+def start_storage_scp():
+    """
+    Start a storage SCP that accepts every storage SOP class and answers
+    the IMAGE-level C-FIND used to skip already stored instances.
+
+    Returns:
+        The running server and the list its per-instance stores go into
+    """
+    from pynetdicom import AE, ALL_TRANSFER_SYNTAXES, evt
+    from pynetdicom.presentation import AllStoragePresentationContexts
+    from pynetdicom.sop_class import StudyRootQueryRetrieveInformationModelFind
+
+    stored = []
+    stored_lock = threading.Lock()
+
+    def handle_store(event):
+        dataset = event.dataset
+        with stored_lock:
+            stored.append(
+                (
+                    str(dataset.StudyInstanceUID),
+                    str(dataset.SOPInstanceUID),
+                    str(dataset.get("ContentDate", "") or ""),
+                    str(dataset.get("ContentTime", "") or ""),
+                )
+            )
+        return 0x0000
+
+    def handle_find(event):
+        study_uid = str(event.identifier.get("StudyInstanceUID", ""))
+        with stored_lock:
+            matches = [entry[1:] for entry in stored if entry[0] == study_uid]
+        for sop_uid, content_date, content_time in matches:
+            identifier = event.identifier.copy()
+            identifier.SOPInstanceUID = sop_uid
+            identifier.ContentDate = content_date
+            identifier.ContentTime = content_time
+            yield 0xFF00, identifier
+        yield 0x0000, None
+
+    ae = AE(ae_title=SCP_AE_TITLE)
+    ae.maximum_associations = 64
+    for context in AllStoragePresentationContexts:
+        ae.add_supported_context(
+            context.abstract_syntax, ALL_TRANSFER_SYNTAXES
+        )
+    ae.add_supported_context(StudyRootQueryRetrieveInformationModelFind)
+
+    server = ae.start_server(
+        ("127.0.0.1", 0),
+        block=False,
+        evt_handlers=[
+            (evt.EVT_C_STORE, handle_store),
+            (evt.EVT_C_FIND, handle_find),
+        ],
+    )
+    return server, stored
+
+
+def write_synthetic_sweeps(inputdir: Path, sweeps: int, frames: int) -> None:
+    """
+    Write multi-frame ultrasound DICOMs of random noise, one study per
+    call.
+    """
+    from pydicom.dataset import Dataset, FileMetaDataset
+    from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+
+    rng = np.random.default_rng()
+    study_uid = generate_uid()
+    inputdir.mkdir(parents=True, exist_ok=True)
+
+    for sweep in range(sweeps):
+        meta = FileMetaDataset()
+        meta.MediaStorageSOPClassUID = "1.2.840.10008.5.1.4.1.1.3.1"
+        meta.MediaStorageSOPInstanceUID = generate_uid()
+        meta.TransferSyntaxUID = ExplicitVRLittleEndian
+
+        ds = Dataset()
+        ds.file_meta = meta
+        ds.SOPClassUID = meta.MediaStorageSOPClassUID
+        ds.SOPInstanceUID = meta.MediaStorageSOPInstanceUID
+        ds.StudyInstanceUID = study_uid
+        ds.SeriesInstanceUID = generate_uid()
+        ds.PatientID = "LOADTEST"
+        ds.PatientName = "Load^Test"
+        ds.Modality = "US"
+        ds.InstanceNumber = sweep + 1
+        ds.NumberOfFrames = frames
+        ds.Rows, ds.Columns = 480, 640
+        ds.SamplesPerPixel = 3
+        ds.PhotometricInterpretation = "RGB"
+        ds.PlanarConfiguration = 0
+        ds.BitsAllocated = 8
+        ds.BitsStored = 8
+        ds.HighBit = 7
+        ds.PixelRepresentation = 0
+        ds.PixelData = rng.integers(
+            0, 255, (frames, 480, 640, 3), dtype=np.uint8
+        ).tobytes()
+
+        ds.save_as(
+            inputdir / f"sweep-{sweep + 1}.dcm", enforce_file_format=True
+        )
+
+
+class StubModel:
+    """
+    Stands in for the YOLO model, taking a fixed time per frame and
+    detecting nothing.
+    """
+
+    ckpt_path = None
+
+    def __init__(self, seconds_per_frame: float):
+        self.seconds_per_frame = seconds_per_frame
+
+    def predict(self, images, **kwargs):
+        time.sleep(self.seconds_per_frame * len(images))
+        return [
+            SimpleNamespace(
+                # YOLO takes arrays as BGR and PIL images as RGB
+                orig_img=(
+                    image
+                    if isinstance(image, np.ndarray)
+                    else np.asarray(image)[..., ::-1]
+                ),
+                masks=None,
+                boxes=None,
+            )
+            for image in images
+        ]
+
+
+def run_instance(
+    metrics_path: str,
+    api_url: str,
+    inputdir: str,
+    outputdir: str,
+    seconds_per_frame: float,
+) -> None:
+    """
+    Run one plugin instance with the stub model, recording lock wait and
+    C-STORE timings to metrics_path.
+    """
+    import retuve_chris_plugin as plugin
+    from retuve_chris_plugin import job, orthanc
+    from retuve_chris_plugin.config import parser
+
+    metrics = {"lock_wait": None, "c_store": [], "errors": []}
+
+    job.load_model = lambda config, options: StubModel(seconds_per_frame)
+
+    place_lock = plugin.place_lock
+
+    def timed_place_lock(*args, **kwargs):
+        start = time.perf_counter()
+        place_lock(*args, **kwargs)
+        metrics["lock_wait"] = time.perf_counter() - start
+
+    plugin.place_lock = timed_place_lock
+
+    send_dataset = orthanc._send_dataset
+
+    def timed_send_dataset(dataset, dicom_file_path):
+        start = time.perf_counter()
+        result = send_dataset(dataset, dicom_file_path)
+        metrics["c_store"].append(time.perf_counter() - start)
+        if not result:
+            metrics["errors"].append(
+                f"C-STORE {os.path.basename(dicom_file_path)}: {result}"
+            )
+        return result
+
+    orthanc._send_dataset = timed_send_dataset
+
+    options = parser.parse_args(
+        ["--chris-api-url", api_url, "--token", "loadtest"]
+    )
+
+    start = time.perf_counter()
+    try:
+        plugin.main(options, inputdir, outputdir)
+    except Exception as e:
+        metrics["errors"].append(repr(e))
+    metrics["seconds"] = time.perf_counter() - start
+
+    inputs = len(list(Path(inputdir).glob("**/*.dcm")))
+    reports = len(list(Path(outputdir).glob("**/*-report.dcm")))
+    if reports < inputs:
+        metrics["errors"].append(f"{inputs - reports} reports missing")
+    metrics["sweeps"] = inputs
+
+    with open(metrics_path, "w") as f:
+        json.dump(metrics, f)
+
+
+def _percentiles(values: List[float]) -> str:
+    if not values:
+        return "n/a"
+    p50, p90, p99 = np.percentile(values, [50, 90, 99])
+    return (
+        f"min {min(values):.2f}s, p50 {p50:.2f}s, p90 {p90:.2f}s, "
+        f"p99 {p99:.2f}s, max {max(values):.2f}s"
+    )
+
+
+def main(
+    instances: int,
+    sweeps: int,
+    frames: int,
+    seconds_per_frame: float,
+    workdir: str,
+) -> None:
+    cube = StubCube()
+    cube.start()
+    scp, stored = start_storage_scp()
+    scp_port = scp.server_address[1]
+
+    print(f"[loadtest] CUBE stub at {cube.api_url}")
+    print(f"[loadtest] Storage SCP {SCP_AE_TITLE} on port {scp_port}")
+
+    env = dict(os.environ)
+    env.pop("DEV", None)
+    env.pop("RETUVE_DAEMON_SPOOL", None)
+    env.update(
+        {
+            "ORTHANC_HOST": "127.0.0.1",
+            "ORTHANC_PORT": str(scp_port),
+            "ORTHANC_AE_TITLE": SCP_AE_TITLE,
+            "LOCK_DIR_PATH": LOCK_DIR_PATH,
+        }
+    )
+
+    start = time.perf_counter()
+    processes = []
+    for i in range(instances):
+        root = Path(workdir) / f"instance-{i}"
+        write_synthetic_sweeps(root / "input", sweeps, frames)
+        (root / "output").mkdir(parents=True, exist_ok=True)
+
+        instance_env = dict(env, ORTHANC_SPOOL_DIR=str(root / "spool"))
+        log = open(root / "log.txt", "w")
+        processes.append(
+            (
+                root,
+                log,
+                subprocess.Popen(
+                    [
+                        sys.executable,
+                        "-m",
+                        "retuve_chris_plugin.loadtest",
+                        "--instance",
+                        str(root / "metrics.json"),
+                        cube.api_url,
+                        str(root / "input"),
+                        str(root / "output"),
+                        "--seconds-per-frame",
+                        str(seconds_per_frame),
+                    ],
+                    env=instance_env,
+                    stdout=log,
+                    stderr=subprocess.STDOUT,
+                ),
+            )
+        )
+        # Distinct lock timestamps, which have one second resolution
+        time.sleep(1.0)
+
+    print(f"[loadtest] Started {instances} instances")
+
+    lock_waits, c_store, errors, total_sweeps = [], [], [], 0
+    for root, log, process in processes:
+        process.wait()
+        log.close()
+        try:
+            with open(root / "metrics.json") as f:
+                metrics = json.load(f)
+        except (OSError, ValueError):
+            errors.append(
+                f"{root.name}: exited with {process.returncode}, "
+                f"see {root / 'log.txt'}"
+            )
+            continue
+
+        if metrics["lock_wait"] is not None:
+            lock_waits.append(metrics["lock_wait"])
+        c_store.extend(metrics["c_store"])
+        errors.extend(f"{root.name}: {e}" for e in metrics["errors"])
+        total_sweeps += metrics["sweeps"]
+
+    elapsed = time.perf_counter() - start
+    scp.shutdown()
+    cube.stop()
+
+    print(f"[loadtest] {instances} instances finished in {elapsed:.1f}s")
+    print(f"[loadtest] Lock wait: {_percentiles(lock_waits)}")
+    print(
+        f"[loadtest] Throughput: {total_sweeps / elapsed * 60:.1f} "
+        f"sweeps/min, {total_sweeps * frames / elapsed:.1f} frames/s"
+    )
+    print(
+        f"[loadtest] C-STORE latency ({len(c_store)} sends, "
+        f"{len(stored)} stored): {_percentiles(c_store)}"
+    )
+    print(f"[loadtest] Errors: {len(errors)}")
+    for error in errors:
+        print(f"  {error}")
+
+
+if __name__ == "__main__":
+    arg_parser = ArgumentParser(description=__doc__.strip().splitlines()[0])
+    arg_parser.add_argument("--instances", type=int, default=10)
+    arg_parser.add_argument("--sweeps", type=int, default=2)
+    arg_parser.add_argument("--frames", type=int, default=50)
+    arg_parser.add_argument("--seconds-per-frame", type=float, default=0.02)
+    arg_parser.add_argument(
+        "--workdir", help="Keep inputs, outputs and logs here"
+    )
+    # Used by main() to start each instance in its own process
+    arg_parser.add_argument("--instance", nargs=4, help=SUPPRESS)
+    args = arg_parser.parse_args()
+
+    if args.instance:
+        run_instance(*args.instance, args.seconds_per_frame)
+    else:
+        workdir = args.workdir or tempfile.mkdtemp(prefix="retuve-loadtest-")
+        try:
+            main(
+                args.instances,
+                args.sweeps,
+                args.frames,
+                args.seconds_per_frame,
+                workdir,
+            )
+        finally:
+            if not args.workdir:
+                shutil.rmtree(workdir, ignore_errors=True)
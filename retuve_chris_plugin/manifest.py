@@ -0,0 +1,74 @@
+import json
+import os
+from pathlib import Path
+from typing import Dict, Set
+
+MANIFEST_FNAME = ".retuve-manifest.jsonl"
+
+# Stages a file goes through, in order
+ORIGINAL_UPLOADED = "original_uploaded"
+ANALYSED = "analysed"
+PDF_WRITTEN = "pdf_written"
+REPORT_WRITTEN = "report_written"
+REPORT_UPLOADED = "report_uploaded"
+# Structured output, see --output-mode
+JSON_WRITTEN = "json_written"
+SR_WRITTEN = "sr_written"
+SR_UPLOADED = "sr_uploaded"
+
+
+class Manifest:
+    """
+    Append-only record of the stages each input file has completed, kept in
+    the output directory so a rerun can skip finished work.
+
+    Each line is a single JSON object, written with one write() and fsynced,
+    so a crash can at worst lose or truncate the last line.
+    """
+
+    def __init__(self, outputdir):
+        self.path = Path(outputdir) / MANIFEST_FNAME
+        self.done: Dict[str, Set[str]] = {}
+
+        if self.path.exists():
+            with open(self.path, "rb+") as f:
+                # Terminate a line truncated by a crash so the next entry
+                # starts on its own line
+                f.seek(0, os.SEEK_END)
+                if f.tell() > 0:
+                    f.seek(-1, os.SEEK_END)
+                    if f.read(1) != b"\n":
+                        f.write(b"\n")
+
+            with open(self.path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        # Partially written line from an interrupted run
+                        continue
+                    self.done.setdefault(entry["file"], set()).add(
+                        entry["stage"]
+                    )
+
+        if self.done:
+            print(
+                f"[manifest] Resuming: {len(self.done)} files have "
+                "completed stages"
+            )
+
+    def has(self, file_key: str, stage: str) -> bool:
+        return stage in self.done.get(str(file_key), set())
+
+    def mark(self, file_key: str, stage: str) -> None:
+        file_key = str(file_key)
+        if self.has(file_key, stage):
+            return
+
+        line = json.dumps({"file": file_key, "stage": stage}) + "\n"
+        with open(self.path, "a") as f:
+            f.write(line)
+            f.flush()
+            os.fsync(f.fileno())
+
+        self.done.setdefault(file_key, set()).add(stage)
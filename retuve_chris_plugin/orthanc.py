@@ -1,24 +1,340 @@
+import os
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
 import pydicom
 from dotenv import load_dotenv
+from pydicom.dataset import Dataset
+from pydicom.uid import (
+    DeflatedExplicitVRLittleEndian,
+    ExplicitVRLittleEndian,
+    ImplicitVRLittleEndian,
+    JPEGLSLossless,
+    RLELossless,
+)
 from pynetdicom import AE
+from pynetdicom.sop_class import StudyRootQueryRetrieveInformationModelFind
+
+from retuve_chris_plugin.tuning import available_cpus
 
 load_dotenv()
 
 # Orthanc upload configuration constants
-ORTHANC_HOST = "orthanc"
-ORTHANC_PORT = 4242
-ORTHANC_AE_TITLE = "NIDUS"
-CALLING_AE_TITLE = "RETUVE"  # Your local AE title
+ORTHANC_HOST = os.environ.get("ORTHANC_HOST", "orthanc")
+ORTHANC_PORT = int(os.environ.get("ORTHANC_PORT", "4242"))
+ORTHANC_AE_TITLE = os.environ.get("ORTHANC_AE_TITLE", "NIDUS")
+# Your local AE title
+CALLING_AE_TITLE = os.environ.get("ORTHANC_CALLING_AE_TITLE", "RETUVE")
 ENABLE_UPLOAD = True  # Set to False to disable uploading
 
+# Lossless recompression of originals before upload: none, rle, jpegls or
+# deflate
+COMPRESSION = os.environ.get("ORTHANC_COMPRESSION", "none").lower()
+COMPRESSION_WORKERS = int(
+    os.environ.get("ORTHANC_COMPRESSION_WORKERS", str(available_cpus()))
+)
+COMPRESSION_SYNTAXES = {
+    "rle": RLELossless,
+    "jpegls": JPEGLSLossless,
+    "deflate": DeflatedExplicitVRLittleEndian,
+}
+
+# Network timeouts (seconds)
+CONNECTION_TIMEOUT = float(os.environ.get("ORTHANC_CONNECTION_TIMEOUT", "5"))
+ACSE_TIMEOUT = float(os.environ.get("ORTHANC_ACSE_TIMEOUT", "15"))
+DIMSE_TIMEOUT = float(os.environ.get("ORTHANC_DIMSE_TIMEOUT", "60"))
+NETWORK_TIMEOUT = float(os.environ.get("ORTHANC_NETWORK_TIMEOUT", "60"))
+
+# Retries for transient failures, the backoff doubles on each attempt
+UPLOAD_RETRIES = int(os.environ.get("ORTHANC_UPLOAD_RETRIES", "3"))
+RETRY_BACKOFF = float(os.environ.get("ORTHANC_RETRY_BACKOFF", "1"))
+
+# Failed uploads in a row before Orthanc is considered down, and how long
+# to wait before trying it again
+BREAKER_THRESHOLD = int(os.environ.get("ORTHANC_BREAKER_THRESHOLD", "3"))
+BREAKER_RESET_SECONDS = float(
+    os.environ.get("ORTHANC_BREAKER_RESET_SECONDS", "300")
+)
+
+# Uploads deferred while Orthanc is down, replayed by replay_spool()
+SPOOL_DIR = os.environ.get("ORTHANC_SPOOL_DIR", "/home/chris/orthanc-spool")
+
+
+class CircuitBreaker:
+    """
+    Stops upload attempts after repeated failures, so a down Orthanc does
+    not cost a full set of timeouts for every file.
+    """
+
+    def __init__(self, threshold: int, reset_seconds: float):
+        self.threshold = threshold
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self.opened_at = None
+
+    @property
+    def is_open(self) -> bool:
+        if self.opened_at is None:
+            return False
+        # After the reset period, let the next attempt through as a probe
+        return time.time() - self.opened_at < self.reset_seconds
+
+    def record_success(self) -> None:
+        self.failures = 0
+        self.opened_at = None
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        if self.failures >= self.threshold:
+            if self.opened_at is None:
+                print(
+                    f"[orthanc] {self.failures} failed uploads in a row, "
+                    f"deferring uploads for {self.reset_seconds:.0f}s"
+                )
+            self.opened_at = time.time()
+
+
+BREAKER = CircuitBreaker(BREAKER_THRESHOLD, BREAKER_RESET_SECONDS)
+
+
+def _make_ae() -> AE:
+    ae = AE(ae_title=CALLING_AE_TITLE)
+    ae.connection_timeout = CONNECTION_TIMEOUT
+    ae.acse_timeout = ACSE_TIMEOUT
+    ae.dimse_timeout = DIMSE_TIMEOUT
+    ae.network_timeout = NETWORK_TIMEOUT
+    return ae
+
+
+def _send_dataset(dataset: Dataset, dicom_file_path: str) -> Optional[bool]:
+    """
+    Send a dataset via C-STORE in a single association.
+
+    Returns:
+        True if stored, False if Orthanc rejected it, None if Orthanc could
+        not be reached (worth retrying)
+    """
+    # Create Application Entity with calling AE title
+    ae = _make_ae()
+
+    # Only propose the dataset's own SOP class, in its own transfer syntax
+    # with uncompressed fallbacks
+    transfer_syntaxes = [ExplicitVRLittleEndian, ImplicitVRLittleEndian]
+    own_syntax = dataset.file_meta.TransferSyntaxUID
+    if own_syntax not in transfer_syntaxes:
+        transfer_syntaxes.insert(0, own_syntax)
+
+    ae.add_requested_context(
+        dataset.SOPClassUID, transfer_syntax=transfer_syntaxes
+    )
+
+    try:
+        # Establish association with Orthanc
+        assoc = ae.associate(
+            addr=ORTHANC_HOST,
+            port=ORTHANC_PORT,
+            ae_title=ORTHANC_AE_TITLE,
+        )
+    except Exception as e:
+        print(f"Error connecting to Orthanc: {str(e)}")
+        return None
+
+    if not (assoc and assoc.is_established):
+        print("Failed to establish association with Orthanc.")
+        return None
+
+    try:
+        # Send the DICOM file via C-STORE
+        status = assoc.send_c_store(dataset)
+    finally:
+        # Release the association
+        assoc.release()
+
+    if not status:
+        # No response within the DIMSE timeout, or the association aborted
+        print("Failed to send the DICOM file.")
+        return None
 
-def upload_dicom_to_orthanc(dicom_file_path: str, original_dicom=None) -> bool:
+    print(f"C-STORE request status: 0x{status.Status:04X}")
+    if status.Status == 0x0000:
+        print(
+            f"DICOM file successfully uploaded via DICOM networking: {dicom_file_path}"
+        )
+        return True
+
+    print(f"Error uploading DICOM file: {status}")
+    return False
+
+
+def _send_with_retries(
+    dataset: Dataset, dicom_file_path: str
+) -> Optional[bool]:
+    """
+    Send a dataset, retrying transient failures with backoff and feeding
+    the outcome to the circuit breaker.
+
+    Returns:
+        True if stored, False if Orthanc rejected it, None if Orthanc could
+        not be reached
+    """
+    for attempt in range(UPLOAD_RETRIES):
+        result = _send_dataset(dataset, dicom_file_path)
+
+        if result is not None:
+            # Orthanc answered, so it is up even if it rejected the file
+            BREAKER.record_success()
+            return result
+
+        if attempt < UPLOAD_RETRIES - 1:
+            time.sleep(RETRY_BACKOFF * 2**attempt)
+
+    BREAKER.record_failure()
+    return None
+
+
+def spool_dataset(dataset: Dataset, dicom_file_path: str) -> None:
+    """
+    Keep a dataset in the spool directory so it can be uploaded later.
+    """
+    spool = Path(SPOOL_DIR)
+    spool.mkdir(parents=True, exist_ok=True)
+    spool_path = spool / f"{dataset.SOPInstanceUID}.dcm"
+    dataset.save_as(spool_path)
+    print(f"[orthanc] Deferred upload of {dicom_file_path} to {spool_path}")
+
+
+def replay_spool() -> int:
+    """
+    Upload datasets deferred while Orthanc was down.
+
+    Returns:
+        int: The number of spooled datasets uploaded
+    """
+    spool = Path(SPOOL_DIR)
+    if not ENABLE_UPLOAD or not spool.is_dir():
+        return 0
+
+    uploaded = 0
+    for spool_path in sorted(spool.glob("*.dcm")):
+        if BREAKER.is_open:
+            break
+
+        dataset = pydicom.dcmread(spool_path)
+        if _send_with_retries(dataset, str(spool_path)):
+            spool_path.unlink()
+            uploaded += 1
+
+    if uploaded:
+        print(f"[orthanc] Replayed {uploaded} deferred uploads")
+    return uploaded
+
+
+def _compress_file(
+    dicom_file_path: str, out_dir: str
+) -> Tuple[str, Optional[str], float, float]:
+    """
+    Losslessly recompress one DICOM file into out_dir.
+
+    Runs in a worker process.
+
+    Returns:
+        The input path, the compressed path (None if left as is), the
+        compression ratio and the time taken in seconds
+    """
+    start = time.time()
+    dataset = pydicom.dcmread(dicom_file_path)
+
+    if (
+        "PixelData" not in dataset
+        or dataset.file_meta.TransferSyntaxUID.is_compressed
+    ):
+        return dicom_file_path, None, 1.0, time.time() - start
+
+    transfer_syntax = COMPRESSION_SYNTAXES[COMPRESSION]
+    if transfer_syntax == DeflatedExplicitVRLittleEndian:
+        # The whole dataset is deflated when encoded, pixel data included
+        dataset.file_meta.TransferSyntaxUID = transfer_syntax
+    else:
+        # Lossless, so the instance keeps its identity
+        dataset.compress(transfer_syntax, generate_instance_uid=False)
+
+    buffer = BytesIO()
+    dataset.save_as(buffer)
+    compressed = buffer.getvalue()
+
+    out_path = os.path.join(out_dir, os.path.basename(dicom_file_path))
+    with open(out_path, "wb") as f:
+        f.write(compressed)
+
+    ratio = os.path.getsize(dicom_file_path) / max(len(compressed), 1)
+    return dicom_file_path, out_path, ratio, time.time() - start
+
+
+def compress_for_upload(dicom_file_paths: List[str]) -> Dict[str, str]:
+    """
+    Losslessly recompress files in a worker pool ahead of uploading them,
+    if ORTHANC_COMPRESSION is enabled.
+
+    Args:
+        dicom_file_paths: Paths of the DICOM files to be uploaded
+
+    Returns:
+        Mapping of input path to the path of the file to upload instead.
+        The compressed files are left in a temporary directory for the
+        caller to remove.
+    """
+    if COMPRESSION == "none" or not dicom_file_paths:
+        return {}
+
+    if COMPRESSION not in COMPRESSION_SYNTAXES:
+        print(f"[orthanc] Unknown compression mode: {COMPRESSION}")
+        return {}
+
+    out_dir = tempfile.mkdtemp(prefix="retuve-upload-")
+    compressed = {}
+
+    with ProcessPoolExecutor(max_workers=COMPRESSION_WORKERS) as pool:
+        futures = [
+            pool.submit(_compress_file, str(path), out_dir)
+            for path in dicom_file_paths
+        ]
+        for future in futures:
+            try:
+                path, out_path, ratio, seconds = future.result()
+            except Exception as e:
+                # Leave the file uncompressed, e.g. missing codec plugin
+                print(f"[orthanc] Compression failed: {str(e)}")
+                continue
+            if out_path is None:
+                continue
+            compressed[path] = out_path
+            print(
+                f"[orthanc] Compressed {path} ({COMPRESSION}): "
+                f"ratio {ratio:.2f} in {seconds:.2f}s"
+            )
+
+    return compressed
+
+
+def upload_dicom_to_orthanc(
+    dicom_file_path: str, original_dicom=None, uncompressed_path=None
+) -> bool:
     """
     Upload a DICOM file to Orthanc server.
 
+    If Orthanc cannot be reached, the file is spooled for replay_spool()
+    instead.
+
     Args:
         dicom_file_path: Path to the DICOM file to upload
         original_dicom: Original DICOM dataset to copy metadata from (optional)
+        uncompressed_path: The untouched file dicom_file_path was recompressed
+            from (optional). It is sent, or spooled, instead if the
+            recompressed file is not stored.
 
     Returns:
         bool: True if upload successful, False otherwise
@@ -45,63 +361,112 @@ def upload_dicom_to_orthanc(dicom_file_path: str, original_dicom=None) -> bool:
             if hasattr(original_dicom, "StationName"):
                 dataset.StationName = original_dicom.StationName
 
-        # Create Application Entity with calling AE title
-        ae = AE(ae_title=CALLING_AE_TITLE)
+        if BREAKER.is_open:
+            result = None
+        else:
+            result = _send_with_retries(dataset, dicom_file_path)
 
-        # Define the requested contexts for different DICOM types
-        requested_contexts = [
-            "1.2.840.10008.5.1.4.1.1.1",  # CR Image Storage
-            "1.2.840.10008.5.1.4.1.1.4",  # MR Image Storage
-            "1.2.840.10008.5.1.4.1.1.3.1",  # Ultrasound Multi-frame Image Storage
-            "1.2.840.10008.5.1.4.1.1.1.1",  # Digital X-Ray Image Storage
-            "1.2.840.10008.5.1.4.1.1.104.1",  # Encapsulated PDF Storage
-        ]
+    except Exception as e:
+        # e.g. Orthanc accepted none of the file's transfer syntaxes
+        print(f"Error uploading DICOM file {dicom_file_path}: {str(e)}")
+        result = False
 
-        transfer_syntaxes = [
-            "1.2.840.10008.1.2.4.91",
-            "1.2.840.10008.1.2.5",
-            "1.2.840.10008.1.2.1",
-            "1.2.840.10008.1.2.4.50",
-        ]
+    if result is True:
+        return True
+
+    if uncompressed_path is not None:
+        # Any Orthanc accepts the untouched file, and if it has to be
+        # spooled, it replays without a codec
+        print(
+            "[orthanc] Sending the uncompressed original instead: "
+            f"{uncompressed_path}"
+        )
+        return upload_dicom_to_orthanc(uncompressed_path, original_dicom)
 
-        # Add requested contexts
-        for context in requested_contexts:
-            for ts in transfer_syntaxes:
-                ae.add_requested_context(context, transfer_syntax=ts)
+    if result is None:
+        spool_dataset(dataset, dicom_file_path)
+    return False
+
+
+def content_marker(dataset: Dataset) -> str:
+    """
+    Identify the content of an instance beyond its SOPInstanceUID, so a
+    re-exported instance that kept its UID is not mistaken for the stored
+    one.
+
+    Args:
+        dataset: The instance, or a C-FIND identifier for it
+
+    Returns:
+        Its Content Date and Content Time, or an empty string if it has
+        neither
+    """
+    return "{}{}".format(
+        dataset.get("ContentDate", "") or "",
+        dataset.get("ContentTime", "") or "",
+    )
+
+
+def find_stored_instances(
+    study_instance_uid: str,
+) -> Optional[Dict[str, str]]:
+    """
+    Query Orthanc for the instances it already stores for a study.
+
+    Args:
+        study_instance_uid: StudyInstanceUID of the study to query
+
+    Returns:
+        The content marker of each stored instance by SOPInstanceUID, or
+        None if the query failed
+    """
+    if not ENABLE_UPLOAD or BREAKER.is_open:
+        return None
+
+    try:
+        ae = _make_ae()
+        ae.add_requested_context(StudyRootQueryRetrieveInformationModelFind)
+
+        query = Dataset()
+        query.QueryRetrieveLevel = "IMAGE"
+        query.StudyInstanceUID = study_instance_uid
+        query.SeriesInstanceUID = ""
+        query.SOPInstanceUID = ""
+        query.ContentDate = ""
+        query.ContentTime = ""
 
-        # Establish association with Orthanc
         assoc = ae.associate(
             addr=ORTHANC_HOST,
             port=ORTHANC_PORT,
             ae_title=ORTHANC_AE_TITLE,
         )
 
-        if assoc and assoc.is_established:
-            # Send the DICOM file via C-STORE
-            status = assoc.send_c_store(dataset)
-
-            if status:
-                print(f"C-STORE request status: 0x{status.Status:04X}")
-                if status.Status == 0x0000:
-                    print(
-                        f"DICOM file successfully uploaded via DICOM networking: {dicom_file_path}"
-                    )
-                    success = True
-                else:
-                    print(f"Error uploading DICOM file: {status}")
-                    success = False
-            else:
-                print("Failed to send the DICOM file.")
-                success = False
-
-            # Release the association
-            assoc.release()
-        else:
+        if not (assoc and assoc.is_established):
             print("Failed to establish association with Orthanc.")
-            success = False
+            BREAKER.record_failure()
+            return None
+
+        stored = {}
+        failed = False
+        for status, identifier in assoc.send_c_find(
+            query, StudyRootQueryRetrieveInformationModelFind
+        ):
+            if not status:
+                failed = True
+                break
+            # 0xFF00 and 0xFF01 are pending statuses carrying a match
+            if status.Status in (0xFF00, 0xFF01) and identifier:
+                stored[str(identifier.SOPInstanceUID)] = content_marker(
+                    identifier
+                )
+            elif status.Status != 0x0000:
+                print(f"C-FIND request status: 0x{status.Status:04X}")
+                failed = True
 
-        return success
+        assoc.release()
+
+        return None if failed else stored
 
     except Exception as e:
-        print(f"Error uploading DICOM file {dicom_file_path}: {str(e)}")
-        return False
+        print(f"Error querying study {study_instance_uid}: {str(e)}")
+        return None
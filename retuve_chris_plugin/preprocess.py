@@ -0,0 +1,256 @@
+"""
+Whole-sweep frame preprocessing for YOLO inference.
+
+The default retuve path converts every frame to a PIL RGB image, which
+YOLO then converts back to a contiguous BGR array, one frame at a time.
+Here the decoded sweep is converted to BGR in a few NumPy operations
+instead, and YOLO takes the frames as they are.
+"""
+
+import argparse
+import threading
+import time
+from multiprocessing import shared_memory
+from typing import List
+
+import numpy as np
+
+# Frames converted per NumPy operation when values need clipping or frames
+# are decoded lazily, to bound the temporary memory used
+CHUNK_FRAMES = 64
+
+
+def sweep_pixels(dcm, dicom_type: str, decoder=None):
+    """
+    The decoded frames of a DICOM as one (frames, rows, columns[, samples])
+    array.
+
+    Args:
+        dcm: The DICOM dataset
+        dicom_type: The retuve config's dicom_type
+        decoder: A decode.FrameDecoder to decode the pixel data with
+            (optional, defaults to pixel_array)
+
+    Returns:
+        The pixel array, with a frame axis added for single frames, or a
+        decode.LazyFrames when decoding lazily
+    """
+    from radstract.data.dicom.utils import DicomTypes
+
+    pixels = dcm.pixel_array if decoder is None else decoder.decode(dcm)
+    samples = int(dcm.get("SamplesPerPixel", 1))
+    single = pixels.ndim == (2 if samples == 1 else 3)
+    if dicom_type == DicomTypes.SINGLE or single:
+        pixels = pixels[np.newaxis]
+    return pixels
+
+
+def bgr_shape(pixels: np.ndarray) -> tuple:
+    return tuple(pixels.shape[:3]) + (3,)
+
+
+def to_bgr(pixels, out: np.ndarray = None) -> np.ndarray:
+    """
+    Convert a sweep, or a chunk of one, to 8-bit BGR frames as YOLO takes
+    them.
+
+    Matches converting each frame with PIL's convert("RGB") and then to
+    BGR: greyscale is repeated across the channels, alpha is dropped and
+    values outside 0-255 are clipped.
+
+    Args:
+        pixels: (frames, rows, columns[, samples]) array or LazyFrames
+        out: Preallocated uint8 array of bgr_shape(pixels) to write into
+            (optional)
+
+    Returns:
+        The (frames, rows, columns, 3) uint8 BGR array
+    """
+    if out is None:
+        out = np.empty(bgr_shape(pixels), dtype=np.uint8)
+
+    for start in range(0, len(pixels), _chunk_frames(pixels)):
+        chunk = pixels[start : start + _chunk_frames(pixels)]
+        if chunk.dtype != np.uint8:
+            chunk = np.clip(chunk, 0, 255).astype(np.uint8)
+
+        if chunk.ndim == 4 and chunk.shape[-1] == 1:
+            chunk = chunk[..., 0]
+
+        # One strided write per channel, several times faster than
+        # broadcasting or reversing the channel axis in one assignment
+        target = out[start : start + len(chunk)]
+        for channel in range(3):
+            if chunk.ndim == 3:
+                target[..., channel] = chunk
+            else:
+                target[..., channel] = chunk[..., 2 - channel]
+
+    return out
+
+
+def _chunk_frames(pixels) -> int:
+    # Decoded uint8 frames need no temporary, so are converted in one
+    # operation
+    if isinstance(pixels, np.ndarray) and pixels.dtype == np.uint8:
+        return max(1, len(pixels))
+    return CHUNK_FRAMES
+
+
+def preprocess_sweep(dcm, dicom_type: str, decoder=None) -> np.ndarray:
+    """
+    Decode a DICOM and convert the whole sweep to BGR frames.
+
+    Returns:
+        The (frames, rows, columns, 3) uint8 BGR array
+    """
+    return to_bgr(sweep_pixels(dcm, dicom_type, decoder))
+
+
+def yolo_predict_dcm_vectorized(
+    dcm, keyphrase, model=None, decoder=None, **kwargs
+):
+    """
+    Segmentation function (a retuve modes_func) equivalent to
+    yolo_predict_dcm_us, with the sweep preprocessed as a whole.
+
+    Pass decoder (a decode.FrameDecoder) with functools.partial to decode
+    compressed sweeps in parallel.
+    """
+    from retuve.keyphrases.config import Config
+
+    config = Config.get_config(keyphrase)
+    frames = preprocess_sweep(dcm, config.dicom_type, decoder)
+    return yolo_predict_frames(frames, keyphrase, model, **kwargs)
+
+
+def yolo_predict_frames(frames, keyphrase, model=None, **kwargs):
+    """
+    yolo_predict_us on preprocessed BGR frames. Through an
+    inference.BatchingModel, the frames are predicted in batches rather
+    than one per call.
+    """
+    from retuve_yolo_plugin.ultrasound import yolo_predict_us
+
+    frames = list(frames)
+    if not hasattr(model, "prefetch"):
+        return yolo_predict_us(frames, keyphrase, model, **kwargs)
+
+    with model.prefetch(frames) as sweep_model:
+        return yolo_predict_us(frames, keyphrase, sweep_model, **kwargs)
+
+
+class SharedFrameBuffers:
+    """
+    Pool of shared memory blocks that preprocessed sweeps are written
+    into, reused across sweeps instead of allocating one block per sweep.
+
+    A block is held by one sweep at a time, so sweeps preprocessed from
+    several threads never share one. Blocks only grow, to the largest
+    sweep seen.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.free: List[shared_memory.SharedMemory] = []
+        self.blocks: List[shared_memory.SharedMemory] = []
+
+    def acquire(self, nbytes: int) -> shared_memory.SharedMemory:
+        with self.lock:
+            fitting = [shm for shm in self.free if shm.size >= nbytes]
+            if fitting:
+                shm = min(fitting, key=lambda s: s.size)
+                self.free.remove(shm)
+                return shm
+
+            if self.free:
+                # Replace the largest free block rather than keep both
+                too_small = max(self.free, key=lambda s: s.size)
+                self.free.remove(too_small)
+                self.blocks.remove(too_small)
+                too_small.close()
+                too_small.unlink()
+
+            shm = shared_memory.SharedMemory(create=True, size=max(1, nbytes))
+            self.blocks.append(shm)
+            return shm
+
+    def release(self, shm: shared_memory.SharedMemory) -> None:
+        with self.lock:
+            self.free.append(shm)
+
+    def close(self) -> None:
+        with self.lock:
+            for shm in self.blocks:
+                shm.close()
+                shm.unlink()
+            self.blocks = []
+            self.free = []
+
+
+def _per_frame_pipeline(pixels: np.ndarray) -> list:
+    """The per-frame path, PIL RGB images converted to BGR by YOLO."""
+    from PIL import Image
+
+    images = [Image.fromarray(frame).convert("RGB") for frame in pixels]
+    # What YOLO does with each PIL image before inference
+    return [np.ascontiguousarray(np.asarray(im)[..., ::-1]) for im in images]
+
+
+def benchmark(
+    frame_counts, height: int, width: int, colour: bool, repeats: int
+):
+    """
+    Time the per-frame path against whole-sweep preprocessing on synthetic
+    sweeps, checking both give the same frames.
+    """
+    rng = np.random.default_rng(0)
+    shape = (height, width, 3) if colour else (height, width)
+
+    print(
+        f"[preprocess] {height}x{width} "
+        f"{'RGB' if colour else 'greyscale'} frames, best of {repeats}"
+    )
+    print(f"{'frames':>8} {'per-frame':>12} {'vectorized':>12} {'speedup':>8}")
+
+    for frames in frame_counts:
+        pixels = rng.integers(0, 255, (frames,) + shape, dtype=np.uint8)
+        buffer = np.empty(bgr_shape(pixels), dtype=np.uint8)
+
+        per_frame = vectorized = float("inf")
+        for _ in range(repeats):
+            start = time.perf_counter()
+            expected = _per_frame_pipeline(pixels)
+            per_frame = min(per_frame, time.perf_counter() - start)
+
+            start = time.perf_counter()
+            to_bgr(pixels, out=buffer)
+            vectorized = min(vectorized, time.perf_counter() - start)
+
+        assert all(np.array_equal(a, b) for a, b in zip(expected, buffer))
+        del expected
+
+        print(
+            f"{frames:>8} {per_frame:>11.3f}s {vectorized:>11.3f}s "
+            f"{per_frame / vectorized:>7.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(
+        description="Benchmark whole-sweep frame preprocessing"
+    )
+    arg_parser.add_argument(
+        "--frames", type=int, nargs="+", default=[50, 200, 500, 1000]
+    )
+    arg_parser.add_argument("--height", type=int, default=480)
+    arg_parser.add_argument("--width", type=int, default=640)
+    arg_parser.add_argument(
+        "--greyscale", action="store_true", help="Single-sample frames"
+    )
+    arg_parser.add_argument("--repeats", type=int, default=3)
+    args = arg_parser.parse_args()
+
+    benchmark(
+        args.frames, args.height, args.width, not args.greyscale, args.repeats
+    )
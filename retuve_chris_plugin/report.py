@@ -0,0 +1,146 @@
+"""
+Report rendering with the static parts of every report (logo, stylesheet
+and fonts) prepared once per process and shared between reports.
+"""
+
+import base64
+import os
+import re
+import threading
+from functools import lru_cache
+from typing import Optional
+
+from dotenv import load_dotenv
+from radstract.visuals import ReportGenerator
+from radstract.visuals.report_utils import generate_css_styles
+
+load_dotenv()
+
+# Embed whole fonts rather than subsetting them with fontTools on every
+# render. Renders faster, at the cost of larger PDFs.
+REPORT_FULL_FONTS = os.environ.get("REPORT_FULL_FONTS", "false").lower() in {
+    "1",
+    "true",
+    "yes",
+}
+
+_STYLE_BLOCK = re.compile(r"<style>.*?</style>", re.DOTALL)
+
+_lock = threading.Lock()
+_font_config = None
+
+
+def _get_font_config():
+    global _font_config
+    from weasyprint.text.fonts import FontConfiguration
+
+    with _lock:
+        if _font_config is None:
+            _font_config = FontConfiguration()
+        return _font_config
+
+
+@lru_cache(maxsize=None)
+def _logo_data_uri(logo_path: str) -> Optional[str]:
+    try:
+        with open(logo_path, "rb") as logo_file:
+            logo_base64 = base64.b64encode(logo_file.read()).decode("utf-8")
+    except OSError:
+        # Skip logo if loading fails
+        return None
+
+    logo_type = logo_path.split(".")[-1].lower()
+    if logo_type == "jpg":
+        logo_type = "jpeg"
+    return f"data:image/{logo_type};base64,{logo_base64}"
+
+
+@lru_cache(maxsize=None)
+def _stylesheet(*colors: str):
+    from weasyprint import CSS
+
+    return CSS(
+        string=generate_css_styles(*colors), font_config=_get_font_config()
+    )
+
+
+class CachedReportGenerator(ReportGenerator):
+    """
+    ReportGenerator that reuses the logo, the parsed stylesheet and the
+    font configuration across every report in the process, and renders the
+    PDF once when it is saved both as a file and as DICOM.
+
+    Overrides ReportGenerator's private _create_header_html and _render, so
+    radstract is pinned in requirements.txt.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # (html, pdf bytes) of the last render
+        self._rendered = None
+
+    def _create_header_html(self) -> str:
+        header_html = '<header><div class="header-content">'
+
+        logo_uri = _logo_data_uri(self.logo_path) if self.logo_path else None
+        if logo_uri:
+            header_html += (
+                f'<img src="{logo_uri}" alt="Logo" class="header-logo">'
+            )
+
+        header_html += f"<h1>{self.title}</h1></div></header>"
+        return header_html
+
+    def _render(self, html_content: str) -> bytes:
+        from weasyprint import HTML
+
+        stylesheet = _stylesheet(
+            self.accent_color,
+            self.header_color,
+            self.page_color,
+            self.background_color,
+            self.background_color_light,
+            self.text_color,
+            self.border_color,
+            self.text_color_light,
+            self.footer_color,
+        )
+
+        options = {
+            "stylesheets": [stylesheet],
+            "font_config": _get_font_config(),
+            "full_fonts": REPORT_FULL_FONTS,
+        }
+        if self._attachments:
+            options["attachments"] = self._create_attachments_list()
+
+        # The stylesheet is passed already parsed instead
+        html_content = _STYLE_BLOCK.sub("", html_content, count=1)
+        return HTML(string=html_content).write_pdf(**options)
+
+    def get_pdf_bytes(
+        self, hide_videos=True, hide_attachment_note=False
+    ) -> Optional[bytes]:
+        try:
+            html_content = self.generate_html(
+                hide_videos=hide_videos, hide_attachments=hide_attachment_note
+            )
+            if self._rendered is None or self._rendered[0] != html_content:
+                self._rendered = (html_content, self._render(html_content))
+            return self._rendered[1]
+        except Exception as e:
+            print(f"Error generating PDF bytes: {str(e)}")
+            return None
+
+    def save_pdf(self, output_path: str, hide_videos=True) -> bool:
+        pdf_bytes = self.get_pdf_bytes(hide_videos=hide_videos)
+        if pdf_bytes is None:
+            return False
+
+        try:
+            with open(output_path, "wb") as f:
+                f.write(pdf_bytes)
+            return True
+        except OSError as e:
+            print(f"Error generating PDF: {str(e)}")
+            return False
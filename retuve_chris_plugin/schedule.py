@@ -2,11 +2,15 @@
 https://fnndsc.github.io/ChRIS_ultron_backEnd
 """
 
+import hashlib
 import os
+import re
 import tempfile
+import threading
 import time
 from datetime import datetime, timedelta, timezone
-from typing import Any, Dict, List, Optional
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
 
 import requests
 from dateutil import parser as dtparser
@@ -17,6 +21,22 @@ load_dotenv()
 USER = os.environ.get("CHRIS_USER", "chris")
 LOCK_DIR_PATH = os.environ.get("LOCK_DIR_PATH", "home/chris/locks")
 PREEMPT = os.environ.get("PREEMPT", "false").lower() in {"1", "true", "yes"}
+# Estimated seconds of work per frame, to turn a job's frame count into an
+# expected run time when ordering the lock queue
+LOCK_SECONDS_PER_FRAME = float(os.environ.get("LOCK_SECONDS_PER_FRAME", "0.5"))
+# Assumed frame count of a job that did not report its cost
+LOCK_DEFAULT_FRAMES = int(os.environ.get("LOCK_DEFAULT_FRAMES", "300"))
+# How long the next job in the queue has to claim the lock
+LOCK_CLAIM_SECONDS = float(os.environ.get("LOCK_CLAIM_SECONDS", "60"))
+# Longest a job waits in the queue before it fails
+LOCK_MAX_WAIT_SECONDS = float(os.environ.get("LOCK_MAX_WAIT_SECONDS", "3600"))
+# How often the lock holder shows it is alive, and how long a holder may go
+# without doing so before waiting jobs remove its lock
+LOCK_HEARTBEAT_SECONDS = float(os.environ.get("LOCK_HEARTBEAT_SECONDS", "60"))
+LOCK_STALE_SECONDS = float(os.environ.get("LOCK_STALE_SECONDS", "300"))
+QUEUE_DIR = "queue"
+GRANTED_DIR = "granted"
+ALIVE_DIR = "alive"
 SESSION = requests.Session()
 
 
@@ -57,6 +77,8 @@ def list_folder_files(api_url, folder_path: str) -> List[Dict[str, Any]]:
 
 def parse_lock_fname(fname: str) -> Optional[str]:
     fname = fname.split("/")[-1]
+    # Locks placed with a job_id carry it as a prefix
+    fname = fname[fname.find("lock-") :] if "lock-" in fname else fname
     if fname.startswith("lock-") and "T" in fname and fname.endswith("Z"):
         iso = fname[5:]
         try:
@@ -67,14 +89,173 @@ def parse_lock_fname(fname: str) -> Optional[str]:
     return None
 
 
+def parse_lock_meta(fname: str) -> Tuple[bool, int, int, Optional[str]]:
+    """
+    Read the state, priority, estimated cost and group of a lock entry from
+    its path.
+
+    Entries are stored as <LOCK_DIR_PATH>/<queue|granted>/
+    p<priority>-c<cost>[-g<group>]/lock-<iso>. A bare
+    <LOCK_DIR_PATH>/lock-<iso> was placed by an older plugin, which only
+    places its lock once no other lock exists, so it is treated as granted.
+
+    Returns:
+        (granted, priority, cost in frames, 0 if unknown, group or None)
+    """
+    parts = fname.split("/")
+    if len(parts) >= 3 and parts[-3] in {QUEUE_DIR, GRANTED_DIR}:
+        match = re.fullmatch(r"p(-?\d+)-c(\d+)(?:-g(\w+))?", parts[-2])
+        if match:
+            priority, cost, group = match.groups()
+            return parts[-3] == GRANTED_DIR, int(priority), int(cost), group
+    return True, 0, 0, None
+
+
+def list_lock_entries(api_url) -> List[Dict[str, Any]]:
+    entries = []
+    for f in list_folder_files(api_url, LOCK_DIR_PATH):
+        fname = f.get("fname", "")
+        iso = parse_lock_fname(fname)
+        if not iso:
+            continue
+        granted, priority, cost, group = parse_lock_meta(fname)
+        entries.append(
+            {
+                "file": f,
+                "fname": fname,
+                "name": fname.split("/")[-1],
+                "iso": iso,
+                "granted": granted,
+                "priority": priority,
+                "cost": cost,
+                "group": group,
+            }
+        )
+    return entries
+
+
+def lock_score(entry: Dict[str, Any], now: datetime) -> float:
+    """
+    Highest response ratio next: (wait + estimated run time) / estimated
+    run time, doubled per priority level.
+
+    Short jobs start with a high ratio so go first, while the ratio of a
+    long job keeps growing as it waits, so it is never starved.
+    """
+    frames = entry["cost"] or LOCK_DEFAULT_FRAMES
+    run_seconds = max(1.0, frames * LOCK_SECONDS_PER_FRAME)
+    waited = max(0.0, (now - iso_to_dt(entry["iso"])).total_seconds())
+    return (1 + waited / run_seconds) * 2 ** entry["priority"]
+
+
+def next_in_queue(entries, now: datetime) -> Optional[Dict[str, Any]]:
+    queued = [e for e in entries if not e["granted"]]
+    if not queued:
+        return None
+    return min(queued, key=lambda e: (-lock_score(e, now), e["iso"]))
+
+
+def _lock_name(my_iso: str, job_id=None) -> str:
+    prefix = f"{job_id}-" if job_id else ""
+    return f"{prefix}lock-{my_iso.replace(':', '')}"
+
+
+def list_heartbeats(api_url) -> Dict[str, datetime]:
+    """
+    The latest heartbeat of each lock holder, by lock file name.
+
+    Heartbeats are stored as <LOCK_DIR_PATH>/alive/<lock name>/beat-<iso>.
+    """
+    beats = {}
+    for f in list_folder_files(api_url, f"{LOCK_DIR_PATH}/{ALIVE_DIR}"):
+        parts = f.get("fname", "").split("/")
+        if len(parts) < 2 or not parts[-1].startswith("beat-"):
+            continue
+        try:
+            beat = iso_to_dt(parts[-1][5:])
+        except ValueError:
+            continue
+        beats[parts[-2]] = max(beat, beats.get(parts[-2], beat))
+    return beats
+
+
+def _delete_heartbeats(api_url, name: str, keep: str = None) -> None:
+    beat_dir = f"{LOCK_DIR_PATH}/{ALIVE_DIR}/{name}"
+    for f in list_folder_files(api_url, beat_dir):
+        if keep is None or not f.get("fname", "").endswith(keep):
+            delete_file(api_url, f)
+
+
+def keep_alive(api_url, my_iso: str, job_id=None):
+    """
+    Refresh this job's heartbeat every LOCK_HEARTBEAT_SECONDS while it
+    holds the lock, so waiting jobs can tell it from a crashed holder.
+
+    Returns:
+        A function that stops the heartbeat, once the last one is written
+    """
+    name = _lock_name(my_iso, job_id)
+    stop = threading.Event()
+
+    def beat():
+        while not stop.is_set():
+            beat_fname = "beat-" + datetime.now(timezone.utc).strftime(
+                "%Y-%m-%dT%H%M%SZ"
+            )
+            try:
+                upload_file(
+                    api_url,
+                    f"{LOCK_DIR_PATH}/{ALIVE_DIR}/{name}/{beat_fname}",
+                    b"alive\n",
+                )
+                _delete_heartbeats(api_url, name, keep=beat_fname)
+            except Exception as e:
+                print(f"[lock] Heartbeat failed: {e}")
+            stop.wait(LOCK_HEARTBEAT_SECONDS)
+
+    thread = threading.Thread(target=beat, daemon=True)
+    thread.start()
+
+    def stop_heartbeat() -> None:
+        stop.set()
+        thread.join()
+
+    return stop_heartbeat
+
+
 def find_current_lock(api_url) -> Optional[dict]:
-    files = list_folder_files(api_url, LOCK_DIR_PATH)
-    locks = [
-        (iso, f)
-        for f in files
-        if (iso := parse_lock_fname(f.get("fname", "")))
-    ]
-    return min(locks, key=lambda t: t[0])[1] if locks else None
+    granted = [e for e in list_lock_entries(api_url) if e["granted"]]
+    return min(granted, key=lambda e: e["iso"])["file"] if granted else None
+
+
+def estimate_job_frames(inputdir) -> int:
+    """
+    Total frames across the input DICOMs, from a header-only scan, as the
+    estimated cost of a job.
+    """
+    import pydicom
+
+    frames = 0
+    for path in Path(inputdir).glob("**/*.dcm"):
+        try:
+            header = pydicom.dcmread(path, stop_before_pixels=True)
+        except Exception:
+            continue
+        frames += int(header.get("NumberOfFrames", 1) or 1)
+    return frames
+
+
+def input_digest(inputdir) -> str:
+    """
+    Short digest of the input DICOMs' paths and sizes, the same for every
+    shard of a job, used to let them share the lock.
+    """
+    digest = hashlib.sha256()
+    for path in sorted(Path(inputdir).glob("**/*.dcm")):
+        digest.update(
+            f"{path.relative_to(inputdir)}:{path.stat().st_size}\n".encode()
+        )
+    return digest.hexdigest()[:16]
 
 
 # https://chris-api.nidusai.ca/api/v1/userfiles/
@@ -106,70 +287,202 @@ def delete_file(api_url, file_entry: dict) -> None:
 
 
 def place_lock(
-    api_url, my_iso, job_id=None, timeout_seconds: float = 300.0
+    api_url,
+    my_iso,
+    job_id=None,
+    priority: int = 0,
+    cost: int = 0,
+    group: Optional[str] = None,
+    max_wait_seconds: float = None,
 ) -> None:
-
-    if not job_id:
-        job_id = ""
-    else:
-        job_id += "-"
-
-    my_fname = f"{job_id}lock-{my_iso.replace(':', '')}"
-    my_path = f"{LOCK_DIR_PATH}/{my_fname}"
-
-    t_start = time.time()
+    """
+    Queue for the lock and wait until it is granted.
+
+    While nobody holds the lock, the queued entry with the highest
+    lock_score is granted next, so cheap and high priority jobs overtake
+    long ones without starving them. Entries of one group, e.g. the shards
+    of a job, share a grant: while only their group holds the lock, they
+    take it without waiting.
+
+    There is no limit on how long one holder may keep the lock, as long as
+    it shows it is alive (see keep_alive). A holder without a heartbeat for
+    LOCK_STALE_SECONDS is taken to have crashed, and its lock is removed.
+
+    Args:
+        api_url: The ChRIS API URL
+        my_iso: The time this job requested the lock, as ISO 8601
+        job_id: Optional prefix for the lock file name
+        priority: Each level doubles the job's score
+        cost: Estimated cost of the job in frames (0 if unknown)
+        group: Alphanumeric key of the jobs sharing a grant (optional)
+        max_wait_seconds: Give up after waiting this long in total,
+            LOCK_MAX_WAIT_SECONDS by default
+
+    Raises:
+        TimeoutError: If the lock was not granted in time
+    """
+    if max_wait_seconds is None:
+        max_wait_seconds = LOCK_MAX_WAIT_SECONDS
+
+    my_fname = _lock_name(my_iso, job_id)
+    meta = f"p{priority}-c{cost}" + (f"-g{group}" if group else "")
+    queue_path = f"{LOCK_DIR_PATH}/{QUEUE_DIR}/{meta}/{my_fname}"
+    grant_path = f"{LOCK_DIR_PATH}/{GRANTED_DIR}/{meta}/{my_fname}"
+
+    t_queued = time.time()
     last_seen = None
+    # When each holder was first seen, the start of its staleness window
+    seen_at = {}
+    last_next = None
+    t_next = time.time()
+
+    entries = list_lock_entries(api_url)
+    if any(e["name"] == my_fname and e["granted"] for e in entries):
+        print(f"[lock] Already placed: {my_fname}")
+        return
+    if not any(e["name"] == my_fname for e in entries):
+        upload_file(api_url, queue_path, f"lock for {my_iso}\n".encode())
+        print(
+            f"[lock] Queued: {my_fname} (priority {priority}, {cost} frames)"
+        )
 
-    while True:
-        cur = find_current_lock(api_url)
-
-        if cur is None:
-            upload_file(api_url, my_path, f"lock for {my_iso}\n".encode())
-            print(f"[lock] Placed: {my_fname}")
-            return
-
-        cur_fname = cur.get("fname", "")
-        if cur_fname.endswith(f"/{my_fname}"):
-            print(f"[lock] Already placed: {my_fname}")
-            return
-
-        if PREEMPT:
-            print(f"[lock] Preempting: {cur_fname}")
-            delete_file(api_url, cur)
-            time.sleep(0.5)
-            continue
+    try:
+        while True:
+            if time.time() - t_queued > max_wait_seconds:
+                raise TimeoutError(
+                    f"[lock] Not granted within {max_wait_seconds:.0f}s"
+                )
+
+            entries = list_lock_entries(api_url)
+            now = datetime.now(timezone.utc)
+            holders = [e for e in entries if e["granted"]]
+
+            if not any(e["name"] == my_fname for e in entries):
+                # Our entry is gone, e.g. removed as stale by another job
+                upload_file(
+                    api_url, queue_path, f"lock for {my_iso}\n".encode()
+                )
+                print(f"[lock] Queued again: {my_fname}")
+                continue
+
+            if holders:
+                last_next = None
+                cur = min(holders, key=lambda e: (e["iso"], e["name"]))
+                cur_fname = cur["fname"]
+                if cur["name"] == my_fname:
+                    for e in entries:
+                        if e["name"] == my_fname and not e["granted"]:
+                            delete_file(api_url, e["file"])
+                    print(f"[lock] Placed: {my_fname}")
+                    return
+
+                if group and all(e["group"] == group for e in holders):
+                    if not any(e["name"] == my_fname for e in holders):
+                        upload_file(
+                            api_url,
+                            grant_path,
+                            f"lock for {my_iso}\n".encode(),
+                        )
+                    for e in entries:
+                        if e["name"] == my_fname and not e["granted"]:
+                            delete_file(api_url, e["file"])
+                    print(f"[lock] Sharing grant of: {cur_fname}")
+                    return
+
+                mine = [e for e in holders if e["name"] == my_fname]
+                if mine:
+                    # Granted at the same time as another job, which wins
+                    for e in mine:
+                        delete_file(api_url, e["file"])
+                    print(f"[lock] Lost grant to: {cur_fname}")
+                    continue
+
+                if PREEMPT:
+                    print(f"[lock] Preempting: {cur_fname}")
+                    delete_file(api_url, cur["file"])
+                    time.sleep(0.5)
+                    continue
+
+                if last_seen != cur_fname:
+                    last_seen = cur_fname
+                    print(f"[lock] Waiting for: {cur_fname}")
+
+                beats = list_heartbeats(api_url)
+                stale = []
+                for e in holders:
+                    if f"/{GRANTED_DIR}/" not in e["fname"]:
+                        # Older plugins never show they are alive
+                        continue
+                    alive_at = seen_at.setdefault(e["name"], now)
+                    if e["name"] in beats:
+                        alive_at = max(alive_at, beats[e["name"]])
+                    if (now - alive_at).total_seconds() > LOCK_STALE_SECONDS:
+                        stale.append(e)
+
+                for e in stale:
+                    print(f"[lock] Removing stale holder: {e['fname']}")
+                    delete_file(api_url, e["file"])
+                    _delete_heartbeats(api_url, e["name"])
+                if stale:
+                    continue
+
+                time.sleep(5.0)
+                continue
+
+            nxt = next_in_queue(entries, now)
+
+            if nxt["fname"] != last_next:
+                last_next = nxt["fname"]
+                t_next = time.time()
+                print(
+                    f"[lock] Next: {nxt['name']} (priority "
+                    f"{nxt['priority']}, {nxt['cost']} frames, score "
+                    f"{lock_score(nxt, now):.2f}, "
+                    f"{sum(not e['granted'] for e in entries)} queued)"
+                )
+
+            if nxt["name"] == my_fname:
+                upload_file(
+                    api_url, grant_path, f"lock for {my_iso}\n".encode()
+                )
+                # Re-check on the next pass in case another job was granted
+                # at the same time
+                time.sleep(0.5)
+                continue
+
+            if time.time() - t_next > LOCK_CLAIM_SECONDS:
+                # Its job never claimed the lock, e.g. it crashed in the queue
+                print(f"[lock] Removing stale entry: {nxt['fname']}")
+                delete_file(api_url, nxt["file"])
+                continue
+
+            time.sleep(5.0)
+    except BaseException:
+        release_lock(api_url, my_iso, job_id=job_id)
+        raise
 
-        if last_seen != cur_fname:
-            last_seen = cur_fname
-            t_start = time.time()
-            print(f"[lock] Waiting for: {cur_fname}")
 
-        if time.time() - t_start > timeout_seconds:
-            raise TimeoutError(f"[lock] Timeout waiting for: {cur_fname}")
+def release_lock(api_url, my_iso: str = None, job_id=None) -> None:
+    entries = list_lock_entries(api_url)
 
-        time.sleep(5.0)
+    if my_iso:
+        my_fname = f"lock-{my_iso.replace(':', '')}"
+        mine = [e for e in entries if e["name"].endswith(my_fname)]
+        if job_id:
+            mine = [e for e in mine if e["name"].startswith(f"{job_id}-")]
+    else:
+        mine = [e for e in entries if job_id and job_id in e["fname"]]
 
+    for e in mine:
+        delete_file(api_url, e["file"])
+        _delete_heartbeats(api_url, e["name"])
+        print(f"[lock] Released: {e['fname']}")
 
-def release_lock(api_url, my_iso: str = None, job_id=None) -> None:
-    cur = find_current_lock(api_url)
-    my_fname = f"lock-{my_iso.replace(':', '')}"
-
-    if not my_iso:
-        cur_fname = cur.get("fname", "")
-        if job_id in cur_fname:
-            delete_file(api_url, cur)
-            print(f"[lock] Released: {cur_fname}")
-            return True
-
-    if cur:
-        cur_fname = cur.get("fname", "")
-        if cur_fname.endswith(f"/{my_fname}"):
-            delete_file(api_url, cur)
-            print(f"[lock] Released: {my_fname}")
-        else:
+    if not mine:
+        if entries:
             print(f"[lock] Not our lock, skipping release")
-    else:
-        print(f"[lock] No lock found")
+        else:
+            print(f"[lock] No lock found")
 
 
 def main(api, password):
@@ -181,12 +494,20 @@ def main(api, password):
     )
     login(api, password=password)
     print(f"[main] Acquiring lock: {MY_LOCK_DT} (PREEMPT={PREEMPT})")
-    place_lock(api, MY_LOCK_DT)
+    place_lock(
+        api,
+        MY_LOCK_DT,
+        priority=int(os.environ.get("MY_LOCK_PRIORITY", "0")),
+        cost=int(os.environ.get("MY_LOCK_COST", "0")),
+    )
+
+    stop_heartbeat = keep_alive(api, MY_LOCK_DT)
 
     print("[main] Running job (30s)...")
     time.sleep(30)
 
     print("[main] Releasing lock")
+    stop_heartbeat()
     release_lock(api, MY_LOCK_DT)
     print("[main] Done")
 
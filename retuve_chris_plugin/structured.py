@@ -0,0 +1,235 @@
+"""
+Browser-free report output: the metric table as a JSON document and as a
+DICOM Comprehensive SR with numeric measurements, built with pydicom.
+"""
+
+import json
+import math
+import re
+from datetime import datetime
+from typing import List, Optional
+
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.sequence import Sequence
+from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+
+COMPREHENSIVE_SR = "1.2.840.10008.5.1.4.1.1.88.33"
+# Coding scheme of the metric names, which have no standard codes
+METRIC_SCHEME = "99RETUVE"
+
+# (code value, coding scheme, meaning) of the UCUM unit per metric name
+DEGREES = ("deg", "UCUM", "degree")
+NO_UNITS = ("1", "UCUM", "no units")
+METRIC_UNITS = {
+    "alpha": DEGREES,
+    "beta": DEGREES,
+    "aca": DEGREES,
+}
+
+
+def _number(value) -> Optional[float]:
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        return None
+    return number if math.isfinite(number) else None
+
+
+def _code(value: str, scheme: str, meaning: str) -> Dataset:
+    code = Dataset()
+    code.CodeValue = value
+    code.CodingSchemeDesignator = scheme
+    code.CodeMeaning = meaning
+    return code
+
+
+def _metric_code(name: str) -> Dataset:
+    value = re.sub(r"[^A-Za-z0-9]+", "_", name).strip("_").upper()
+    return _code(value[:16] or "METRIC", METRIC_SCHEME, name[:64])
+
+
+def _content_item(
+    relationship: str, value_type: str, concept: Dataset
+) -> Dataset:
+    item = Dataset()
+    item.RelationshipType = relationship
+    item.ValueType = value_type
+    item.ConceptNameCodeSequence = Sequence([concept])
+    return item
+
+
+def _num_item(name: str, value: float) -> Dataset:
+    item = _content_item("CONTAINS", "NUM", _metric_code(name))
+
+    measured = Dataset()
+    measured.NumericValue = f"{value:.8g}"
+    measured.MeasurementUnitsCodeSequence = Sequence(
+        [_code(*METRIC_UNITS.get(name.lower(), NO_UNITS))]
+    )
+    item.MeasuredValueSequence = Sequence([measured])
+    return item
+
+
+class StructuredReport:
+    """
+    The metric table of one sweep or study, written as JSON and as a DICOM
+    SR instead of being rendered to PDF.
+    """
+
+    def __init__(self, title: str, success: bool = True):
+        self.title = title
+        self.success = success
+        self.sweeps: List[dict] = []
+
+    def add_sweep(self, dicom, values) -> "StructuredReport":
+        """
+        Add the metrics of one analysed sweep.
+
+        Args:
+            dicom: The sweep's DICOM dataset
+            values: (metric name, value) rows, as from analyse_dicom
+        """
+        metrics = {}
+        for name, value in values:
+            number = _number(value)
+            metrics[name] = number if number is not None else str(value)
+
+        self.sweeps.append(
+            {
+                "instance_number": str(dicom.get("InstanceNumber", "")),
+                "sop_instance_uid": str(dicom.get("SOPInstanceUID", "")),
+                "metrics": metrics,
+            }
+        )
+        return self
+
+    def to_dict(self, dicom_tags=None) -> dict:
+        dicom_tags = dicom_tags if dicom_tags is not None else Dataset()
+        return {
+            "title": self.title,
+            "status": "ok" if self.success else "error",
+            "patient_id": str(dicom_tags.get("PatientID", "")),
+            "study_instance_uid": str(dicom_tags.get("StudyInstanceUID", "")),
+            "sweeps": self.sweeps,
+        }
+
+    def save_json(self, output_path: str, dicom_tags=None) -> bool:
+        try:
+            with open(output_path, "w") as f:
+                json.dump(self.to_dict(dicom_tags), f, indent=2)
+            return True
+        except (OSError, TypeError) as e:
+            print(f"Error writing JSON report: {str(e)}")
+            return False
+
+    def _content(self) -> Sequence:
+        groups = []
+        for sweep in self.sweeps:
+            group = _content_item(
+                "CONTAINS",
+                "CONTAINER",
+                _code("125007", "DCM", "Measurement Group"),
+            )
+            group.ContinuityOfContent = "SEPARATE"
+
+            tracking = _content_item(
+                "HAS OBS CONTEXT",
+                "TEXT",
+                _code("112039", "DCM", "Tracking Identifier"),
+            )
+            tracking.TextValue = f"Sweep {sweep['instance_number']}"
+
+            children = [tracking]
+            for name, value in sweep["metrics"].items():
+                # Only numeric values are measurements
+                if isinstance(value, float):
+                    children.append(_num_item(name, value))
+
+            group.ContentSequence = Sequence(children)
+            groups.append(group)
+        return Sequence(groups)
+
+    def save_to_dicom_sr(
+        self,
+        output_path: str,
+        dicom_tags: Dataset = None,
+        series_number: int = 998,
+        series_description: str = "Hip Analysis Measurements",
+    ) -> bool:
+        """
+        Save the metrics as a DICOM Comprehensive SR.
+
+        Args:
+            output_path: Path to write the DICOM file to
+            dicom_tags: Dataset to copy the patient and study tags from
+            series_number: Series number of the SR
+            series_description: Series description of the SR
+
+        Returns:
+            True if successful, False otherwise
+        """
+        try:
+            dicom_tags = dicom_tags if dicom_tags is not None else Dataset()
+            now = datetime.now()
+
+            file_meta = FileMetaDataset()
+            file_meta.MediaStorageSOPClassUID = COMPREHENSIVE_SR
+            file_meta.MediaStorageSOPInstanceUID = generate_uid()
+            file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+
+            ds = Dataset()
+            ds.file_meta = file_meta
+
+            # Patient and General Study modules, type 2 tags left empty
+            for tag in [
+                "PatientName",
+                "PatientID",
+                "PatientBirthDate",
+                "PatientSex",
+                "StudyInstanceUID",
+                "StudyID",
+                "StudyDate",
+                "StudyTime",
+                "AccessionNumber",
+                "ReferringPhysicianName",
+            ]:
+                value = dicom_tags.get(tag)
+                setattr(ds, tag, value if value is not None else "")
+            if not ds.StudyInstanceUID:
+                ds.StudyInstanceUID = generate_uid()
+
+            # SR Document Series module
+            ds.Modality = "SR"
+            ds.SeriesInstanceUID = generate_uid()
+            ds.SeriesNumber = series_number
+            ds.SeriesDescription = series_description
+            ds.ReferencedPerformedProcedureStepSequence = Sequence()
+
+            # General Equipment module
+            ds.Manufacturer = "Retuve"
+
+            # SR Document General module
+            ds.InstanceNumber = 1
+            ds.CompletionFlag = "COMPLETE"
+            ds.VerificationFlag = "UNVERIFIED"
+            ds.ContentDate = now.strftime("%Y%m%d")
+            ds.ContentTime = now.strftime("%H%M%S")
+            ds.PerformedProcedureCodeSequence = Sequence()
+
+            # SR Document Content module
+            ds.ValueType = "CONTAINER"
+            ds.ConceptNameCodeSequence = Sequence(
+                [_code("126000", "DCM", "Imaging Measurement Report")]
+            )
+            ds.ContinuityOfContent = "SEPARATE"
+            ds.ContentSequence = self._content()
+
+            # SOP Common module
+            ds.SOPClassUID = COMPREHENSIVE_SR
+            ds.SOPInstanceUID = file_meta.MediaStorageSOPInstanceUID
+
+            ds.save_as(output_path, enforce_file_format=True)
+            return True
+        except Exception as e:
+            print(f"Error generating DICOM SR: {str(e)}")
+            return False
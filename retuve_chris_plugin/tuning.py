@@ -0,0 +1,335 @@
+"""
+Calibrates inference threads, worker count and batch size for the CPU
+the plugin is running on, and caches the result per CPU and model.
+"""
+
+import hashlib
+import json
+import math
+import os
+import platform
+import time
+from argparse import Namespace
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+from dotenv import load_dotenv
+
+load_dotenv()
+
+TUNING_CACHE = os.environ.get(
+    "RETUVE_TUNING_CACHE",
+    os.path.expanduser("~/.cache/retuve-chris-plugin/tuning.json"),
+)
+# Upper bound on the time spent profiling when there is no cached result
+TUNING_BUDGET_SECONDS = float(os.environ.get("RETUVE_TUNING_BUDGET", "30"))
+BATCH_SIZES = [1, 2, 4, 8, 16]
+SYNTHETIC_FRAME_SHAPE = (600, 800, 3)
+# YOLO's graph runs one op at a time, so more inter-op threads would only
+# compete with the intra-op ones
+INTER_OP_THREADS = 1
+# Bumped when calibration changes, so older cached results are redone
+CALIBRATION_VERSION = 2
+# ultralytics versions, from and up to, that keep the ONNX Runtime session
+# at predictor.model.backend.session, which is replaced to set its threads
+ONNX_SESSION_VERSIONS = ((8, 4), (9, 0))
+
+
+def _cgroup_cpu_limit() -> Optional[float]:
+    # cgroup v2
+    try:
+        quota, period = Path("/sys/fs/cgroup/cpu.max").read_text().split()
+        if quota != "max":
+            return int(quota) / int(period)
+        return None
+    except (OSError, ValueError):
+        pass
+
+    # cgroup v1
+    try:
+        quota = int(
+            Path("/sys/fs/cgroup/cpu/cpu.cfs_quota_us").read_text().strip()
+        )
+        period = int(
+            Path("/sys/fs/cgroup/cpu/cpu.cfs_period_us").read_text().strip()
+        )
+        if quota > 0:
+            return quota / period
+    except (OSError, ValueError):
+        pass
+
+    return None
+
+
+def available_cpus() -> int:
+    """
+    CPUs this process can actually use, from its affinity mask and any
+    cgroup CPU quota.
+    """
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+
+    limit = _cgroup_cpu_limit()
+    if limit is not None:
+        cpus = min(cpus, max(1, math.ceil(limit)))
+
+    return cpus
+
+
+def _weights_path(model) -> Optional[str]:
+    weights = getattr(model, "ckpt_path", None) or getattr(
+        model, "model_name", None
+    )
+    return str(weights) if weights else None
+
+
+def _model_hash(model) -> str:
+    weights = _weights_path(model)
+    digest = hashlib.sha256()
+    if weights and os.path.isfile(weights):
+        with open(weights, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                digest.update(chunk)
+    else:
+        digest.update(str(weights).encode())
+    return digest.hexdigest()[:16]
+
+
+def _cpu_model() -> str:
+    try:
+        for line in Path("/proc/cpuinfo").read_text().splitlines():
+            if line.startswith("model name"):
+                return line.split(":", 1)[1].strip()
+    except OSError:
+        pass
+    return platform.processor() or "unknown"
+
+
+def _machine_key(cpus: int) -> str:
+    # Not the hostname, which is unique to every job pod
+    return f"{_cpu_model()}-{platform.machine()}-{cpus}cpu"
+
+
+def _load_cache() -> dict:
+    try:
+        with open(TUNING_CACHE) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _save_cache(cache: dict) -> None:
+    os.makedirs(os.path.dirname(TUNING_CACHE), exist_ok=True)
+    tmp_path = f"{TUNING_CACHE}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(cache, f, indent=2)
+    os.replace(tmp_path, TUNING_CACHE)
+
+
+def _synthetic_frames(count: int) -> list:
+    rng = np.random.default_rng(0)
+    return [
+        rng.integers(0, 255, SYNTHETIC_FRAME_SHAPE, dtype=np.uint8)
+        for _ in range(count)
+    ]
+
+
+def _set_inter_op_threads(threads: int) -> None:
+    import torch
+
+    if torch.get_num_interop_threads() == threads:
+        return
+    try:
+        torch.set_num_interop_threads(threads)
+    except RuntimeError:
+        # Only possible before the first parallel work in the process,
+        # e.g. not on later jobs of the daemon
+        print(
+            "[tuning] Inter-op threads already fixed at "
+            f"{torch.get_num_interop_threads()} in this process"
+        )
+
+
+def _is_onnx(model) -> bool:
+    weights = _weights_path(model)
+    return bool(weights) and weights.endswith(".onnx")
+
+
+def _onnx_session_supported() -> bool:
+    import ultralytics
+
+    try:
+        version = tuple(
+            int(part) for part in ultralytics.__version__.split(".")[:2]
+        )
+    except ValueError:
+        return False
+    return ONNX_SESSION_VERSIONS[0] <= version < ONNX_SESSION_VERSIONS[1]
+
+
+def _onnx_backend(model):
+    """
+    The ONNX Runtime backend of the model's predictor, or None for torch
+    weights, GPU sessions, a model that has not predicted yet or an
+    ultralytics version whose backend layout is not known.
+    """
+    if not _is_onnx(model) or not _onnx_session_supported():
+        return None
+    predictor = getattr(model, "predictor", None)
+    backend = getattr(getattr(predictor, "model", None), "backend", None)
+    if getattr(backend, "session", None) is None:
+        return None
+    if getattr(backend, "use_io_binding", False):
+        return None
+    return backend
+
+
+def _set_intra_op_threads(model, threads: int) -> None:
+    """
+    Set the intra-op threads of torch and, for ONNX weights, of the ONNX
+    Runtime session, which ignores the torch settings. If the session
+    cannot be recreated, the current one is kept.
+    """
+    import torch
+
+    torch.set_num_threads(threads)
+
+    backend = _onnx_backend(model)
+    weights = _weights_path(model)
+    if backend is None or not weights or not os.path.isfile(weights):
+        return
+    if backend.session.get_session_options().intra_op_num_threads == threads:
+        return
+
+    try:
+        import onnxruntime
+
+        session_options = onnxruntime.SessionOptions()
+        session_options.intra_op_num_threads = threads
+        session_options.inter_op_num_threads = INTER_OP_THREADS
+        session = onnxruntime.InferenceSession(
+            weights,
+            session_options,
+            providers=backend.session.get_providers(),
+        )
+    except Exception as e:
+        print(f"[tuning] Keeping the default ONNX Runtime threads: {e}")
+        return
+
+    backend.session_options = session_options
+    backend.session = session
+
+
+def _frames_per_second(model, batch_size: int, frames: list) -> float:
+    batch = frames[:batch_size]
+    # Warm up so lazy initialisation is not measured
+    model.predict(batch, verbose=False, device="cpu")
+
+    start = time.perf_counter()
+    for _ in range(2):
+        model.predict(batch, verbose=False, device="cpu")
+    return 2 * batch_size / (time.perf_counter() - start)
+
+
+def calibrate(model, cpus: int) -> dict:
+    """
+    Profile the model on synthetic frames and pick the fastest thread and
+    batch settings within the time budget.
+    """
+    frames = _synthetic_frames(max(BATCH_SIZES))
+    # Set up the predictor, and with it any ONNX Runtime session
+    model.predict(frames[:1], verbose=False, device="cpu")
+
+    thread_options = sorted({cpus, max(1, cpus // 2), max(1, cpus // 4)})
+    deadline = time.time() + TUNING_BUDGET_SECONDS
+
+    best = {"intra_op_threads": cpus, "batch_size": 1, "fps": 0.0}
+    for threads in reversed(thread_options):
+        _set_intra_op_threads(model, threads)
+        for batch_size in BATCH_SIZES:
+            if time.time() > deadline:
+                break
+            try:
+                fps = _frames_per_second(model, batch_size, frames)
+            except Exception:
+                # e.g. static batch dimension, larger batches will fail too
+                break
+            if fps > best["fps"]:
+                best = {
+                    "intra_op_threads": threads,
+                    "batch_size": batch_size,
+                    "fps": round(fps, 2),
+                }
+
+    # Each sweep fills whole batches by itself, so analysing more DICOMs at
+    # once only keeps inference busy while others decode and analyse: one
+    # per share of intra-op threads the CPUs fit, plus one
+    best["workers"] = max(1, min(cpus, 1 + cpus // best["intra_op_threads"]))
+    return best
+
+
+def apply_tuning(model, options: Namespace) -> Namespace:
+    """
+    Tune the thread pools and inference knobs for this machine and model,
+    using the cached calibration when there is one.
+
+    Options given on the command line (see config.passed_options) are left
+    alone. Without that record, none are overridden.
+
+    Args:
+        model: The loaded YOLO model
+        options: The parsed plugin options
+
+    Returns:
+        A copy of options with the tuned values applied
+    """
+    # Must come before the first prediction of the process
+    _set_inter_op_threads(INTER_OP_THREADS)
+
+    cpus = available_cpus()
+    key = f"v{CALIBRATION_VERSION}-{_machine_key(cpus)}-{_model_hash(model)}"
+
+    cache = _load_cache()
+    tuning = cache.get(key)
+    if tuning is None:
+        print(f"[tuning] Calibrating for {cpus} CPUs...")
+        tuning = calibrate(model, cpus)
+        cache[key] = tuning
+        try:
+            _save_cache(cache)
+        except OSError as e:
+            print(f"[tuning] Could not save calibration: {e}")
+    elif (
+        _is_onnx(model)
+        and tuning["intra_op_threads"] < cpus
+        and _onnx_session_supported()
+        and _onnx_backend(model) is None
+    ):
+        # Set up the predictor so its ONNX Runtime session can be tuned. Its
+        # default already uses every CPU, and torch weights need no session.
+        model.predict(_synthetic_frames(1), verbose=False, device="cpu")
+
+    _set_intra_op_threads(model, tuning["intra_op_threads"])
+
+    passed = getattr(options, "passed_options", None)
+    if passed is None:
+        passed = vars(options)
+    options = Namespace(**vars(options))
+    for option, value in [
+        ("inference_batch_size", tuning["batch_size"]),
+        ("inference_files", tuning["workers"]),
+        ("study_workers", tuning["workers"]),
+    ]:
+        if option not in passed:
+            setattr(options, option, value)
+
+    print(
+        f"[tuning] {key}: intra-op threads {tuning['intra_op_threads']}, "
+        f"inter-op threads {INTER_OP_THREADS}, "
+        f"workers {options.inference_files}, "
+        f"batch size {options.inference_batch_size}"
+    )
+    return options
@@ -0,0 +1,217 @@
+"""
+Persistent, content-addressed cache of model weights downloaded from
+--model-url, so repeat jobs never fetch or re-validate the same weights.
+"""
+
+import fcntl
+import hashlib
+import json
+import os
+import tempfile
+import time
+from contextlib import contextmanager
+from typing import Optional
+
+import requests
+from dotenv import load_dotenv
+
+load_dotenv()
+
+WEIGHTS_CACHE = os.environ.get(
+    "RETUVE_WEIGHTS_CACHE",
+    os.path.expanduser("~/.cache/retuve-chris-plugin/weights"),
+)
+# Least recently used weights are evicted above this total size
+WEIGHTS_CACHE_MAX_MB = float(
+    os.environ.get("RETUVE_WEIGHTS_CACHE_MAX_MB", "2048")
+)
+# Only use cached weights, never download
+WEIGHTS_OFFLINE = os.environ.get(
+    "RETUVE_WEIGHTS_OFFLINE", "false"
+).lower() in {"1", "true", "yes"}
+DOWNLOAD_TIMEOUT = float(os.environ.get("RETUVE_WEIGHTS_TIMEOUT", "60"))
+
+INDEX_FNAME = "index.json"
+LOCK_FNAME = ".lock"
+
+
+@contextmanager
+def _locked():
+    # Serialises index updates between plugin instances sharing the cache
+    os.makedirs(WEIGHTS_CACHE, exist_ok=True)
+    with open(os.path.join(WEIGHTS_CACHE, LOCK_FNAME), "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _load_index() -> dict:
+    try:
+        with open(os.path.join(WEIGHTS_CACHE, INDEX_FNAME)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _save_index(index: dict) -> None:
+    index_path = os.path.join(WEIGHTS_CACHE, INDEX_FNAME)
+    tmp_path = f"{index_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(index, f, indent=2)
+    os.replace(tmp_path, index_path)
+
+
+def _blob_path(sha256: str, ext: str) -> str:
+    return os.path.join(WEIGHTS_CACHE, f"{sha256}.{ext}")
+
+
+def _cached_path(entry: Optional[dict], sha256: Optional[str]):
+    if entry is None or (sha256 and entry["sha256"] != sha256):
+        return None
+    path = _blob_path(entry["sha256"], entry["ext"])
+    # A size check catches truncation without rehashing the file
+    if not os.path.isfile(path) or os.path.getsize(path) != entry["size"]:
+        return None
+    return path
+
+
+def _download_url(url: str):
+    """The URL to fetch and the headers to send, as the YOLO plugin does."""
+    from retuve_yolo_plugin.utils import _convert_github_url
+
+    download_url = _convert_github_url(url)
+    headers = {"User-Agent": "Python-GitHub-File-Downloader"}
+    token = os.getenv("GITHUB_PAT")
+    if "api.github.com" in download_url and token:
+        headers["Authorization"] = f"token {token}"
+        headers["Accept"] = "application/vnd.github.v3.raw"
+    return download_url, headers
+
+
+def _download(url: str, ext: str) -> tuple:
+    """
+    Download url into the cache under a temporary name.
+
+    Returns:
+        The temporary path, its SHA-256 and its size
+    """
+    download_url, headers = _download_url(url)
+    print(f"[weights] Downloading {url}...")
+
+    fd, tmp_path = tempfile.mkstemp(
+        dir=WEIGHTS_CACHE, prefix=".download-", suffix=f".{ext}"
+    )
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        with os.fdopen(fd, "wb") as f, requests.get(
+            download_url,
+            headers=headers,
+            stream=True,
+            timeout=DOWNLOAD_TIMEOUT,
+        ) as response:
+            response.raise_for_status()
+            for chunk in response.iter_content(chunk_size=1 << 20):
+                f.write(chunk)
+                digest.update(chunk)
+                size += len(chunk)
+            f.flush()
+            os.fsync(f.fileno())
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+    return tmp_path, digest.hexdigest(), size
+
+
+def _evict(index: dict, keep: str) -> None:
+    max_bytes = WEIGHTS_CACHE_MAX_MB * 1024 * 1024
+    blobs = {}
+    for entry in index.values():
+        blob = _blob_path(entry["sha256"], entry["ext"])
+        last_used = max(entry["last_used"], blobs.get(blob, (0, 0))[1])
+        blobs[blob] = (entry["size"], last_used)
+
+    total = sum(size for size, _ in blobs.values())
+    for blob, (size, _) in sorted(blobs.items(), key=lambda b: b[1][1]):
+        if total <= max_bytes:
+            break
+        if blob == keep:
+            continue
+        try:
+            os.remove(blob)
+        except FileNotFoundError:
+            pass
+        total -= size
+        for url in [
+            url
+            for url, entry in index.items()
+            if _blob_path(entry["sha256"], entry["ext"]) == blob
+        ]:
+            del index[url]
+        print(f"[weights] Evicted {os.path.basename(blob)}")
+
+
+def resolve_weights(
+    model_url: Optional[str], sha256: Optional[str] = None
+) -> Optional[str]:
+    """
+    Local path of the weights for --model-url, downloading them into the
+    cache only when they are not there already.
+
+    Weights are stored under their SHA-256 and indexed by URL. Downloads
+    are written to a temporary file and renamed into place, so a crashed
+    or concurrent job never sees partial weights.
+
+    Args:
+        model_url: The weights URL, a local path or None for the defaults
+        sha256: The expected SHA-256 of the weights (optional)
+
+    Returns:
+        The path to load the model from, or model_url itself if it is not
+        a URL
+    """
+    if model_url is None or not model_url.startswith("http"):
+        return model_url
+
+    sha256 = sha256.lower() if sha256 else None
+    ext = model_url.split("?")[0].split(".")[-1]
+
+    with _locked():
+        index = _load_index()
+        path = _cached_path(index.get(model_url), sha256)
+        if path is not None:
+            index[model_url]["last_used"] = time.time()
+            _save_index(index)
+            print(f"[weights] Using cached weights {path}")
+            return path
+
+        if WEIGHTS_OFFLINE:
+            raise FileNotFoundError(
+                f"Weights for {model_url} are not cached and "
+                "RETUVE_WEIGHTS_OFFLINE is set"
+            )
+
+        tmp_path, digest, size = _download(model_url, ext)
+        if sha256 and digest != sha256:
+            os.remove(tmp_path)
+            raise ValueError(
+                f"Checksum mismatch for {model_url}: expected {sha256}, "
+                f"got {digest}"
+            )
+
+        path = _blob_path(digest, ext)
+        os.replace(tmp_path, path)
+        index[model_url] = {
+            "sha256": digest,
+            "ext": ext,
+            "size": size,
+            "last_used": time.time(),
+        }
+        _evict(index, keep=path)
+        _save_index(index)
+
+    print(f"[weights] Cached {model_url} as {path} ({size:,} bytes)")
+    return path
@@ -26,7 +26,8 @@ setup(
         "console_scripts": [
             # here you need to declare the name of your executable program
             # and your main function
-            "retuve_chris_plugin = retuve_chris_plugin:main"
+            "retuve_chris_plugin = retuve_chris_plugin:main",
+            "retuve_chris_daemon = retuve_chris_plugin.daemon:serve",
         ]
     },
 )
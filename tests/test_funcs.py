@@ -0,0 +1,74 @@
+import numpy as np
+import pytest
+
+from retuve_chris_plugin.funcs import (
+    SEED_TOLERANCE,
+    _angle_bounds,
+    _build_valid_pairs,
+    _compute_all_angles,
+    _largest_pair_angle,
+    _line_directions,
+    _pair_angle_bounds,
+    _search_alpha_pairs,
+    _synthetic_sweep,
+    find_alpha_landmarks,
+)
+
+
+def random_pairs(seed):
+    rng = np.random.default_rng(seed)
+    points = rng.uniform(0, 500, (40, 2))
+    # A repeated point makes zero-length lines on the left
+    points[5] = points[6]
+    return (
+        _build_valid_pairs(points[:20], 0.0),
+        _build_valid_pairs(points[20:], 30.0),
+    )
+
+
+def directions(left, right):
+    return (
+        _line_directions(left[0], left[1]),
+        _line_directions(right[0], right[1]),
+    )
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_pair_angle_bounds_match_all_angles(seed):
+    left, right = random_pairs(seed)
+    angles = _compute_all_angles(left[0], left[1], right[0], right[1])
+
+    assert _pair_angle_bounds(*directions(left, right)) == pytest.approx(
+        _angle_bounds(angles), abs=1e-6
+    )
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_largest_pair_angle_is_full_search_angle(seed):
+    left, right = random_pairs(seed)
+    left_dirs, right_dirs = directions(left, right)
+    _, upper_bound = _pair_angle_bounds(left_dirs, right_dirs)
+
+    assert _largest_pair_angle(
+        left_dirs, right_dirs, upper_bound
+    ) == pytest.approx(_search_alpha_pairs(left, right)[0], abs=1e-6)
+
+
+def test_seeded_search_within_tolerance_of_full_search():
+    full = [
+        find_alpha_landmarks(ilium, landmarks)[1]
+        for ilium, landmarks in _synthetic_sweep(30)
+    ]
+
+    seed = None
+    seeded = []
+    for ilium, landmarks in _synthetic_sweep(30):
+        landmarks, angle = find_alpha_landmarks(ilium, landmarks, seed=seed)
+        seed = landmarks.alpha_seed
+        seeded.append(angle)
+
+    # Angles are rounded to 2 decimals
+    assert all(
+        0 <= full_angle - seeded_angle <= SEED_TOLERANCE + 0.01
+        for full_angle, seeded_angle in zip(full, seeded)
+    )
@@ -0,0 +1,62 @@
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+from retuve.classes.seg import SegFrameObjects, SegObject
+from retuve.keyphrases.config import Config
+
+from retuve_chris_plugin import inference
+from retuve_chris_plugin.inference import FrameDeduplicator
+
+
+@pytest.fixture
+def sweep(monkeypatch):
+    rng = np.random.default_rng(0)
+    base = rng.integers(0, 200, (32, 32, 3), dtype=np.uint8)
+    # Frame offsets from the base frame, in grey levels
+    offsets = [0, 1, 2, 30, 31, 31, 0]
+    frames = np.stack([base + offset for offset in offsets])
+
+    monkeypatch.setattr(
+        Config, "get_config", classmethod(lambda cls, keyphrase: keyphrase)
+    )
+    monkeypatch.setattr(
+        inference, "preprocess_sweep", lambda dcm, dicom_type, dec: frames
+    )
+    return frames
+
+
+def run(threshold):
+    inferred = []
+
+    def predict_images(images, config, model, **kwargs):
+        inferred.extend(images)
+        return [
+            SegFrameObjects(img=image, seg_objects=[SegObject(empty=True)])
+            for image in images
+        ]
+
+    dedup = FrameDeduplicator(threshold, predict_images=predict_images)
+    config = SimpleNamespace(dicom_type="SERIES")
+    return dedup(None, config), inferred, dedup
+
+
+@pytest.mark.parametrize(
+    "threshold, inferred_frames", [(0.5, 6), (1.5, 4), (2.5, 3), (50, 1)]
+)
+def test_threshold_decides_which_frames_are_inferred(
+    sweep, threshold, inferred_frames
+):
+    results, inferred, dedup = run(threshold)
+
+    assert len(inferred) == inferred_frames
+    assert len(results) == len(sweep)
+    assert dedup.reused == len(sweep) - inferred_frames
+
+
+def test_reused_frames_keep_their_own_image_and_copy(sweep):
+    results, _, _ = run(2.5)
+
+    for frame, result in zip(sweep, results):
+        assert np.array_equal(result.img, frame)
+    assert results[1].seg_objects is not results[0].seg_objects
@@ -0,0 +1,59 @@
+import pytest
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+
+from retuve_chris_plugin.job import shard_files
+
+
+def write_header(path, study_uid):
+    meta = FileMetaDataset()
+    meta.MediaStorageSOPClassUID = "1.2.840.10008.5.1.4.1.1.3.1"
+    meta.MediaStorageSOPInstanceUID = generate_uid()
+    meta.TransferSyntaxUID = ExplicitVRLittleEndian
+
+    ds = Dataset()
+    ds.file_meta = meta
+    ds.SOPClassUID = meta.MediaStorageSOPClassUID
+    ds.SOPInstanceUID = meta.MediaStorageSOPInstanceUID
+    ds.StudyInstanceUID = study_uid
+    ds.save_as(path, enforce_file_format=True)
+
+
+@pytest.fixture
+def store_mapper(tmp_path):
+    studies = [generate_uid() for _ in range(8)]
+    mapper = []
+    for i, study_uid in enumerate(studies):
+        for sweep in range(3):
+            input_file = tmp_path / f"study{i}-sweep{sweep}.dcm"
+            write_header(input_file, study_uid)
+            mapper.append((input_file, tmp_path / "out" / input_file.name))
+    return mapper
+
+
+def test_shards_split_the_job_by_study(tmp_path, store_mapper):
+    shards = [shard_files(store_mapper, tmp_path, i, 3) for i in range(3)]
+
+    assert sorted(pair for shard in shards for pair in shard) == sorted(
+        store_mapper
+    )
+    for shard in shards:
+        # Every sweep of a study lands in the same shard, in input order
+        studies = {pair[0].name.split("-")[0] for pair in shard}
+        assert len(shard) == 3 * len(studies)
+        assert shard == [pair for pair in store_mapper if pair in shard]
+
+
+def test_shards_are_deterministic(tmp_path, store_mapper):
+    assert shard_files(store_mapper, tmp_path, 1, 3) == shard_files(
+        list(store_mapper), tmp_path, 1, 3
+    )
+
+
+def test_single_shard_keeps_everything(tmp_path, store_mapper):
+    assert shard_files(store_mapper, tmp_path, 0, 1) == store_mapper
+
+
+def test_shard_index_out_of_range(tmp_path, store_mapper):
+    with pytest.raises(ValueError):
+        shard_files(store_mapper, tmp_path, 3, 3)
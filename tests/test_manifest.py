@@ -0,0 +1,32 @@
+import json
+
+from retuve_chris_plugin.manifest import (
+    ANALYSED,
+    MANIFEST_FNAME,
+    ORIGINAL_UPLOADED,
+    Manifest,
+)
+
+
+def test_truncated_line_is_skipped_and_terminated(tmp_path):
+    path = tmp_path / MANIFEST_FNAME
+    complete = json.dumps({"file": "a.dcm", "stage": ORIGINAL_UPLOADED})
+    path.write_text(complete + '\n{"file": "b.dcm", "sta')
+
+    manifest = Manifest(tmp_path)
+    assert manifest.has("a.dcm", ORIGINAL_UPLOADED)
+    assert not manifest.has("b.dcm", ORIGINAL_UPLOADED)
+
+    manifest.mark("b.dcm", ANALYSED)
+    resumed = Manifest(tmp_path)
+    assert resumed.has("a.dcm", ORIGINAL_UPLOADED)
+    assert resumed.has("b.dcm", ANALYSED)
+
+
+def test_marks_are_written_once(tmp_path):
+    manifest = Manifest(tmp_path)
+    manifest.mark("a.dcm", ANALYSED)
+    manifest.mark("a.dcm", ANALYSED)
+
+    lines = (tmp_path / MANIFEST_FNAME).read_text().splitlines()
+    assert len(lines) == 1
@@ -0,0 +1,84 @@
+import pytest
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+
+from retuve_chris_plugin import orthanc
+from retuve_chris_plugin.orthanc import CircuitBreaker
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(orthanc.time, "time", lambda: now[0])
+    return now
+
+
+def test_opens_after_threshold_failures(clock):
+    breaker = CircuitBreaker(threshold=3, reset_seconds=60)
+    for _ in range(2):
+        breaker.record_failure()
+        assert not breaker.is_open
+
+    breaker.record_failure()
+    assert breaker.is_open
+
+
+def test_success_resets_failures(clock):
+    breaker = CircuitBreaker(threshold=2, reset_seconds=60)
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    assert not breaker.is_open
+
+    breaker.record_failure()
+    breaker.record_success()
+    assert not breaker.is_open
+    assert breaker.failures == 0
+
+
+def test_lets_a_probe_through_after_reset(clock):
+    breaker = CircuitBreaker(threshold=1, reset_seconds=60)
+    breaker.record_failure()
+    clock[0] += 59
+    assert breaker.is_open
+
+    clock[0] += 1
+    assert not breaker.is_open
+
+    # A failed probe opens it for another reset period
+    breaker.record_failure()
+    assert breaker.is_open
+    clock[0] += 60
+    assert not breaker.is_open
+
+
+def test_uncompressed_original_sent_when_compressed_is_refused(
+    tmp_path, monkeypatch
+):
+    meta = FileMetaDataset()
+    meta.MediaStorageSOPClassUID = "1.2.840.10008.5.1.4.1.1.7"
+    meta.MediaStorageSOPInstanceUID = generate_uid()
+    meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    ds = Dataset()
+    ds.file_meta = meta
+    ds.SOPClassUID = meta.MediaStorageSOPClassUID
+    ds.SOPInstanceUID = meta.MediaStorageSOPInstanceUID
+    original, compressed = tmp_path / "original.dcm", tmp_path / "rle.dcm"
+    ds.save_as(original, enforce_file_format=True)
+    ds.save_as(compressed, enforce_file_format=True)
+
+    sent = []
+
+    def send(dataset, dicom_file_path):
+        sent.append(dicom_file_path)
+        if dicom_file_path == compressed:
+            raise ValueError("No presentation context accepted")
+        return True
+
+    monkeypatch.setattr(orthanc, "_send_with_retries", send)
+    monkeypatch.setattr(orthanc, "BREAKER", CircuitBreaker(3, 60))
+
+    assert orthanc.upload_dicom_to_orthanc(
+        compressed, uncompressed_path=original
+    )
+    assert sent == [compressed, original]
@@ -0,0 +1,64 @@
+import numpy as np
+import pytest
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian
+from radstract.data.dicom.utils import DicomTypes
+
+from retuve_chris_plugin.preprocess import (
+    CHUNK_FRAMES,
+    _per_frame_pipeline,
+    preprocess_sweep,
+    to_bgr,
+)
+
+
+def assert_matches_per_frame(pixels, frames):
+    expected = _per_frame_pipeline(pixels)
+    assert len(frames) == len(expected)
+    assert all(np.array_equal(a, b) for a, b in zip(expected, frames))
+
+
+@pytest.mark.parametrize(
+    "shape, dtype, low, high",
+    [
+        ((5, 16, 24), np.uint8, 0, 256),
+        ((5, 16, 24, 3), np.uint8, 0, 256),
+        ((5, 16, 24, 4), np.uint8, 0, 256),
+        # Out of range values are clipped, in chunks past CHUNK_FRAMES
+        ((CHUNK_FRAMES + 6, 16, 24), np.uint16, 0, 1000),
+        ((5, 16, 24), np.int16, -50, 300),
+    ],
+)
+def test_to_bgr_matches_per_frame_path(shape, dtype, low, high):
+    rng = np.random.default_rng(0)
+    pixels = rng.integers(low, high, shape).astype(dtype)
+    assert_matches_per_frame(pixels, to_bgr(pixels))
+
+
+def sweep_dataset(pixels):
+    meta = FileMetaDataset()
+    meta.TransferSyntaxUID = ExplicitVRLittleEndian
+
+    ds = Dataset()
+    ds.file_meta = meta
+    ds.Rows, ds.Columns = pixels.shape[1:3]
+    if len(pixels) > 1:
+        ds.NumberOfFrames = len(pixels)
+    ds.SamplesPerPixel = 3 if pixels.ndim == 4 else 1
+    ds.PhotometricInterpretation = "RGB" if pixels.ndim == 4 else "MONOCHROME2"
+    if pixels.ndim == 4:
+        ds.PlanarConfiguration = 0
+    ds.BitsAllocated = ds.BitsStored = 8
+    ds.HighBit = 7
+    ds.PixelRepresentation = 0
+    ds.PixelData = pixels.tobytes()
+    return ds
+
+
+@pytest.mark.parametrize(
+    "shape", [(6, 16, 24), (6, 16, 24, 3), (1, 16, 24), (1, 16, 24, 3)]
+)
+def test_preprocess_sweep_matches_per_frame_path(shape):
+    pixels = np.random.default_rng(1).integers(0, 256, shape, np.uint8)
+    frames = preprocess_sweep(sweep_dataset(pixels), DicomTypes.SERIES)
+    assert_matches_per_frame(pixels, frames)
@@ -0,0 +1,61 @@
+from datetime import datetime, timedelta, timezone
+
+from retuve_chris_plugin import schedule
+from retuve_chris_plugin.schedule import (
+    LOCK_SECONDS_PER_FRAME,
+    lock_score,
+    next_in_queue,
+)
+
+NOW = datetime(2026, 1, 1, 12, tzinfo=timezone.utc)
+
+
+def entry(waited, cost, priority=0, granted=False):
+    queued_at = NOW - timedelta(seconds=waited)
+    return {
+        "iso": queued_at.strftime("%Y-%m-%dT%H:%M:%S.%fZ"),
+        "cost": cost,
+        "priority": priority,
+        "granted": granted,
+    }
+
+
+def test_short_job_goes_before_long_job():
+    short, long = entry(10, 100), entry(10, 1000)
+    assert lock_score(short, NOW) > lock_score(long, NOW)
+    assert next_in_queue([long, short], NOW) is short
+
+
+def test_long_job_overtakes_after_waiting():
+    long_run = 1000 * LOCK_SECONDS_PER_FRAME
+    long, short = entry(10 * long_run, 1000), entry(0, 100)
+    assert next_in_queue([short, long], NOW) is long
+
+
+def test_priority_doubles_score():
+    low, high = entry(10, 100), entry(10, 100, priority=1)
+    assert lock_score(high, NOW) == 2 * lock_score(low, NOW)
+    assert next_in_queue([low, high], NOW) is high
+
+
+def test_granted_entries_are_not_queued():
+    assert next_in_queue([entry(10, 100, granted=True)], NOW) is None
+
+
+def test_latest_heartbeat_per_holder(monkeypatch):
+    beats = f"{schedule.LOCK_DIR_PATH}/{schedule.ALIVE_DIR}"
+    monkeypatch.setattr(
+        schedule,
+        "list_folder_files",
+        lambda api_url, folder_path: [
+            {"fname": f"{beats}/lock-2026-01-01T110000Z/beat-{beat}"}
+            for beat in ["2026-01-01T115800Z", "2026-01-01T115900Z"]
+        ]
+        + [{"fname": f"{beats}/lock-2026-01-01T110000Z/notes.txt"}],
+    )
+
+    assert schedule.list_heartbeats("api") == {
+        "lock-2026-01-01T110000Z": datetime(
+            2026, 1, 1, 11, 59, tzinfo=timezone.utc
+        )
+    }
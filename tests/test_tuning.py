@@ -0,0 +1,91 @@
+import json
+import platform
+from argparse import Namespace
+from types import SimpleNamespace
+
+import pytest
+
+from retuve_chris_plugin import tuning
+
+
+class FakeModel:
+    def __init__(self, weights):
+        self.ckpt_path = str(weights)
+        self.predictions = 0
+
+    def predict(self, *args, **kwargs):
+        self.predictions += 1
+
+
+def test_machine_key_ignores_hostname(monkeypatch):
+    key = tuning._machine_key(4)
+    monkeypatch.setattr(platform, "node", lambda: "job-pod-1234")
+    assert tuning._machine_key(4) == key
+    assert key.endswith(f"-{platform.machine()}-4cpu")
+
+
+@pytest.fixture
+def cached_tuning(tmp_path, monkeypatch):
+    monkeypatch.setattr(tuning, "TUNING_CACHE", str(tmp_path / "t.json"))
+    monkeypatch.setattr(tuning, "available_cpus", lambda: 4)
+
+    def cache(model, threads):
+        key = (
+            f"v{tuning.CALIBRATION_VERSION}-{tuning._machine_key(4)}-"
+            f"{tuning._model_hash(model)}"
+        )
+        (tmp_path / "t.json").write_text(
+            json.dumps(
+                {
+                    key: {
+                        "intra_op_threads": threads,
+                        "batch_size": 4,
+                        "workers": 2,
+                    }
+                }
+            )
+        )
+
+    return cache
+
+
+@pytest.mark.parametrize(
+    "weights, threads, predictions",
+    [("model.pt", 2, 0), ("model.onnx", 4, 0), ("model.onnx", 2, 1)],
+)
+def test_warm_up_only_when_onnx_threads_are_retuned(
+    cached_tuning, tmp_path, weights, threads, predictions
+):
+    model = FakeModel(tmp_path / weights)
+    cached_tuning(model, threads)
+
+    options = tuning.apply_tuning(
+        model,
+        Namespace(
+            inference_batch_size=1,
+            inference_files=1,
+            study_workers=1,
+            passed_options=["inference_files"],
+        ),
+    )
+
+    assert model.predictions == predictions
+    assert options.inference_batch_size == 4
+    assert options.inference_files == 1
+
+
+def test_session_kept_when_it_cannot_be_recreated(tmp_path):
+    weights = tmp_path / "model.onnx"
+    weights.write_bytes(b"not a model")
+    session = SimpleNamespace(
+        get_session_options=lambda: SimpleNamespace(intra_op_num_threads=0),
+        get_providers=lambda: ["CPUExecutionProvider"],
+    )
+    model = FakeModel(weights)
+    model.predictor = SimpleNamespace(
+        model=SimpleNamespace(backend=SimpleNamespace(session=session))
+    )
+
+    tuning._set_intra_op_threads(model, 2)
+
+    assert model.predictor.model.backend.session is session
@@ -0,0 +1,100 @@
+import hashlib
+import os
+
+import pytest
+
+from retuve_chris_plugin import weights
+from retuve_chris_plugin.weights import resolve_weights
+
+CONTENT = {
+    "https://example.org/a.pt": b"a" * 600_000,
+    "https://example.org/b.pt": b"b" * 600_000,
+}
+
+
+@pytest.fixture
+def downloads(tmp_path, monkeypatch):
+    monkeypatch.setattr(weights, "WEIGHTS_CACHE", str(tmp_path))
+    fetched = []
+
+    def download(url, ext):
+        fetched.append(url)
+        download_path = os.path.join(weights.WEIGHTS_CACHE, f".download.{ext}")
+        with open(download_path, "wb") as f:
+            f.write(CONTENT[url])
+        return (
+            download_path,
+            hashlib.sha256(CONTENT[url]).hexdigest(),
+            len(CONTENT[url]),
+        )
+
+    monkeypatch.setattr(weights, "_download", download)
+    return fetched
+
+
+def sha256(url):
+    return hashlib.sha256(CONTENT[url]).hexdigest()
+
+
+def test_cached_weights_are_not_downloaded_again(downloads):
+    url = "https://example.org/a.pt"
+    path = resolve_weights(url, sha256(url))
+
+    assert resolve_weights(url, sha256(url)) == path
+    assert resolve_weights(url) == path
+    assert downloads == [url]
+    with open(path, "rb") as f:
+        assert f.read() == CONTENT[url]
+
+
+def test_checksum_mismatch_is_rejected(downloads, tmp_path):
+    url = "https://example.org/a.pt"
+    with pytest.raises(ValueError):
+        resolve_weights(url, "0" * 64)
+
+    assert not [f for f in os.listdir(tmp_path) if f.endswith(".pt")]
+
+
+def test_different_checksum_downloads_again(downloads):
+    url = "https://example.org/a.pt"
+    resolve_weights(url)
+    with pytest.raises(ValueError):
+        resolve_weights(url, "0" * 64)
+    assert downloads == [url, url]
+
+
+def test_truncated_weights_are_downloaded_again(downloads):
+    url = "https://example.org/a.pt"
+    path = resolve_weights(url)
+    with open(path, "r+b") as f:
+        f.truncate(10)
+
+    assert resolve_weights(url) == path
+    assert os.path.getsize(path) == len(CONTENT[url])
+    assert downloads == [url, url]
+
+
+def test_least_recently_used_weights_are_evicted(downloads, monkeypatch):
+    # Room for one set of weights only
+    monkeypatch.setattr(weights, "WEIGHTS_CACHE_MAX_MB", 1)
+    a, b = "https://example.org/a.pt", "https://example.org/b.pt"
+    path_a = resolve_weights(a)
+    path_b = resolve_weights(b)
+
+    assert not os.path.exists(path_a)
+    assert os.path.exists(path_b)
+    assert resolve_weights(a) == path_a
+    assert not os.path.exists(path_b)
+    assert downloads == [a, b, a]
+
+
+def test_offline_fails_without_cached_weights(downloads, monkeypatch):
+    monkeypatch.setattr(weights, "WEIGHTS_OFFLINE", True)
+    with pytest.raises(FileNotFoundError):
+        resolve_weights("https://example.org/a.pt")
+    assert downloads == []
+
+
+def test_local_paths_are_returned_unchanged(downloads):
+    assert resolve_weights("/models/local.pt") == "/models/local.pt"
+    assert resolve_weights(None) is None